@@ -18,27 +18,32 @@
 #   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 from buildfarm.build import BuildStatus
-from buildfarm.sqldb import distinct_builds, Cast, StormBuild, setup_schema, StormHostDatabase
+from buildfarm.sqldb import StormBuild, StormHost, StormLatestBuild, setup_schema, StormHostDatabase
 from buildfarm.tree import Tree
 from storm.database import create_database
-from storm.expr import Desc
+from storm.expr import Coalesce, Desc, Join, LeftJoin
 from storm.store import Store
 
 import ConfigParser
 import os
 import re
 
-def read_trees_from_conf(path):
+def read_trees_from_conf(path, history_dir=None):
     """Read trees from a configuration file.
 
     :param path: tree path
+    :param history_dir: Directory with the history indexes of the trees
     :return: Dictionary with trees
     """
     ret = {}
     cfp = ConfigParser.ConfigParser()
     cfp.read(path)
     for s in cfp.sections():
-        ret[s] = Tree(name=s, **dict(cfp.items(s)))
+        if history_dir is None:
+            history_index = None
+        else:
+            history_index = os.path.join(history_dir, "%s.sqlite" % s)
+        ret[s] = Tree(name=s, history_index=history_index, **dict(cfp.items(s)))
     return ret
 
 
@@ -66,10 +71,12 @@ class BuildFarm(object):
         self.webdir = os.path.join(self.path, "web")
         if not os.path.isdir(path):
             raise Exception("web directory %s does not exist" % self.webdir)
-        self.trees = read_trees_from_conf(os.path.join(self.webdir, "trees.conf"))
+        self.trees = read_trees_from_conf(os.path.join(self.webdir, "trees.conf"),
+            os.path.join(self.path, "data", "cache", "history"))
         self.builds = self._open_build_results()
         self.upload_builds = self._open_upload_build_results()
         self.hostdb = self._open_hostdb()
+        self.outbox = self._open_outbox()
         self.compilers = self._load_compilers()
         self.lcovdir = os.path.join(self.path, "lcov/data")
 
@@ -84,11 +91,16 @@ class BuildFarm(object):
     def _open_upload_build_results(self):
         from buildfarm.build import UploadBuildResultStore
         path = os.path.join(self.path, "data", "upload")
-        return UploadBuildResultStore(path)
+        return UploadBuildResultStore(path,
+            os.path.join(self.path, "data", "upload.index"))
 
     def _open_hostdb(self):
         return StormHostDatabase(self._get_store())
 
+    def _open_outbox(self):
+        from buildfarm.outbox import MailOutbox
+        return MailOutbox(self._get_store())
+
     def _load_compilers(self):
         from buildfarm import util
         return set(util.load_list(os.path.join(self.webdir, "compilers.list")))
@@ -97,6 +109,10 @@ class BuildFarm(object):
         if self.store is not None:
             self.store.commit()
 
+    def rollback(self):
+        if self.store is not None:
+            self.store.rollback()
+
     def lcov_status(self, tree):
         """get status of build"""
         from buildfarm.build import NoSuchBuildError
@@ -132,17 +148,21 @@ class BuildFarm(object):
         else:
             return self.upload_builds.get_build(tree, host, compiler)
 
-    def get_new_builds(self):
+    def get_new_builds(self, unseen_only=False):
         hostnames = set([host.name for host in self.hostdb.hosts()])
-        for build in self.upload_builds.get_all_builds():
+        for build in self.upload_builds.get_all_builds(unseen_only):
             if (build.tree in self.trees and
                 build.compiler in self.compilers and
                 build.host in hostnames):
                 yield build
 
+    def _find_latest_builds(self, *args):
+        result = self._get_store().find(StormBuild,
+            StormBuild.id == StormLatestBuild.build_id, *args)
+        return result.order_by(Desc(StormBuild.upload_time))
+
     def get_last_builds(self):
-        result = self._get_store().find(StormBuild)
-        return distinct_builds(result.order_by(Desc(StormBuild.upload_time)))
+        return self._find_latest_builds()
 
     def get_summary_builds(self, min_age=0):
         """Return last build age, status for each tree/host/compiler.
@@ -153,30 +173,69 @@ class BuildFarm(object):
         store = self._get_store()
         return ((tree, BuildStatus.__deserialize__(status_str))
                 for (tree, status_str) in store.execute("""
-SELECT obd.tree, obd.status AS status_str
-FROM build obd
-INNER JOIN(
-    SELECT MAX(age) age, tree, host, compiler
-    FROM build
-    WHERE age > ?
-    GROUP BY tree, host, compiler
-) ibd ON obd.age = ibd.age AND
-         obd.tree = ibd.tree AND
-         obd.host = ibd.host AND
-         obd.compiler = ibd.compiler;
+SELECT build.tree, build.status AS status_str
+FROM latest_build
+INNER JOIN build ON build.id = latest_build.build
+WHERE latest_build.age > ?
+ORDER BY latest_build.tree, latest_build.host, latest_build.compiler;
 """, (min_age, )))
 
     def get_tree_builds(self, tree):
-        result = self._get_store().find(StormBuild,
-            Cast(StormBuild.tree, "TEXT") == Cast(tree, "TEXT"))
-        return distinct_builds(result.order_by(Desc(StormBuild.upload_time)))
+        return self._find_latest_builds(StormLatestBuild.tree == tree)
+
+    def get_tree_builds_with_platform(self, tree, sort_by="age"):
+        """Retrieve the latest builds of a tree, with the platforms of their hosts.
+
+        :param tree: Name of the tree
+        :param sort_by: What to sort on: "age", "revision", "host",
+            "compiler" or "platform". Builds with the same value are
+            sorted by age.
+        :return: Result set with (build, platform) tuples; the platform is
+            u"UNKNOWN" for hosts that are not in the host database or
+            have no platform set
+        """
+        platform = Coalesce(StormHost.platform, u"UNKNOWN")
+        columns = {
+            "revision": StormBuild.revision,
+            "host": StormBuild.host,
+            "compiler": StormBuild.compiler,
+            "platform": platform,
+            }
+        order_by = [Desc(StormBuild.upload_time)]
+        if sort_by != "age":
+            order_by.insert(0, columns[sort_by])
+        result = self._get_store().using(StormBuild,
+            Join(StormLatestBuild, StormBuild.id == StormLatestBuild.build_id),
+            LeftJoin(StormHost, StormHost.name == StormBuild.host)).find(
+                (StormBuild, platform), StormLatestBuild.tree == tree)
+        return result.order_by(*order_by)
 
     def host_last_build(self, host):
-        return max([build.upload_time for build in self.get_host_builds(host)])
+        return self._get_store().find(StormLatestBuild,
+            StormLatestBuild.host == host).max(StormLatestBuild.upload_time)
+
+    def last_upload_time(self, tree=None):
+        """Find the time of the most recent upload.
+
+        :param tree: Only consider builds of this tree
+        :return: Upload time, or None if there are no builds
+        """
+        args = []
+        if tree is not None:
+            args.append(StormLatestBuild.tree == tree)
+        return self._get_store().find(StormLatestBuild,
+            *args).max(StormLatestBuild.upload_time)
+
+    def host_last_builds(self):
+        """Retrieve the time of the last build of every host.
+
+        :return: Dictionary mapping host names to upload times
+        """
+        return dict(self._get_store().execute(
+            "SELECT host, MAX(age) FROM latest_build GROUP BY host"))
 
     def get_host_builds(self, host):
-        result = self._get_store().find(StormBuild, StormBuild.host == host)
-        return distinct_builds(result.order_by(Desc(StormBuild.upload_time)))
+        return self._find_latest_builds(StormLatestBuild.host == host)
 
     def _get_store(self):
         if self.store is not None:
@@ -192,5 +251,5 @@ INNER JOIN(
 
     def get_revision_builds(self, tree, revision=None):
         return self._get_store().find(StormBuild,
-            Cast(StormBuild.tree, "TEXT") == Cast(tree, "TEXT"),
-            Cast(StormBuild.revision, "TEXT") == Cast(revision, "TEXT"))
+            StormBuild.tree == tree,
+            StormBuild.revision == revision)
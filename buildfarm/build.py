@@ -24,6 +24,7 @@
 import bz2
 from cStringIO import StringIO
 import collections
+import gzip
 import hashlib
 import os
 import re
@@ -33,6 +34,11 @@ from storm.expr import Desc
 import time
 
 
+# Files that can exist for a build, relative to its basename.
+LOG_SUFFIXES = (".log", ".log.bz2", ".err", ".err.bz2",
+                ".subunit.gz", ".html.gz")
+
+
 def open_opt_compressed_file(path):
     try:
         return bz2.BZ2File(path+".bz2", 'r')
@@ -55,6 +61,53 @@ class TestResult(object):
         self.result = result
 
 
+# Number of recent runs that flakiness is judged on
+FLAKINESS_WINDOW = 32
+# Number of times a test has to go from passing to failing or back within
+# the window to be considered flaky
+FLAKY_MIN_FLIPS = 3
+
+
+class TestFlakiness(object):
+    """The recent results of a test for a tree, host and compiler.
+
+    The outcomes of the last `runs` runs (at most FLAKINESS_WINDOW) are
+    kept as a bit mask in `history`, with the most recent run in the
+    lowest bit; a set bit means the test failed.
+    """
+
+    def __init__(self, tree, host, compiler, test, runs=0, history=0):
+        self.tree = tree
+        self.host = host
+        self.compiler = compiler
+        self.test = test
+        self.runs = runs
+        self.history = history
+
+    @property
+    def failures(self):
+        """Number of failed runs."""
+        return bin(self.history).count("1")
+
+    @property
+    def flips(self):
+        """Number of times the test went from passing to failing or back."""
+        if self.runs < 2:
+            return 0
+        changes = (self.history ^ (self.history >> 1)) & ((1 << (self.runs - 1)) - 1)
+        return bin(changes).count("1")
+
+    @property
+    def score(self):
+        """Fraction of runs in which the result differed from the run before."""
+        if self.runs < 2:
+            return 0.0
+        return self.flips / float(self.runs - 1)
+
+    def is_flaky(self):
+        return self.flips >= FLAKY_MIN_FLIPS
+
+
 class BuildSummary(object):
 
     def __init__(self, host, tree, compiler, revision, status):
@@ -98,11 +151,39 @@ class BuildStatus(object):
         return not all([x.result == 0 for x in self.stages])
 
     def __serialize__(self):
-        return repr(self)
+        """Serialize this status as a compact string.
+
+        The format is STAGE=RESULT/STAGE=RESULT|FAILURE,FAILURE
+        """
+        return "%s|%s" % (
+            "/".join(["%s=%d" % (s.name, s.result) for s in self.stages]),
+            ",".join(sorted(self.other_failures)))
 
     @classmethod
     def __deserialize__(cls, text):
-        return eval(text)
+        if text.startswith("BuildStatus("):
+            return cls._deserialize_repr(text)
+        (stages, other_failures) = text.split("|", 1)
+        ret = cls()
+        if stages:
+            for stage in stages.split("/"):
+                (name, result) = stage.split("=", 1)
+                ret.stages.append(BuildStageResult(name, int(result)))
+        if other_failures:
+            ret.other_failures = set(other_failures.split(","))
+        return ret
+
+    @classmethod
+    def _deserialize_repr(cls, text):
+        """Parse the repr() of a BuildStatus, as used by older versions."""
+        stages = [(name, int(result)) for (name, result) in
+            re.findall(r"BuildStageResult\(name='([^']*)', result=(-?\d+)\)", text)]
+        m = re.search(r"set\(\[(.*)\]\)\)$", text)
+        if m:
+            other_failures = set(re.findall("'([^']*)'", m.group(1)))
+        else:
+            other_failures = set()
+        return cls(stages, other_failures)
 
     def __str__(self):
         if self.other_failures:
@@ -114,8 +195,12 @@ class BuildStatus(object):
             return True
         return False
 
-    def regressed_since(self, older):
-        """Check if this build has regressed since another build."""
+    def comparable_to(self, older):
+        """Check if the results of this build can be compared to another build.
+
+        Builds that ran out of disk space can not, and neither can two
+        builds that both timed out.
+        """
         if "disk full" in self.other_failures:
             return False
         if ("timeout" in self.other_failures and
@@ -123,6 +208,12 @@ class BuildStatus(object):
             # When the timeout happens exactly can differ slightly, so it's
             # okay if the numbers are a bit different..
             return False
+        return True
+
+    def regressed_since(self, older):
+        """Check if this build has regressed since another build."""
+        if not self.comparable_to(older):
+            return False
         if ("panic" in self.other_failures and
             not "panic" in older.other_failures):
             # If this build introduced panics, then that's always worse.
@@ -194,77 +285,231 @@ def extract_phase_output(f):
 
 
 def extract_test_output(f):
-    for name, output in extract_phase_output(f):
-        if name == "test":
-            return output
-    raise NoTestOutput()
+    """Extract the test output from a log.
 
+    :param f: Iterable over the lines of the log
+    :return: List with the lines of the test output
+    :raise NoTestOutput: if the log does not contain test output
+    """
+    return list(iter_test_output(f))
+
+
+def iter_test_output(f):
+    """Iterate over the test output in a log, without reading it all.
+
+    The test output consists of the lines after the start of the first
+    test action, up to the line that reports its result. If the test
+    action never finished, it ends at the start of the next action or
+    at the end of the log.
+
+    :param f: Iterable over the lines of the log
+    :return: Iterator over the lines of the test output
+    :raise NoTestOutput: if the log does not contain a test action
+    """
+    re_action = re.compile("^ACTION (PASSED|FAILED):")
+    f = iter(f)
+    for l in f:
+        if l.startswith("Running action ") and (
+                l[len("Running action "):].strip() == "test"):
+            break
+    else:
+        raise NoTestOutput()
+    for l in f:
+        if l.startswith("Running action ") or re_action.match(l):
+            return
+        yield l
+
+
+# Possible results of a test, in the order they are numbered in the
+# test_result table.
+TEST_RESULTS = ("success", "failure", "error", "skip", "xfail", "uxsuccess")
+# Results that count as the test failing
+FAILED_TEST_RESULTS = ("failure", "error", "uxsuccess")
 
-def build_status_from_logs(log, err):
-    """get status of build"""
-    # FIXME: Perhaps also extract revision here?
 
-    test_failures = 0
-    test_successes = 0
-    test_seen = 0
-    ret = BuildStatus()
+def parse_test_results(lines):
+    """Extract the results of the individual tests from subunit output.
+
+    :param lines: Iterable over the lines of a subunit (version 1) stream
+    :return: Iterator over (test name, result) tuples, with the result
+        being one of TEST_RESULTS
+    """
+    re_result = re.compile(
+        "^(success|successful|failure|fail|error|skip|xfail|uxsuccess): "
+        "(.*?)( \\[( multipart)?)?$")
+    aliases = {"successful": "success", "fail": "failure"}
+    in_details = False
+    for l in lines:
+        l = l.rstrip("\r\n")
+        if in_details:
+            if l == "]":
+                in_details = False
+            continue
+        m = re_result.match(l)
+        if m is None:
+            continue
+        (result, name, details) = m.group(1, 2, 3)
+        if details:
+            in_details = True
+        yield (name, aliases.get(result, result))
+
+
+class TestResultsDiff(object):
+    """Differences between the test results of two builds.
+
+    :ivar newly_failing: (name, old result, new result) tuples of tests
+        that failed in the new build but not in the old one
+    :ivar newly_passing: Same, for tests that failed in the old build and
+        passed in the new one
+    :ivar added: (name, result) tuples of tests only run by the new build
+    :ivar removed: (name, result) tuples of tests only run by the old build
+    """
+
+    def __init__(self, newly_failing=None, newly_passing=None, added=None,
+                 removed=None):
+        self.newly_failing = newly_failing or []
+        self.newly_passing = newly_passing or []
+        self.added = added or []
+        self.removed = removed or []
+
+    def __nonzero__(self):
+        return bool(self.newly_failing or self.newly_passing or
+                    self.added or self.removed)
+
+    def as_dict(self):
+        """Convert to a dictionary, e.g. for serializing as JSON."""
+        def changed(entries):
+            return [{"test": name, "old": old, "new": new}
+                    for (name, old, new) in entries]
+        def single(entries):
+            return [{"test": name, "result": result}
+                    for (name, result) in entries]
+        return {
+            "newly_failing": changed(self.newly_failing),
+            "newly_passing": changed(self.newly_passing),
+            "added": single(self.added),
+            "removed": single(self.removed),
+            }
+
+
+def compare_test_results(old_results, new_results):
+    """Compare the results of the tests of two builds.
+
+    Tests are matched by name, so the order in which they ran does not
+    matter. Both inputs are only iterated over once.
+
+    :param old_results: Iterable over (test name, result) tuples, or a
+        dictionary mapping test names to results, for the old build
+    :param new_results: Same, for the new build
+    :return: A `TestResultsDiff`
+    """
+    old = dict(old_results)
+    new = dict(new_results)
+    diff = TestResultsDiff()
+    for (name, new_result) in new.iteritems():
+        try:
+            old_result = old.pop(name)
+        except KeyError:
+            diff.added.append((name, new_result))
+            continue
+        old_failed = (old_result in FAILED_TEST_RESULTS)
+        new_failed = (new_result in FAILED_TEST_RESULTS)
+        if new_failed and not old_failed:
+            diff.newly_failing.append((name, old_result, new_result))
+        elif old_failed and new_result in ("success", "xfail"):
+            diff.newly_passing.append((name, old_result, new_result))
+    diff.removed.extend(old.iteritems())
+    for entries in (diff.newly_failing, diff.newly_passing, diff.added,
+                    diff.removed):
+        entries.sort()
+    return diff
+
+
+class BuildStatusParser(object):
+    """Incremental parser for the status of a build.
+
+    Lines from the log and err files can be fed in one at a time, so the
+    parser can share a single pass over the logs with other consumers.
+    """
 
-    stages = []
     re_status = re.compile("^([A-Z_]+) STATUS:(\s*\d+)$")
     re_action = re.compile("^ACTION (PASSED|FAILED):\s+test$")
 
-    for l in log:
+    def __init__(self):
+        self.test_failures = 0
+        self.test_successes = 0
+        self.test_seen = 0
+        self.stages = []
+        self.other_failures = set()
+
+    def feed_log(self, l):
         if l.startswith("No space left on device"):
-            ret.other_failures.add("disk full")
-            continue
+            self.other_failures.add("disk full")
+            return
         if "Maximum time expired in timelimit" in l: # Ugh.
-            ret.other_failures.add("timeout")
-            continue
+            self.other_failures.add("timeout")
+            return
         if "maximum runtime exceeded" in l: # Ugh.
-            ret.other_failures.add("timeout")
-            continue
+            self.other_failures.add("timeout")
+            return
         if l.startswith("PANIC:") or l.startswith("INTERNAL ERROR:"):
-            ret.other_failures.add("panic")
-            continue
+            self.other_failures.add("panic")
+            return
         if l.startswith("testsuite-failure: ") or l.startswith("testsuite-error: "):
-            test_failures += 1
-            continue
+            self.test_failures += 1
+            return
         if l.startswith("testsuite-success: "):
-            test_successes += 1
-            continue
-        m = re_status.match(l)
+            self.test_successes += 1
+            return
+        m = self.re_status.match(l)
         if m:
-            stages.append(BuildStageResult(m.group(1), int(m.group(2).strip())))
+            self.stages.append(BuildStageResult(m.group(1), int(m.group(2).strip())))
             if m.group(1) == "TEST":
-                test_seen = 1
-            continue
-        m = re_action.match(l)
-        if m and not test_seen:
+                self.test_seen = 1
+            return
+        m = self.re_action.match(l)
+        if m and not self.test_seen:
             if m.group(1) == "PASSED":
-                stages.append(BuildStageResult("TEST", 0))
+                self.stages.append(BuildStageResult("TEST", 0))
             else:
-                stages.append(BuildStageResult("TEST", 1))
-            continue
+                self.stages.append(BuildStageResult("TEST", 1))
 
-    # Scan err file for specific errors
-    for l in err:
+    def feed_err(self, l):
+        # Scan err file for specific errors
         if "No space left on device" in l:
-            ret.other_failures.add("disk full")
+            self.other_failures.add("disk full")
 
-    def map_stage(sr):
-        if sr.name != "TEST":
-            return sr
-        # TEST is special
-        if test_successes + test_failures == 0:
-            # No granular test output
-            return BuildStageResult("TEST", sr.result)
-        if sr.result == 1 and test_failures == 0:
-            ret.other_failures.add("inconsistent test result")
-            return BuildStageResult("TEST", -1)
-        return BuildStageResult("TEST", test_failures)
+    def result(self):
+        """Return the status of the build, based on the lines seen so far.
 
-    ret.stages = map(map_stage, stages)
-    return ret
+        :return: A `BuildStatus` instance
+        """
+        ret = BuildStatus(other_failures=set(self.other_failures))
+
+        def map_stage(sr):
+            if sr.name != "TEST":
+                return sr
+            # TEST is special
+            if self.test_successes + self.test_failures == 0:
+                # No granular test output
+                return BuildStageResult("TEST", sr.result)
+            if sr.result == 1 and self.test_failures == 0:
+                ret.other_failures.add("inconsistent test result")
+                return BuildStageResult("TEST", -1)
+            return BuildStageResult("TEST", self.test_failures)
+
+        ret.stages = map(map_stage, self.stages)
+        return ret
+
+
+def build_status_from_logs(log, err):
+    """get status of build"""
+    parser = BuildStatusParser()
+    for l in log:
+        parser.feed_log(l)
+    for l in err:
+        parser.feed_err(l)
+    return parser.result()
 
 
 def revision_from_log(log):
@@ -277,6 +522,46 @@ def revision_from_log(log):
     return revid
 
 
+class LogAnalysis(object):
+    """Checksum, revision, status and warning count of a build.
+
+    All of these are extracted in a single pass over the (possibly
+    compressed) log files.
+    """
+
+    def __init__(self, checksum, revision, status, err_count=0, err_size=0):
+        self.checksum = checksum
+        self.revision = revision
+        self.status = status
+        self.err_count = err_count
+        self.err_size = err_size
+
+    @classmethod
+    def from_logs(cls, log, err):
+        """Analyse a build.
+
+        :param log: Iterable over the lines of the build log
+        :param err: Iterable over the lines of the err file
+        :return: A `LogAnalysis` instance
+        """
+        sha1 = hashlib.sha1()
+        revision = None
+        parser = BuildStatusParser()
+        for l in log:
+            sha1.update(l)
+            if l.startswith("BUILD COMMIT REVISION: "):
+                revision = l.split(":", 1)[1].strip()
+            parser.feed_log(l)
+        err_count = 0
+        err_size = 0
+        for l in err:
+            err_count += 1
+            err_size += len(l)
+            parser.feed_err(l)
+        return cls(sha1.hexdigest(), revision, parser.result(), err_count,
+            err_size)
+
+
 class NoSuchBuildError(Exception):
     """The build with the specified name does not exist."""
 
@@ -295,6 +580,8 @@ class Build(object):
     """A single build of a tree on a particular host using a particular compiler.
     """
 
+    _analysis = None
+
     def __init__(self, basename, tree, host, compiler, rev=None):
         self.basename = basename
         self.tree = tree
@@ -319,10 +606,9 @@ class Build(object):
 
     def remove_logs(self):
         # In general, basename.log should *always* exist.
-        if os.path.exists(self.basename+".log"):
-            os.unlink(self.basename + ".log")
-        if os.path.exists(self.basename+".err"):
-            os.unlink(self.basename+".err")
+        for suffix in LOG_SUFFIXES:
+            if os.path.exists(self.basename+suffix):
+                os.unlink(self.basename+suffix)
 
     def remove(self):
         self.remove_logs()
@@ -340,8 +626,76 @@ class Build(object):
 
     def read_subunit(self):
         """read the test output as subunit"""
+        f = self.read_sidecar("subunit")
+        if f is not None:
+            return f
         return StringIO("".join(extract_test_output(self.read_log())))
 
+    def test_results(self):
+        """Find the results of the individual tests in this build.
+
+        :return: Dictionary mapping test names to results
+        :raise NoTestOutput: if the log does not contain test output
+        """
+        f = self.read_subunit()
+        try:
+            return dict(parse_test_results(f))
+        finally:
+            f.close()
+
+    def write_subunit(self):
+        """Extract the test output and store it next to the logs.
+
+        :raise NoTestOutput: if the log does not contain test output
+        """
+        f = self.read_log()
+        try:
+            self.write_sidecar("subunit", "".join(extract_test_output(f)))
+        finally:
+            f.close()
+
+    def find_file(self, kind):
+        """Find the file with a particular kind of output of this build.
+
+        :param kind: "log", "err", or the kind of a precomputed file
+        :return: Tuple with the path of the file and its compression
+            ("bzip2", "gzip" or None), or None if there is no such file
+        """
+        if kind in ("log", "err"):
+            candidates = [(".bz2", "bzip2"), ("", None)]
+        else:
+            candidates = [(".gz", "gzip")]
+        for (extension, compression) in candidates:
+            path = "%s.%s%s" % (self.basename, kind, extension)
+            if os.path.exists(path):
+                return (path, compression)
+        return None
+
+    def read_sidecar(self, kind):
+        """Open a file that was precomputed from the logs of this build.
+
+        :param kind: Kind of file, e.g. "subunit" or "html"
+        :return: File-like object, or None if the file does not exist
+        """
+        path = "%s.%s.gz" % (self.basename, kind)
+        if not os.path.exists(path):
+            return None
+        return gzip.open(path, 'rb')
+
+    def write_sidecar(self, kind, data):
+        """Store a file precomputed from the logs of this build.
+
+        :param kind: Kind of file, e.g. "subunit" or "html"
+        :param data: Contents of the file
+        """
+        path = "%s.%s.gz" % (self.basename, kind)
+        f = gzip.open(path + ".new", 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(path + ".new", path)
+
     def read_log(self):
         """read full log file"""
         try:
@@ -366,12 +720,27 @@ class Build(object):
             # No such file
             return StringIO()
 
+    def analysis(self):
+        """Analyse the logs of this build.
+
+        The logs are only read once; the result is cached.
+
+        :return: A `LogAnalysis` instance
+        """
+        if self._analysis is None:
+            log = self.read_log()
+            try:
+                err = self.read_err()
+                try:
+                    self._analysis = LogAnalysis.from_logs(log, err)
+                finally:
+                    err.close()
+            finally:
+                log.close()
+        return self._analysis
+
     def log_checksum(self):
-        f = self.read_log()
-        try:
-            return hashlib.sha1(f.read()).hexdigest()
-        finally:
-            f.close()
+        return self.analysis().checksum
 
     def summary(self):
         revid = self.revision_details()
@@ -383,57 +752,235 @@ class Build(object):
 
         :return: revision id
         """
-        f = self.read_log()
-        try:
-            return revision_from_log(f)
-        finally:
-            f.close()
+        revid = self.analysis().revision
+        if revid is None:
+            raise MissingRevisionInfo(self)
+        return revid
 
     def status(self):
         """get status of build
 
         :return: tuple with build status
         """
-        log = self.read_log()
+        return self.analysis().status
+
+    def err_count(self):
+        """get the number of lines in the err file"""
+        if self._analysis is not None:
+            return self._analysis.err_count
+        f = self.read_err()
         try:
-            err = self.read_err()
-            try:
-                return build_status_from_logs(log, err)
-            finally:
-                err.close()
+            return sum(1 for l in f)
         finally:
-            log.close()
+            f.close()
 
-    def err_count(self):
-        """get status of build"""
-        file = self.read_err()
-        return len(file.readlines())
 
+def analyse_build(build):
+    """Analyse the logs of a build.
 
-class UploadBuildResultStore(object):
+    This is a separate function so it can be run in a worker process.
+
+    :param build: A `Build`
+    :return: The same build, with its analysis cached
+    """
+    build.analysis()
+    return build
+
+
+class UploadIndex(object):
+    """Persistent record of the files in the upload directory that have
+    already been dealt with.
+
+    Files are identified by name, mtime and size, so a log that is
+    re-uploaded under the same name is picked up again.
+    """
 
     def __init__(self, path):
+        """Open an upload index.
+
+        :param path: Path to the index file; it is created on first save
+        """
+        self.path = path
+        self._entries = {}
+        try:
+            f = open(path, 'r')
+        except IOError:
+            return
+        try:
+            for l in f:
+                try:
+                    (name, mtime, size) = l.split()
+                except ValueError:
+                    continue
+                self._entries[name] = (int(mtime), int(size))
+        finally:
+            f.close()
+
+    def _key(self, st):
+        return (int(st.st_mtime), st.st_size)
+
+    def is_seen(self, name, st):
+        """Check whether a file has been seen before.
+
+        :param name: File name
+        :param st: Result of os.stat() for the file
+        """
+        return self._entries.get(name) == self._key(st)
+
+    def mark_seen(self, name, st):
+        """Record that a file has been dealt with.
+
+        :param name: File name
+        :param st: Result of os.stat() for the file
+        """
+        self._entries[name] = self._key(st)
+
+    def save(self, names=None):
+        """Write the index to disk.
+
+        :param names: Names of the files that still exist; entries for
+            other files are dropped.
+        """
+        if names is not None:
+            names = set(names)
+            for name in self._entries.keys():
+                if name not in names:
+                    del self._entries[name]
+        f = open(self.path + ".new", 'w')
+        try:
+            for name, (mtime, size) in sorted(self._entries.iteritems()):
+                f.write("%s %d %d\n" % (name, mtime, size))
+        finally:
+            f.close()
+        os.rename(self.path + ".new", self.path)
+
+
+class UploadWatcher(object):
+    """Waits for new files to appear in the upload directory.
+
+    This uses inotify if pyinotify is available, and falls back to polling
+    otherwise.
+    """
+
+    def __init__(self, path, poll_interval=60, settle_time=5):
+        """Create a new watcher.
+
+        :param path: Directory to watch
+        :param poll_interval: Seconds between polls if inotify is unavailable
+        :param settle_time: Seconds without new events before waking up, so
+            that the .log and .err files of a build are picked up together.
+        """
+        self.path = path
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        try:
+            import pyinotify
+        except ImportError:
+            self._notifier = None
+        else:
+            wm = pyinotify.WatchManager()
+            wm.add_watch(path, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+            self._notifier = pyinotify.Notifier(wm,
+                default_proc_fun=lambda event: None)
+
+    def _check(self, timeout):
+        if not self._notifier.check_events(timeout * 1000):
+            return False
+        self._notifier.read_events()
+        self._notifier.process_events()
+        return True
+
+    def wait(self):
+        """Block until there are (probably) new files in the directory."""
+        if self._notifier is None:
+            time.sleep(self.poll_interval)
+            return
+        while not self._check(self.poll_interval):
+            pass
+        while self._check(self.settle_time):
+            pass
+
+    def close(self):
+        if self._notifier is not None:
+            self._notifier.stop()
+
+
+class UploadBuildResultStore(object):
+
+    def __init__(self, path, index_path=None):
         """Open the database.
 
         :param path: Build result base directory
+        :param index_path: Optional path to an `UploadIndex`
         """
         self.path = path
+        if index_path is not None:
+            self.index = UploadIndex(index_path)
+        else:
+            self.index = None
+        self._listing = (None, [])
+        self._stats = {}
 
-    def get_all_builds(self):
-        for name in os.listdir(self.path):
+    def _list(self):
+        """List the upload directory.
+
+        The listing is only refreshed when the directory has changed.
+        """
+        mtime = os.stat(self.path).st_mtime
+        if self._listing[0] != mtime:
+            self._listing = (mtime, os.listdir(self.path))
+        return self._listing[1]
+
+    def get_all_builds(self, unseen_only=False):
+        """Find all builds in the upload directory.
+
+        :param unseen_only: Skip builds that have been marked as seen
+            in the index and have not changed since.
+        """
+        for name in self._list():
             try:
                 (build, tree, host, compiler, extension) = name.split(".")
             except ValueError:
                 continue
             if build != "build" or extension != "log":
                 continue
-            yield self.get_build(tree, host, compiler)
+            if self.index is not None:
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    # Removed in the meantime
+                    continue
+                if unseen_only and self.index.is_seen(name, st):
+                    continue
+                self._stats[name] = st
+            try:
+                yield self.get_build(tree, host, compiler)
+            except NoSuchBuildError:
+                continue
+
+    def mark_seen(self, build):
+        """Record in the index that a build has been dealt with.
+
+        :param build: A build returned by `get_all_builds`
+        """
+        if self.index is None:
+            return
+        name = os.path.basename(build.basename) + ".log"
+        try:
+            st = self._stats.pop(name)
+        except KeyError:
+            return
+        self.index.mark_seen(name, st)
+
+    def save_index(self):
+        if self.index is not None:
+            self.index.save(os.listdir(self.path))
 
     def build_fname(self, tree, host, compiler):
         return os.path.join(self.path, "build.%s.%s.%s" % (tree, host, compiler))
 
     def has_host(self, host):
-        for name in os.listdir(self.path):
+        for name in self._list():
             try:
                 if name.split(".")[2] == host:
                     return True
@@ -464,10 +1011,18 @@ class StormBuild(Build):
     host_id = Int()
     tree_id = Int()
     compiler_id = Int()
+    err_lines = Int(name="err_count")
+    err_size = Int()
 
     def status(self):
         return BuildStatus.__deserialize__(self.status_str)
 
+    def err_count(self):
+        if self.err_lines is None:
+            # Imported before the warning count was stored
+            return super(StormBuild, self).err_count()
+        return self.err_lines
+
     def revision_details(self):
         return self.revision
 
@@ -502,16 +1057,15 @@ class BuildResultStore(object):
             return False
 
     def get_build(self, tree, host, compiler, revision=None, checksum=None):
-        from buildfarm.sqldb import Cast
         expr = [
-            Cast(StormBuild.tree, "TEXT") == Cast(tree, "TEXT"),
-            Cast(StormBuild.host, "TEXT") == Cast(host, "TEXT"),
-            Cast(StormBuild.compiler, "TEXT") == Cast(compiler, "TEXT"),
+            StormBuild.tree == tree,
+            StormBuild.host == host,
+            StormBuild.compiler == compiler,
             ]
         if revision is not None:
-            expr.append(Cast(StormBuild.revision, "TEXT") == Cast(revision, "TEXT"))
+            expr.append(StormBuild.revision == revision)
         if checksum is not None:
-            expr.append(Cast(StormBuild.checksum, "TEXT") == Cast(checksum, "TEXT"))
+            expr.append(StormBuild.checksum == checksum)
         result = self.store.find(StormBuild, *expr).order_by(Desc(StormBuild.upload_time))
         ret = result.first()
         if ret is None:
@@ -542,12 +1096,18 @@ class BuildResultStore(object):
             StormBuild.tree == tree,
             StormBuild.host == host,
             StormBuild.compiler == compiler)
-        return result.order_by(Desc(StormBuild.upload_time))
+        return result.order_by(Desc(StormBuild.upload_time), StormBuild.id)
 
     def upload_build(self, build):
-        from buildfarm.sqldb import Cast, StormHost
+        from buildfarm.sqldb import (
+            StormHost,
+            insert_build_stages,
+            insert_test_results,
+            update_test_flakiness,
+            )
+        analysis = build.analysis()
         try:
-            existing_build = self.get_by_checksum(build.log_checksum())
+            existing_build = self.get_by_checksum(analysis.checksum)
         except NoSuchBuildError:
             pass
         else:
@@ -559,43 +1119,146 @@ class BuildResultStore(object):
         rev = build.revision_details()
 
         new_basename = self.build_fname(build.tree, build.host, build.compiler, rev)
-        for name in os.listdir(self.path):
-            p = os.path.join(self.path, name)
-            if p.startswith(new_basename+"."):
-                os.remove(p)
+        for suffix in LOG_SUFFIXES:
+            if os.path.exists(new_basename+suffix):
+                os.remove(new_basename+suffix)
         os.link(build.basename+".log", new_basename+".log")
         if os.path.exists(build.basename+".err"):
             os.link(build.basename+".err", new_basename+".err")
         new_build = StormBuild(new_basename, build.tree, build.host, build.compiler, rev)
-        new_build.checksum = build.log_checksum()
+        new_build.checksum = analysis.checksum
         new_build.upload_time = build.upload_time
-        new_build.status_str = build.status().__serialize__()
+        new_build.status_str = analysis.status.__serialize__()
+        new_build.err_lines = analysis.err_count
+        new_build.err_size = analysis.err_size
         new_build.basename = new_basename
         host = self.store.find(StormHost,
-            Cast(StormHost.name, "TEXT") == Cast(build.host, "TEXT")).one()
+            StormHost.name == build.host).one()
         assert host is not None, "Unable to find host %r" % build.host
         new_build.host_id = host.id
         self.store.add(new_build)
+        self.store.flush()
+        insert_build_stages(self.store, new_build.id, analysis.status)
+        try:
+            test_results = new_build.test_results()
+        except NoTestOutput:
+            pass
+        else:
+            insert_test_results(self.store, new_build.id, test_results)
+            update_test_flakiness(self.store, new_build)
         return new_build
 
+    def get_builds_with_failed_stage(self, stage, tree=None):
+        """Find the builds in which a particular stage failed.
+
+        :param stage: Name of the stage, e.g. "TEST"
+        :param tree: Optional tree to restrict the search to
+        """
+        from buildfarm.sqldb import StormBuildStage
+        expr = [
+            StormBuildStage.build_id == StormBuild.id,
+            StormBuildStage.name == stage,
+            StormBuildStage.result != 0,
+            ]
+        if tree is not None:
+            expr.append(StormBuild.tree == tree)
+        result = self.store.find(StormBuild, *expr).config(distinct=True)
+        return result.order_by(Desc(StormBuild.upload_time))
+
+    def get_test_history(self, test, tree=None, host=None, compiler=None):
+        """Find the results of a test across builds.
+
+        :param test: Name of the test
+        :param tree: Optional tree to restrict the search to
+        :param host: Optional host to restrict the search to
+        :param compiler: Optional compiler to restrict the search to
+        :return: Result set with (build, result) tuples, most recent first
+        """
+        from buildfarm.sqldb import StormTest, StormTestResult
+        expr = [
+            StormTest.name == test,
+            StormTestResult.test_id == StormTest.id,
+            StormBuild.id == StormTestResult.build_id,
+            ]
+        if tree is not None:
+            expr.append(StormBuild.tree == tree)
+        if host is not None:
+            expr.append(StormBuild.host == host)
+        if compiler is not None:
+            expr.append(StormBuild.compiler == compiler)
+        result = self.store.find((StormBuild, StormTestResult.result), *expr)
+        return result.order_by(Desc(StormBuild.upload_time), Desc(StormBuild.id))
+
+    def get_test_results(self, build):
+        """Retrieve the stored results of the individual tests of a build.
+
+        :param build: A `StormBuild`
+        :return: Dictionary mapping test names to results
+        """
+        from buildfarm.sqldb import StormTest, StormTestResult
+        return dict(self.store.find((StormTest.name, StormTestResult.result),
+            StormTestResult.build_id == build.id,
+            StormTest.id == StormTestResult.test_id))
+
+    def find_test_results(self, build):
+        """Find the results of the individual tests of a build.
+
+        Stored results are used if there are any. For other builds, such as
+        builds that were imported before test results were stored or
+        builds that have not been imported at all, the test output is
+        parsed, which uses the prerendered subunit output if there is one.
+
+        :param build: A `Build`
+        :return: Dictionary mapping test names to results; empty if the
+            build did not run any tests
+        """
+        if isinstance(build, StormBuild):
+            results = self.get_test_results(build)
+            if results:
+                return results
+        try:
+            return build.test_results()
+        except NoTestOutput:
+            return {}
+
+    def get_flaky_tests(self, tree=None, host=None, compiler=None):
+        """Find the tests that are currently considered flaky.
+
+        :param tree: Optional tree to restrict the search to
+        :param host: Optional host to restrict the search to
+        :param compiler: Optional compiler to restrict the search to
+        :return: List of `TestFlakiness` objects, flakiest first
+        """
+        from buildfarm.sqldb import StormTestFlakiness
+        # Tests that have not failed within the window can't be flaky
+        expr = [StormTestFlakiness.history != 0]
+        if tree is not None:
+            expr.append(StormTestFlakiness.tree == tree)
+        if host is not None:
+            expr.append(StormTestFlakiness.host == host)
+        if compiler is not None:
+            expr.append(StormTestFlakiness.compiler == compiler)
+        ret = [f for f in self.store.find(StormTestFlakiness, *expr)
+               if f.is_flaky()]
+        ret.sort(key=lambda f: (-f.score, -f.flips))
+        return ret
+
     def get_by_checksum(self, checksum):
-        from buildfarm.sqldb import Cast
         result = self.store.find(StormBuild,
-            Cast(StormBuild.checksum, "TEXT") == Cast(checksum, "TEXT")).order_by(Desc(StormBuild.upload_time))
+            StormBuild.checksum == checksum).order_by(Desc(StormBuild.upload_time))
         ret = result.first()
         if ret is None:
             raise NoSuchBuildError(None, None, None, None)
         return ret
 
     def get_previous_build(self, tree, host, compiler, revision):
-        from buildfarm.sqldb import Cast
         cur_build = self.get_build(tree, host, compiler, revision)
 
         result = self.store.find(StormBuild,
-            Cast(StormBuild.tree, "TEXT") == Cast(tree, "TEXT"),
-            Cast(StormBuild.host, "TEXT") == Cast(host, "TEXT"),
-            Cast(StormBuild.compiler, "TEXT") == Cast(compiler, "TEXT"),
-            Cast(StormBuild.revision, "TEXT") != Cast(revision, "TEXT"),
+            StormBuild.tree == tree,
+            StormBuild.host == host,
+            StormBuild.compiler == compiler,
+            StormBuild.revision != revision,
             StormBuild.id < cur_build.id)
         result = result.order_by(Desc(StormBuild.id))
         prev_build = result.first()
@@ -618,21 +1281,96 @@ class BuildResultStore(object):
 class BuildDiff(object):
     """Represents the difference between two builds."""
 
-    def __init__(self, tree, old, new):
+    def __init__(self, tree, old, new, old_test_results=None,
+                 new_test_results=None):
         self.tree = tree
         self.old = old
         self.new = new
         self.new_rev = new.revision_details()
         self.new_status = new.status()
+        self.new_test_results = new_test_results
 
         self.old_rev = old.revision_details()
         self.old_status = old.status()
+        self.old_test_results = old_test_results
+
+    def test_results_diff(self):
+        """Compare the test results of old and new.
+
+        :return: A `TestResultsDiff`, or None if the test results are unknown
+        """
+        if self.new_test_results is None:
+            return None
+        return compare_test_results(self.old_test_results or {},
+            self.new_test_results)
+
+    def regressed_tests(self, flaky_tests=None):
+        """Find the tests that fail in new, but did not fail in old.
+
+        Tests that did not run in old only count if old ran any tests at
+        all; otherwise every failing test would look like a regression.
+
+        :param flaky_tests: Optional names of tests to leave out
+        :return: Sorted list of (name, old result, new result) tuples, with
+            None as the old result of tests that did not run in old. Empty
+            if the test results are unknown.
+        """
+        diff = self.test_results_diff()
+        if diff is None or not self.old_test_results:
+            return []
+        ret = diff.newly_failing + [(name, None, result)
+            for (name, result) in diff.added if result in FAILED_TEST_RESULTS]
+        if flaky_tests:
+            ret = [t for t in ret if t[0] not in flaky_tests]
+        ret.sort()
+        return ret
+
+    def new_test_failures(self):
+        """Find the tests that fail in new, but did not fail in old.
+
+        :return: Set of test names; empty if the test results are unknown
+        """
+        return set([name for (name, old, new) in self.regressed_tests()])
+
+    def is_regression(self, flaky_tests=None):
+        """Is there a regression in new build since old build?
 
-    def is_regression(self):
-        """Is there a regression in new build since old build?"""
-        return self.new_status.regressed_since(self.old_status)
+        If the test results of both builds are known, any test that started
+        failing is a regression, even if the number of failures did not
+        go up because other tests were fixed.
 
-    def revisions(self):
-        """Returns the revisions introduced since old in new."""
+        :param flaky_tests: Optional names of tests that are known to be
+            flaky. If the only change is that some of these started
+            failing, the new build is not considered a regression.
+        """
+        if not self.new_status.comparable_to(self.old_status):
+            return False
+        if self.regressed_tests(flaky_tests):
+            return True
+        if not self.new_status.regressed_since(self.old_status):
+            return False
+        if not flaky_tests:
+            return True
+        failures = self.new_test_failures()
+        if not failures:
+            return True
+        # Only flaky tests started failing; see whether anything besides
+        # the test stage got worse.
+        def without_tests(status):
+            return BuildStatus(
+                [(s.name, s.result) for s in status.stages if s.name != "TEST"],
+                status.other_failures)
+        return without_tests(self.new_status).regressed_since(
+            without_tests(self.old_status))
+
+    def revisions(self, limit=100):
+        """Returns the revisions introduced since old in new.
+
+        :param limit: Maximum number of revisions to return
+        """
         branch = self.tree.get_branch()
-        return branch.log(from_rev=self.new.revision, exclude_revs=set([self.old.revision]))
+        try:
+            return list(branch.log(from_rev=self.new.revision,
+                exclude_revs=set([self.old.revision]), limit=limit))
+        finally:
+            branch.close()
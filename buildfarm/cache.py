@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# Simple on-disk cache
+# Copyright (C) 2010 Jelmer Vernooij <jelmer@samba.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import errno
+import hashlib
+import os
+import tempfile
+
+
+# Number of writes after which the size of a cache is recomputed from disk,
+# to pick up changes made by other processes.
+SWEEP_INTERVAL = 100
+
+# When a cache is too large, it is shrunk to this fraction of its maximum
+# size, so that it is not swept again on the next write.
+EVICT_FRACTION = 0.9
+
+
+class FileCache(object):
+    """Cache of strings on disk, with least recently used eviction.
+
+    Every entry is stored in a file named after the SHA1 of its key. Reading
+    an entry updates the mtime of its file, so the files with the oldest
+    mtime are the first to go when the cache grows too large.
+
+    The total size of the entries is kept track of in memory, so that the
+    directory only has to be scanned when the cache is full, and every
+    SWEEP_INTERVAL writes.
+    """
+
+    def __init__(self, path, max_size):
+        """Open a cache.
+
+        :param path: Directory to store the entries in; it is created when
+            the first entry is added
+        :param max_size: Maximum total size of the entries, in bytes
+        """
+        self.path = path
+        self.max_size = max_size
+        self._size = None
+        self._writes = 0
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        """Look up an entry.
+
+        :param key: Key of the entry
+        :return: The cached value, or None if there is no such entry
+        """
+        path = self._entry_path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            value = f.read()
+        finally:
+            f.close()
+        try:
+            os.utime(path, None)
+        except OSError:
+            # Evicted in the meantime
+            pass
+        return value
+
+    def set(self, key, value):
+        """Add or replace an entry.
+
+        :param key: Key of the entry
+        :param value: Value to store; values larger than the cache itself
+            are not stored
+        """
+        if len(value) > self.max_size:
+            return
+        try:
+            os.makedirs(self.path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        path = self._entry_path(key)
+        try:
+            old_size = os.stat(path).st_size
+        except OSError:
+            old_size = 0
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(value)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+        self._writes += 1
+        if self._size is None or self._writes >= SWEEP_INTERVAL:
+            self._sweep()
+        else:
+            self._size += len(value) - old_size
+            if self._size > self.max_size:
+                self._sweep()
+
+    def _sweep(self):
+        """Determine the size of the cache, and remove the least recently
+        used entries if it is too large."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        if total > self.max_size:
+            entries.sort(reverse=True)
+            while total > self.max_size * EVICT_FRACTION:
+                (mtime, size, name) = entries.pop()
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+                total -= size
+        self._size = total
+        self._writes = 0
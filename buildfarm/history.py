@@ -20,24 +20,117 @@
 #   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 from cStringIO import StringIO
+import errno
+import heapq
+import os
+import re
+
+try:
+    from pysqlite2 import dbapi2 as sqlite3
+except ImportError:
+    import sqlite3
 
 from dulwich.objects import Tree
 from dulwich.patch import write_tree_diff
 from dulwich.repo import Repo
 
 
+re_author = re.compile("^(.*) <(.*)>$")
+
+
+def author_email(author):
+    """Extract the email address from an author string.
+
+    :param author: Author, e.g. "Jelmer Vernooij <jelmer@samba.org>"
+    :return: Email address, or None if there is none
+    """
+    m = re_author.match(author)
+    if m is None:
+        return None
+    return m.group(2)
+
+
+def summarize_changes(store, commit):
+    """Summarize the paths changed by a commit, compared to its first parent.
+
+    :param store: Object store to read the trees from
+    :param commit: Commit object
+    :return: Tuple with sets of added, modified and removed paths
+    """
+    if len(commit.parents) == 0:
+        parent_tree = None
+    else:
+        parent_tree = store[commit.parents[0]].tree
+    added = set()
+    modified = set()
+    removed = set()
+    for ((oldpath, newpath), (oldmode, newmode), (oldsha, newsha)) in store.tree_changes(parent_tree, commit.tree):
+        if oldpath is None:
+            added.add(newpath)
+        elif newpath is None:
+            removed.add(oldpath)
+        else:
+            modified.add(newpath)
+    return (added, modified, removed)
+
+
+def _join_paths(paths):
+    return "\0".join(sorted(paths))
+
+
 class Branch(object):
     """A version control branch."""
 
-    def log(self, limit=None):
+    def log(self, from_rev=None, exclude_revs=None, limit=None):
+        """Walk the history, newest revisions first.
+
+        :param from_rev: Revision to start at; defaults to the branch head
+        :param exclude_revs: Revisions whose ancestors (including
+            themselves) are left out
+        :param limit: Maximum number of revisions to return
+        :return: Iterator over revisions
+        """
         raise NotImplementedError(self.log)
 
+    def recent_authors(self, horizon):
+        """Find the authors of the most recent revisions.
+
+        :param horizon: Number of revisions to look at
+        :return: Set of author strings
+        """
+        return set([entry.author for entry in self.log(limit=horizon)])
+
+    def recent_log(self, horizon, offset=0, limit=None, author=None):
+        """Page through the most recent revisions.
+
+        :param horizon: Number of revisions to look at
+        :param offset: Number of (matching) revisions to skip
+        :param limit: Maximum number of revisions to return
+        :param author: Only return revisions by the author with this
+            email address
+        :return: List of revisions, newest first
+        """
+        ret = [entry for entry in self.log(limit=horizon)
+               if author is None or author_email(entry.author) == author]
+        if limit is None:
+            return ret[offset:]
+        return ret[offset:offset+limit]
+
+    def get_revision(self, revision):
+        raise NotImplementedError(self.get_revision)
+
     def diff(self, revision):
         raise NotImplementedError(self.diff)
 
+    def write_diff(self, f, revision):
+        raise NotImplementedError(self.write_diff)
+
     def changes_summary(self, revision):
         raise NotImplementedError(self.changes_summary)
 
+    def close(self):
+        """Release the resources held by this branch."""
+
 
 class Revision(object):
 
@@ -49,19 +142,267 @@ class Revision(object):
         self.message = message
 
 
+class CommitIndex(object):
+    """Persistent index of the commits on a branch.
+
+    The index contains the metadata of all commits reachable from the head
+    of the branch, numbered in the order they appear in the log: commits
+    that were added to the branch later come first, and commits added
+    at the same time are ordered by commit time, together with the
+    summary of the paths they changed.
+
+    The index is only written to by `update`, which is run from
+    import-and-analyse.py; the web frontend merely reads it.
+    """
+
+    def __init__(self, path):
+        """Open an index.
+
+        :param path: Path to the index database; it is created if it does
+            not exist yet
+        """
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.db = sqlite3.connect(path, timeout=10, isolation_level=None)
+        self.db.text_factory = str
+        self.db.executescript("""
+CREATE TABLE IF NOT EXISTS revision (
+    position integer primary key,
+    revision text not null unique,
+    parents text not null,
+    commit_time int not null,
+    author_time int not null,
+    author text not null,
+    author_email text,
+    committer text not null,
+    message text not null,
+    added text,
+    modified text,
+    removed text
+);
+CREATE INDEX IF NOT EXISTS revision_author_email ON revision (author_email);
+CREATE TABLE IF NOT EXISTS head (revision text not null);
+""")
+
+    def close(self):
+        self.db.close()
+
+    def head(self):
+        """Return the head the index was last updated to, or None."""
+        row = self.db.execute("SELECT revision FROM head").fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def update(self, repo, head):
+        """Bring the index up to date with a new head.
+
+        Only the commits that are not in the index yet are read from the
+        repository. If the old head is not an ancestor of the new one, the
+        index is rebuilt. This can take a while for a large repository,
+        so it should not be done while serving a request.
+
+        :param repo: Repository to read commits from
+        :param head: Commit id of the new head
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            old_head = self.head()
+            if old_head != head:
+                commits = self._find_new_commits(repo, head, old_head)
+                if commits is None:
+                    self.db.execute("DELETE FROM revision")
+                    commits = self._find_new_commits(repo, head, None)
+                (position, ) = self.db.execute(
+                    "SELECT MAX(position) FROM revision").fetchone()
+                if position is None:
+                    position = 0
+                for commit in reversed(commits):
+                    position += 1
+                    (added, modified, removed) = summarize_changes(
+                        repo.object_store, commit)
+                    self.db.execute("""
+INSERT INTO revision (position, revision, parents, commit_time, author_time,
+    author, author_email, committer, message, added, modified, removed)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (position, commit.id,
+                        " ".join(commit.parents), commit.commit_time,
+                        commit.author_time, commit.author,
+                        author_email(commit.author), commit.committer,
+                        commit.message, _join_paths(added),
+                        _join_paths(modified), _join_paths(removed)))
+                self.db.execute("DELETE FROM head")
+                self.db.execute("INSERT INTO head (revision) VALUES (?)",
+                    (head, ))
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def _find_new_commits(self, repo, head, old_head):
+        """Find the commits reachable from head that are not indexed yet.
+
+        :return: List of commits, newest first, or None if old_head is not
+            an ancestor of head
+        """
+        ret = []
+        seen = set([head])
+        commit = repo[head]
+        pending = [(-commit.commit_time, commit.id, commit)]
+        found_old_head = (old_head is None)
+        while pending:
+            (_, commit_id, commit) = heapq.heappop(pending)
+            if commit_id == old_head:
+                found_old_head = True
+                continue
+            if old_head is not None and commit_id in self:
+                continue
+            ret.append(commit)
+            for p in commit.parents:
+                if p not in seen:
+                    seen.add(p)
+                    parent = repo[p]
+                    heapq.heappush(pending,
+                        (-parent.commit_time, parent.id, parent))
+        if not found_old_head:
+            return None
+        return ret
+
+    def __contains__(self, revision):
+        return self.db.execute("SELECT 1 FROM revision WHERE revision = ?",
+            (revision, )).fetchone() is not None
+
+    def _revision_from_row(self, row):
+        (revision, commit_time, committer, author, message) = row
+        return Revision(revision, commit_time, committer=committer,
+            author=author, message=message)
+
+    def lookup(self, revision):
+        """Look up a commit.
+
+        :param revision: Commit id
+        :return: Tuple with Revision and list of parent ids, or None if the
+            commit is not in the index
+        """
+        row = self.db.execute("""
+SELECT revision, commit_time, committer, author, message, parents
+FROM revision WHERE revision = ?""", (revision, )).fetchone()
+        if row is None:
+            return None
+        return (self._revision_from_row(row[:-1]), row[-1].split())
+
+    def _horizon_position(self, horizon):
+        (position, ) = self.db.execute(
+            "SELECT MAX(position) FROM revision").fetchone()
+        if position is None:
+            return 0
+        return position - horizon
+
+    def recent_authors(self, horizon):
+        """Find the authors of the most recent commits.
+
+        :param horizon: Number of commits to look at
+        :return: Set of author strings
+        """
+        return set([author for (author, ) in self.db.execute(
+            "SELECT DISTINCT author FROM revision WHERE position > ?",
+            (self._horizon_position(horizon), ))])
+
+    def recent_log(self, horizon, offset=0, limit=None, author=None):
+        """Page through the most recent commits.
+
+        :param horizon: Number of commits to look at
+        :param offset: Number of (matching) commits to skip
+        :param limit: Maximum number of commits to return
+        :param author: Only return commits by the author with this email
+            address
+        :return: List of revisions, newest first
+        """
+        query = """
+SELECT revision, commit_time, committer, author, message
+FROM revision WHERE position > ?"""
+        args = [self._horizon_position(horizon)]
+        if author is not None:
+            query += " AND author_email = ?"
+            args.append(author)
+        query += " ORDER BY position DESC LIMIT ? OFFSET ?"
+        if limit is None:
+            limit = -1
+        args.extend([limit, offset])
+        return [self._revision_from_row(row)
+                for row in self.db.execute(query, args)]
+
+    def changes_summary(self, revision):
+        """Return the summary of the changes in a commit.
+
+        :param revision: Commit id
+        :return: Tuple with sets of added, modified and removed paths, or
+            None if the commit is not in the index
+        """
+        row = self.db.execute(
+            "SELECT added, modified, removed FROM revision WHERE revision = ?",
+            (revision, )).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return tuple([set(filter(None, paths.split("\0"))) for paths in row])
+
+
 class GitBranch(Branch):
 
-    def __init__(self, path, branch="master"):
+    def __init__(self, path, branch="master", index_path=None):
         self.repo = Repo(path)
         self.store = self.repo.object_store
         self.branch = branch
-
-    def _changes_for(self, commit):
-        if len(commit.parents) == 0:
-            parent_tree = Tree().id
+        self.index_path = index_path
+        if index_path is not None and os.path.exists(index_path):
+            self.index = CommitIndex(index_path)
         else:
-            parent_tree = self.store[commit.parents[0]].tree
-        return self.store.tree_changes(parent_tree, commit.tree)
+            self.index = None
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    def _head(self):
+        try:
+            return self.repo.refs["refs/heads/%s" % self.branch]
+        except KeyError:
+            return None
+
+    def update_index(self):
+        """Bring the history index up to date with the branch head.
+
+        The index is created if it does not exist yet.
+        """
+        if self.index_path is None:
+            return
+        head = self._head()
+        if head is None:
+            return
+        if self.index is None:
+            self.index = CommitIndex(self.index_path)
+        if head != self.index.head():
+            self.index.update(self.repo, head)
+
+    def _index_is_current(self):
+        """Check whether the index covers all commits on the branch.
+
+        The metadata of a commit never changes, so a stale index can still
+        be used to look up commits, but not to list the most recent ones.
+        """
+        return (self.index is not None and
+                self.index.head() == self._head())
+
+    def _lookup(self, commit_id):
+        if self.index is not None:
+            ret = self.index.lookup(commit_id)
+            if ret is not None:
+                return ret
+        commit = self.repo[commit_id]
+        return (self._revision_from_commit(commit), commit.parents)
 
     def _revision_from_commit(self, commit):
         return Revision(commit.id, commit.commit_time,
@@ -69,6 +410,10 @@ class GitBranch(Branch):
             message=commit.message)
 
     def log(self, from_rev=None, exclude_revs=None, limit=None):
+        # This walks the history like "git rev-list from_rev ^exclude_revs":
+        # commits are visited newest first, ancestors of excluded commits
+        # are marked as excluded as well, and the walk ends as soon as only
+        # excluded commits are left to visit.
         if exclude_revs is None:
             exclude_revs = set()
         if from_rev is None:
@@ -77,43 +422,92 @@ class GitBranch(Branch):
             except KeyError:
                 return
             from_rev = commit.id
-        done = set()
-        pending_commits = [from_rev]
-        while pending_commits != []:
-             commit_id = pending_commits.pop(0)
-             commit = self.repo[commit_id]
-             yield self._revision_from_commit(commit)
-             done.add(commit.id)
-             if len(done) >= limit:
-                 return
-             exclude_revs.add(commit.id)
-             # FIXME: Add sorted by commit_time
-             for p in commit.parents:
-                 if p in exclude_revs:
-                     continue
-                 pending_commits.append(p)
-                 exclude_revs.add(p)
+        excluded = set(exclude_revs)
+        entries = {from_rev: self._lookup(from_rev)}
+        for commit_id in excluded:
+            if commit_id in entries:
+                continue
+            try:
+                entries[commit_id] = self._lookup(commit_id)
+            except KeyError:
+                # Unknown revisions can't have any ancestors on this branch
+                continue
+        pending = [(-revision.date, commit_id)
+                   for (commit_id, (revision, parents)) in entries.items()]
+        heapq.heapify(pending)
+        queued = set(entries)
+        pending_included = len(queued - excluded)
+        count = 0
+        while pending_included > 0:
+            (_, commit_id) = heapq.heappop(pending)
+            queued.remove(commit_id)
+            (revision, parents) = entries[commit_id]
+            is_excluded = (commit_id in excluded)
+            if not is_excluded:
+                pending_included -= 1
+                yield revision
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            for p in parents:
+                if is_excluded and p not in excluded:
+                    excluded.add(p)
+                    if p in queued:
+                        pending_included -= 1
+                if p in entries:
+                    continue
+                try:
+                    entries[p] = self._lookup(p)
+                except KeyError:
+                    # Missing from a shallow clone
+                    continue
+                heapq.heappush(pending, (-entries[p][0].date, p))
+                queued.add(p)
+                if p not in excluded:
+                    pending_included += 1
+
+    def recent_authors(self, horizon):
+        if not self._index_is_current():
+            return super(GitBranch, self).recent_authors(horizon)
+        return self.index.recent_authors(horizon)
+
+    def recent_log(self, horizon, offset=0, limit=None, author=None):
+        if not self._index_is_current():
+            return super(GitBranch, self).recent_log(horizon, offset, limit,
+                author)
+        return self.index.recent_log(horizon, offset, limit, author)
 
     def changes_summary(self, revision):
-        commit = self.repo[revision]
-        added = set()
-        modified = set()
-        removed = set()
-        for ((oldpath, newpath), (oldmode, newmode), (oldsha, newsha)) in self._changes_for(commit):
-            if oldpath is None:
-                added.add(newpath)
-            elif newpath is None:
-                removed.add(oldpath)
-            else:
-                modified.add(newpath)
-        return (added, modified, removed)
+        if self.index is not None:
+            ret = self.index.changes_summary(revision)
+            if ret is not None:
+                return ret
+        return summarize_changes(self.store, self.repo[revision])
 
-    def diff(self, revision):
+    def get_revision(self, revision):
+        """Look up a revision.
+
+        :param revision: Commit id
+        :return: Revision object
+        """
+        return self._lookup(revision)[0]
+
+    def write_diff(self, f, revision):
+        """Write the diff of a revision against its first parent.
+
+        :param f: File-like object to write to
+        :param revision: Commit id
+        :return: Revision object
+        """
         commit = self.repo[revision]
-        f = StringIO()
         if len(commit.parents) == 0:
             parent_tree = Tree().id
         else:
             parent_tree = self.store[commit.parents[0]].tree
         write_tree_diff(f, self.store, parent_tree, commit.tree)
-        return (self._revision_from_commit(commit), f.getvalue())
+        return self._revision_from_commit(commit)
+
+    def diff(self, revision):
+        f = StringIO()
+        entry = self.write_diff(f, revision)
+        return (entry, f.getvalue())
@@ -92,6 +92,18 @@ class HostDatabase(object):
         """Retrieve an iterable over all hosts."""
         raise NotImplementedError(self.hosts)
 
+    def platform_map(self):
+        """Retrieve the platforms of all hosts.
+
+        :return: Dictionary mapping host names to platforms
+        """
+        return dict([(host.name, host.platform) for host in self.hosts()])
+
+    def serial(self):
+        """Retrieve a number that changes whenever a host is added, removed,
+        renamed or moved to another platform."""
+        raise NotImplementedError(self.serial)
+
     def dead_hosts(self, age):
         dead_time = time.time() - age
         cursor = self.store.execute("SELECT host.name AS host, host.owner AS owner, host.owner_email AS owner_email, MAX(age) AS last_update FROM host LEFT JOIN build ON ( host.name == build.host) WHERE ifnull(last_dead_mail, 0) < %d AND ifnull(join_time, 0) < %d GROUP BY host.name having ifnull(MAX(age),0) < %d" % (dead_time, dead_time, dead_time))
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# Queue of regression mails
+# Copyright (C) 2010 Jelmer Vernooij <jelmer@samba.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Outbox for regression mails.
+
+Importing builds only queues a notice for every recipient of a regression
+mail. The queue is drained separately, over a single SMTP connection.
+Notices for the same recipient about the same tree and new revision are
+sent as one digest, no matter how many hosts broke or which revision they
+built before.
+"""
+
+from email.mime.text import MIMEText
+import smtplib
+import socket
+import time
+
+MAIL_FROM = "\"Build Farm\" <build@samba.org>"
+
+# Delay before the first retry of a mail that could not be sent, in seconds.
+# The delay doubles with every failed attempt, up to MAX_RETRY_DELAY.
+RETRY_DELAY = 5 * 60
+MAX_RETRY_DELAY = 12 * 60 * 60
+
+# Number of attempts after which a mail is dropped.
+MAX_ATTEMPTS = 10
+
+
+def retry_delay(attempts):
+    """Determine how long to wait before trying to send a mail again.
+
+    :param attempts: Number of failed attempts so far
+    :return: Delay in seconds
+    """
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+class QueuedNotice(object):
+    """Notice for a single recipient about a regression on one host."""
+
+    def __init__(self, tree, branch, host, compiler, old_revision,
+            new_revision, recipient, body, change_log, queue_time=None):
+        self.tree = tree
+        self.branch = branch
+        self.host = host
+        self.compiler = compiler
+        self.old_revision = old_revision
+        self.new_revision = new_revision
+        self.recipient = recipient
+        self.body = body
+        self.change_log = change_log
+        if queue_time is None:
+            queue_time = int(time.time())
+        self.queue_time = queue_time
+        self.attempts = 0
+        self.next_attempt = queue_time
+
+    def __repr__(self):
+        return "<%s for %s on %s/%s/%s>" % (self.__class__.__name__,
+            self.recipient, self.tree, self.host, self.compiler)
+
+    def digest_key(self):
+        """Key of the digest this notice is part of."""
+        return (self.recipient, self.tree, self.new_revision)
+
+
+def format_digest(notices):
+    """Create the mail for a set of notices with the same digest key.
+
+    :param notices: List of notices
+    :return: A `MIMEText` message
+    """
+    first = notices[0]
+    body = ""
+    if len(notices) > 1:
+        body += "\nRevision %s broke the build on these hosts:\n\n" % (
+            first.new_revision)
+        for n in notices:
+            body += "    %s with %s (previous build at revision %s)\n" % (
+                n.host, n.compiler, n.old_revision)
+    body += "".join([n.body for n in notices])
+    # The hosts may have built different old revisions; the longest change
+    # log covers the commits since the oldest of them.
+    change_log = max([n.change_log for n in notices], key=len)
+    body += """
+The build may have been broken by one of the following commits:
+
+%s
+    """ % change_log
+    msg = MIMEText(body)
+    if len(notices) == 1:
+        msg["Subject"] = "BUILD of %s:%s BROKEN on %s with %s AT REVISION %s" % (
+            first.tree, first.branch, first.host, first.compiler,
+            first.new_revision)
+    else:
+        msg["Subject"] = "BUILD of %s:%s BROKEN on %d hosts AT REVISION %s" % (
+            first.tree, first.branch,
+            len(set([(n.host, n.compiler) for n in notices])),
+            first.new_revision)
+    msg["From"] = MAIL_FROM
+    msg["To"] = first.recipient
+    return msg
+
+
+class MailOutbox(object):
+    """Queue of regression notices, stored in the database."""
+
+    def __init__(self, store=None):
+        from buildfarm.sqldb import memory_store
+        if store is None:
+            store = memory_store()
+        self.store = store
+
+    def queue(self, notice):
+        """Add a notice to the queue.
+
+        The notice is only sent once the store has been committed.
+
+        :param notice: A `QueuedNotice`
+        """
+        from buildfarm.sqldb import StormQueuedNotice
+        stored = StormQueuedNotice(notice.tree, notice.branch, notice.host,
+            notice.compiler, notice.old_revision, notice.new_revision,
+            notice.recipient, notice.body, notice.change_log,
+            notice.queue_time)
+        self.store.add(stored)
+        return stored
+
+    def pending(self):
+        """Retrieve all notices that have not been sent yet."""
+        from buildfarm.sqldb import StormQueuedNotice
+        return self.store.find(StormQueuedNotice).order_by(
+            StormQueuedNotice.id)
+
+    def due_digests(self, now=None):
+        """Group the notices that are due by digest.
+
+        A digest is only due once all of its notices are due, so notices
+        that are queued while a digest is waiting for a retry end up in
+        the same mail.
+
+        :param now: Current time
+        :return: List of lists of notices, in the order they were queued
+        """
+        if now is None:
+            now = time.time()
+        digests = {}
+        order = []
+        for notice in self.pending():
+            key = notice.digest_key()
+            if key not in digests:
+                digests[key] = []
+                order.append(key)
+            digests[key].append(notice)
+        return [digests[key] for key in order
+                if max([n.next_attempt for n in digests[key]]) <= now]
+
+    def send(self, smtp, now=None):
+        """Send all digests that are due.
+
+        Every digest that was sent or rescheduled is committed right away,
+        so that it is not sent twice if a later one fails badly.
+
+        :param smtp: Connected `smtplib.SMTP` object
+        :param now: Current time
+        :return: Tuple with the number of digests that were sent and the
+            number of digests that could not be sent
+        """
+        if now is None:
+            now = time.time()
+        sent = 0
+        deferred = 0
+        for notices in self.due_digests(now):
+            msg = format_digest(notices)
+            try:
+                smtp.sendmail(MAIL_FROM, [notices[0].recipient],
+                    msg.as_string())
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                # No point trying the other digests.
+                self._defer(notices, now)
+                self.store.commit()
+                raise
+            except smtplib.SMTPException:
+                self._defer(notices, now)
+                deferred += 1
+            else:
+                for notice in notices:
+                    self.store.remove(notice)
+                sent += 1
+            self.store.commit()
+        return (sent, deferred)
+
+    def _defer(self, notices, now):
+        for notice in notices:
+            notice.attempts += 1
+            if notice.attempts >= MAX_ATTEMPTS:
+                self.store.remove(notice)
+            else:
+                notice.next_attempt = int(now + retry_delay(notice.attempts))
@@ -21,8 +21,13 @@ from buildfarm.tree import (
     Tree,
     )
 from buildfarm.build import (
+    BuildStatus,
+    FAILED_TEST_RESULTS,
+    FLAKINESS_WINDOW,
     StormBuild,
+    TEST_RESULTS,
     Test,
+    TestFlakiness,
     TestResult,
     )
 from buildfarm.hostdb import (
@@ -31,6 +36,9 @@ from buildfarm.hostdb import (
     HostAlreadyExists,
     NoSuchHost,
     )
+from buildfarm.outbox import (
+    QueuedNotice,
+    )
 
 
 try:
@@ -39,10 +47,13 @@ except ImportError:
     import sqlite3
 from storm.database import create_database
 from storm.expr import EXPR, FuncExpr, compile
-from storm.locals import Bool, Desc, Int, RawStr, Reference, Unicode
+from storm.locals import Bool, Desc, Enum, Int, RawStr, Reference, Unicode
 from storm.store import Store
 
 
+# Comparing CAST() expressions prevents SQLite from using indexes, so
+# this should not be used in frequently run queries. Text and blob
+# columns are normalized to blobs by upgrade_schema() instead.
 class Cast(FuncExpr):
     __slots__ = ("column", "type")
     name = "CAST"
@@ -118,9 +129,21 @@ class StormHostDatabase(HostDatabase):
         """Retrieve an iterable over all hosts."""
         return self.store.find(StormHost).order_by(StormHost.name)
 
+    def platform_map(self):
+        """See `HostDatabase.platform_map`."""
+        return dict(self.store.execute("SELECT name, platform FROM host"))
+
+    def serial(self):
+        """See `HostDatabase.serial`."""
+        row = self.store.execute(
+            "SELECT serial FROM host_change WHERE id = 1").get_one()
+        if row is None:
+            return 0
+        return row[0]
+
     def __getitem__(self, name):
         result = self.store.find(StormHost,
-            Cast(StormHost.name, "TEXT") == Cast(name, "TEXT"))
+            StormHost.name == name)
         ret = result.one()
         if ret is None:
             raise NoSuchHost(name)
@@ -140,6 +163,41 @@ def distinct_builds(builds):
         yield build
 
 
+class StormBuildStage(object):
+    __storm_table__ = "build_stage"
+
+    id = Int(primary=True)
+    build_id = Int(name="build")
+    build = Reference(build_id, StormBuild.id)
+    name = RawStr()
+    result = Int()
+
+
+class StormLatestBuild(object):
+    __storm_table__ = "latest_build"
+    __storm_primary__ = ("tree", "host", "compiler")
+
+    tree = RawStr()
+    host = RawStr()
+    compiler = RawStr()
+    build_id = Int(name="build")
+    build = Reference(build_id, StormBuild.id)
+    upload_time = Int(name="age")
+
+
+def insert_build_stages(store, build_id, status):
+    """Store the per-stage results of a build.
+
+    :param store: Storm store
+    :param build_id: Id of the build
+    :param status: A `BuildStatus`
+    """
+    for stage in status.stages:
+        store.execute(
+            "INSERT INTO build_stage (build, name, result) VALUES (?, ?, ?)",
+            (build_id, stage.name, stage.result), noresult=True)
+
+
 class StormTree(Tree):
     __storm_table__ = "tree"
 
@@ -161,13 +219,112 @@ class StormTest(Test):
 
 class StormTestResult(TestResult):
     __storm_table__ = "test_result"
+    __storm_primary__ = ("build_id", "test_id")
 
-    id = Int(primary=True)
     build_id = Int(name="build")
-    build = Reference(build_id, StormBuild)
+    build = Reference(build_id, StormBuild.id)
+
+    test_id = Int(name="test")
+    test = Reference(test_id, StormTest.id)
 
+    result = Enum(map=dict((name, i) for (i, name) in enumerate(TEST_RESULTS)))
+
+
+class StormTestFlakiness(TestFlakiness):
+    __storm_table__ = "test_flakiness"
+    __storm_primary__ = ("tree", "host", "compiler", "test_id")
+
+    tree = RawStr()
+    host = RawStr()
+    compiler = RawStr()
     test_id = Int(name="test")
-    test = Reference(test_id, StormTest)
+    test = Reference(test_id, StormTest.id)
+    runs = Int()
+    history = Int()
+
+
+class StormQueuedNotice(QueuedNotice):
+    __storm_table__ = "mail_queue"
+
+    id = Int(primary=True)
+    tree = RawStr()
+    branch = RawStr()
+    host = RawStr()
+    compiler = RawStr()
+    old_revision = RawStr()
+    new_revision = RawStr()
+    recipient = RawStr()
+    body = RawStr()
+    change_log = RawStr()
+    queue_time = Int()
+    attempts = Int()
+    next_attempt = Int()
+
+
+# SQLite refuses statements with more than 999 parameters.
+MAX_SQL_PARAMETERS = 999
+
+
+def insert_test_results(store, build_id, results):
+    """Store the results of the individual tests of a build.
+
+    Test names are interned in the test table. Both tables are filled
+    with multi-row INSERT statements, so that builds with thousands of
+    tests only take a handful of queries.
+
+    :param store: Storm store
+    :param build_id: Id of the build
+    :param results: Dictionary mapping test names to results
+    """
+    names = results.keys()
+    test_ids = {}
+    chunk_size = MAX_SQL_PARAMETERS
+    for i in range(0, len(names), chunk_size):
+        chunk = names[i:i+chunk_size]
+        placeholders = ", ".join(["?"] * len(chunk))
+        store.execute("INSERT OR IGNORE INTO test (name) VALUES %s" %
+            ", ".join(["(?)"] * len(chunk)), chunk, noresult=True)
+        for (test_id, name) in store.execute(
+                "SELECT id, name FROM test WHERE name IN (%s)" % placeholders,
+                chunk):
+            test_ids[str(name)] = test_id
+    rows = [(build_id, test_ids[name], TEST_RESULTS.index(result))
+            for (name, result) in results.iteritems()]
+    chunk_size = MAX_SQL_PARAMETERS // 3
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i+chunk_size]
+        store.execute(
+            "INSERT OR REPLACE INTO test_result (build, test, result) VALUES %s" %
+            ", ".join(["(?, ?, ?)"] * len(chunk)),
+            [value for row in chunk for value in row], noresult=True)
+
+
+def update_test_flakiness(store, build):
+    """Add the test results of a new build to the flakiness statistics.
+
+    Every test that ran gets its result shifted into the history of its
+    tree, host and compiler, which takes constant time per test.
+
+    :param store: Storm store
+    :param build: A `StormBuild` whose test results have been stored
+    """
+    skip = TEST_RESULTS.index("skip")
+    failed = ", ".join([str(TEST_RESULTS.index(r)) for r in FAILED_TEST_RESULTS])
+    store.execute("""
+INSERT OR IGNORE INTO test_flakiness (tree, host, compiler, test, runs, history)
+SELECT ?, ?, ?, test, 0, 0 FROM test_result WHERE build = ? AND result != ?
+""", (build.tree, build.host, build.compiler, build.id, skip), noresult=True)
+    store.execute("""
+UPDATE test_flakiness SET
+    runs = min(runs + 1, ?),
+    history = ((history << 1) | (
+        SELECT result IN (%s) FROM test_result
+        WHERE build = ? AND test = test_flakiness.test)) & ?
+WHERE tree = ? AND host = ? AND compiler = ? AND test IN (
+    SELECT test FROM test_result WHERE build = ? AND result != ?)
+""" % failed, (FLAKINESS_WINDOW, build.id, (1 << FLAKINESS_WINDOW) - 1,
+        build.tree, build.host, build.compiler, build.id, skip),
+        noresult=True)
 
 
 def setup_schema(db):
@@ -187,6 +344,21 @@ CREATE TABLE IF NOT EXISTS host (
     join_time int
 );""", noresult=True)
     db.execute("CREATE UNIQUE INDEX IF NOT EXISTS unique_hostname ON host (name);", noresult=True)
+    # Counts changes to the host list, so that the web frontend knows
+    # when to refresh its menus; maintained by the triggers below.
+    db.execute("""
+CREATE TABLE IF NOT EXISTS host_change (
+    id integer primary key,
+    serial int not null
+);""", noresult=True)
+    for (name, event) in [("insert", "INSERT"), ("delete", "DELETE"),
+                          ("update", "UPDATE OF name, platform")]:
+        db.execute("""
+CREATE TRIGGER IF NOT EXISTS host_change_%s AFTER %s ON host
+BEGIN
+    INSERT OR REPLACE INTO host_change (id, serial)
+    VALUES (1, ifnull((SELECT serial FROM host_change WHERE id = 1), 0) + 1);
+END;""" % (name, event), noresult=True)
     db.execute("""
 CREATE TABLE IF NOT EXISTS build (
     id integer primary key autoincrement,
@@ -201,11 +373,15 @@ CREATE TABLE IF NOT EXISTS build (
     age int,
     status blob,
     basename blob,
+    err_count int,
+    err_size int,
     FOREIGN KEY (host_id) REFERENCES host (id),
     FOREIGN KEY (tree_id) REFERENCES tree (id),
     FOREIGN KEY (compiler_id) REFERENCES compiler (id)
 );""", noresult=True)
     db.execute("CREATE UNIQUE INDEX IF NOT EXISTS unique_checksum ON build (checksum);", noresult=True)
+    db.execute("CREATE INDEX IF NOT EXISTS build_tree_host_compiler ON build (tree, host, compiler, age);", noresult=True)
+    db.execute("CREATE INDEX IF NOT EXISTS build_tree_revision ON build (tree, revision);", noresult=True)
     db.execute("""
 CREATE TABLE IF NOT EXISTS tree (
     id integer primary key autoincrement,
@@ -241,6 +417,161 @@ CREATE TABLE IF NOT EXISTS test (
         result int
         );""", noresult=True)
     db.execute("""CREATE UNIQUE INDEX IF NOT EXISTS build_test_result ON test_result(build, test);""", noresult=True)
+    db.execute("CREATE INDEX IF NOT EXISTS test_result_test ON test_result (test, build);", noresult=True)
+    # Sliding window of recent results of each test, see TestFlakiness
+    db.execute("""
+CREATE TABLE IF NOT EXISTS test_flakiness (
+    tree blob not null,
+    host blob not null,
+    compiler blob not null,
+    test int not null,
+    runs int not null,
+    history int not null,
+    PRIMARY KEY (tree, host, compiler, test)
+);""", noresult=True)
+    db.execute("""
+CREATE TRIGGER IF NOT EXISTS test_result_build_delete AFTER DELETE ON build
+BEGIN
+    DELETE FROM test_result WHERE build = old.id;
+END;""", noresult=True)
+    # Regression notices that have not been mailed yet, see MailOutbox
+    db.execute("""
+CREATE TABLE IF NOT EXISTS mail_queue (
+    id integer primary key autoincrement,
+    tree blob not null,
+    branch blob,
+    host blob not null,
+    compiler blob not null,
+    old_revision blob,
+    new_revision blob,
+    recipient blob not null,
+    body blob not null,
+    change_log blob not null,
+    queue_time int,
+    attempts int not null,
+    next_attempt int not null
+);""", noresult=True)
+    db.execute("""
+CREATE TABLE IF NOT EXISTS build_stage (
+    id integer primary key autoincrement,
+    build int not null,
+    name blob not null,
+    result int,
+    FOREIGN KEY (build) REFERENCES build (id) ON DELETE CASCADE
+);""", noresult=True)
+    db.execute("CREATE INDEX IF NOT EXISTS build_stage_build ON build_stage (build);", noresult=True)
+    db.execute("CREATE INDEX IF NOT EXISTS build_stage_result ON build_stage (name, result);", noresult=True)
+    # The most recent build for each tree/host/compiler combination,
+    # maintained by the triggers below.
+    db.execute("""
+CREATE TABLE IF NOT EXISTS latest_build (
+    tree blob not null,
+    host blob not null,
+    compiler blob not null,
+    build int not null,
+    age int,
+    PRIMARY KEY (tree, host, compiler)
+);""", noresult=True)
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS latest_build_build ON latest_build (build);", noresult=True)
+    db.execute("CREATE INDEX IF NOT EXISTS latest_build_host ON latest_build (host);", noresult=True)
+    db.execute("""
+CREATE TRIGGER IF NOT EXISTS latest_build_insert AFTER INSERT ON build
+BEGIN
+    INSERT OR REPLACE INTO latest_build (tree, host, compiler, build, age)
+    SELECT new.tree, new.host, new.compiler, new.id, new.age
+    WHERE NOT EXISTS (
+        SELECT 1 FROM latest_build
+        WHERE tree = new.tree AND host = new.host AND
+              compiler = new.compiler AND age > new.age);
+END;""", noresult=True)
+    db.execute("""
+CREATE TRIGGER IF NOT EXISTS latest_build_delete AFTER DELETE ON build
+WHEN EXISTS (SELECT 1 FROM latest_build WHERE build = old.id)
+BEGIN
+    DELETE FROM latest_build WHERE build = old.id;
+    INSERT INTO latest_build (tree, host, compiler, build, age)
+    SELECT tree, host, compiler, id, age FROM build
+    WHERE tree = old.tree AND host = old.host AND compiler = old.compiler
+    ORDER BY age DESC, id DESC LIMIT 1;
+END;""", noresult=True)
+    upgrade_schema(db)
+
+
+# Version of the data in the database, as stored in PRAGMA user_version.
+SCHEMA_VERSION = 4
+
+
+def _migrate_build_status(db):
+    """Convert build.status from repr() to the compact format, and fill
+    the build_stage table."""
+    rows = list(db.execute("SELECT id, status FROM build WHERE status IS NOT NULL"))
+    db.execute("DELETE FROM build_stage", noresult=True)
+    for (build_id, status_str) in rows:
+        status = BuildStatus.__deserialize__(str(status_str))
+        db.execute("UPDATE build SET status = ? WHERE id = ?",
+            (status.__serialize__(), build_id), noresult=True)
+        insert_build_stages(db, build_id, status)
+
+
+def _migrate_blob_columns(db):
+    """Convert values stored as text to blobs.
+
+    Storm binds RawStr values as blobs, and in SQLite a text value never
+    compares equal to a blob.
+    """
+    columns = {
+        "host": ["name", "fqdn"],
+        "build": ["tree", "revision", "host", "compiler", "checksum", "status", "basename"],
+        "tree": ["name", "branch", "subdir", "repo"],
+        "compiler": ["name"],
+        }
+    for table, names in columns.iteritems():
+        for name in names:
+            db.execute(
+                "UPDATE %s SET %s = CAST(%s AS BLOB) WHERE typeof(%s) = 'text'" % (
+                    table, name, name, name), noresult=True)
+
+
+def _populate_latest_build(db):
+    """Fill the latest_build table from the existing builds."""
+    db.execute("DELETE FROM latest_build", noresult=True)
+    db.execute("""
+INSERT INTO latest_build (tree, host, compiler, build, age)
+SELECT tree, host, compiler, id, age FROM build b
+WHERE id = (
+    SELECT id FROM build
+    WHERE tree = b.tree AND host = b.host AND compiler = b.compiler
+    ORDER BY age DESC, id DESC LIMIT 1);
+""", noresult=True)
+
+
+def _add_err_columns(db):
+    """Add the err_count and err_size columns to the build table.
+
+    Existing builds are left with NULL; tools/fix.py fills them in.
+    """
+    columns = [row[1] for row in db.execute("PRAGMA table_info(build)")]
+    for name in ["err_count", "err_size"]:
+        if name not in columns:
+            db.execute("ALTER TABLE build ADD COLUMN %s int" % name,
+                noresult=True)
+
+
+def upgrade_schema(db):
+    """Migrate existing data to the current schema version."""
+    version = db.execute("PRAGMA user_version").get_one()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    if version < 1:
+        _migrate_build_status(db)
+    if version < 2:
+        _migrate_blob_columns(db)
+    if version < 3:
+        _populate_latest_build(db)
+    if version < 4:
+        _add_err_columns(db)
+    db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION, noresult=True)
+    db.commit()
 
 
 def memory_store():
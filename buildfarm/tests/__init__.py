@@ -110,8 +110,10 @@ def test_suite():
         '__init__',
         'test_build',
         'test_buildfarm',
+        'test_cache',
         'test_history',
         'test_hostdb',
+        'test_outbox',
         'test_sqldb',
         'test_util',
         ]
@@ -16,17 +16,26 @@
 #   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 from cStringIO import StringIO
+import hashlib
 import os
 import testtools
 
 from buildfarm.build import (
     Build,
+    BuildDiff,
     BuildStatus,
+    LogAnalysis,
     NoSuchBuildError,
     NoTestOutput,
+    TEST_RESULTS,
+    TestFlakiness,
     UploadBuildResultStore,
+    analyse_build,
     build_status_from_logs,
+    compare_test_results,
     extract_test_output,
+    iter_test_output,
+    parse_test_results,
     )
 
 from buildfarm import BuildFarm
@@ -77,6 +86,15 @@ BUILD COMMIT REVISION: myrev
         self.assertFalse(os.path.exists(logname))
         self.assertRaises(NoSuchBuildError, self.x.get_build, "tdb", "charis", "cc", "12")
 
+    def test_build_remove_sidecars(self):
+        self.upload_mock_logfile(self.x, "tdb", "charis", "cc",
+                "BUILD COMMIT REVISION: 12\n")
+        build = self.x.get_build("tdb", "charis", "cc", "12")
+        build.write_sidecar("html", "<pre></pre>")
+        sidecar = build.basename + ".html.gz"
+        build.remove()
+        self.assertFalse(os.path.exists(sidecar))
+
     def test_build_repr(self):
         path = self.upload_mock_logfile(self.x, "tdb", "charis", "cc", 
             "BUILD COMMIT REVISION: 12\n")
@@ -116,6 +134,34 @@ BUILD COMMIT REVISION: myrev
         build = self.x.get_build("tdb", "charis", "cc", "12")
         self.assertEquals("", build.read_err().read())
 
+    def test_read_sidecar(self):
+        self.upload_mock_logfile(self.x, "tdb", "charis", "cc",
+                stdout_contents="BUILD COMMIT REVISION: 12\n")
+        build = self.x.get_build("tdb", "charis", "cc", "12")
+        self.assertIs(None, build.read_sidecar("html"))
+        build.write_sidecar("html", "<pre></pre>")
+        self.assertEquals("<pre></pre>", build.read_sidecar("html").read())
+
+    def test_write_subunit(self):
+        self.upload_mock_logfile(self.x, "tdb", "charis", "cc",
+            stdout_contents="BUILD COMMIT REVISION: 12\n"
+                "Running action test\n"
+                "test: foo\n"
+                "success: foo\n"
+                "ACTION PASSED: test\n")
+        build = self.x.get_build("tdb", "charis", "cc", "12")
+        build.write_subunit()
+        os.unlink(build.basename + ".log")
+        self.assertEquals("test: foo\nsuccess: foo\n",
+            build.read_subunit().read())
+
+    def test_write_subunit_no_test_output(self):
+        self.upload_mock_logfile(self.x, "tdb", "charis", "cc",
+                stdout_contents="BUILD COMMIT REVISION: 12\n")
+        build = self.x.get_build("tdb", "charis", "cc", "12")
+        self.assertRaises(NoTestOutput, build.write_subunit)
+        self.assertIs(None, build.read_sidecar("subunit"))
+
     def test_revision_details(self):
         self.upload_mock_logfile(self.x, "tdb", "charis", "cc", stdout_contents="""
 BUILD COMMIT REVISION: 43
@@ -144,6 +190,10 @@ error2
 error3""")
         build = self.x.get_build("tdb", "charis", "cc", "12")
         self.assertEquals(3, build.err_count())
+        self.assertEquals(3, build.err_lines)
+        self.assertEquals(20, build.err_size)
+        os.unlink(build.basename + ".err")
+        self.assertEquals(3, build.err_count())
 
     def test_upload_build(self):
         path = self.create_mock_logfile("tdb", "charis", "cc", contents="""
@@ -154,6 +204,25 @@ BUILD COMMIT REVISION: myrev
         uploaded_build = self.x.get_build("tdb", "charis", "cc", "myrev")
         self.assertEquals(uploaded_build.log_checksum(), build.log_checksum())
 
+    def test_analysis_cached(self):
+        path = self.create_mock_logfile("tdb", "charis", "cc", contents="""
+BUILD COMMIT REVISION: myrev
+""")
+        build = Build(path[:-4], "tdb", "charis", "cc")
+        analysis = build.analysis()
+        os.remove(path)
+        self.assertIs(analysis, build.analysis())
+        self.assertEquals("myrev", build.revision_details())
+        self.assertEquals(analysis.checksum, build.log_checksum())
+
+    def test_analyse_build(self):
+        path = self.create_mock_logfile("tdb", "charis", "cc", contents="""
+BUILD COMMIT REVISION: myrev
+""")
+        build = analyse_build(Build(path[:-4], "tdb", "charis", "cc"))
+        os.remove(path)
+        self.assertEquals("myrev", build.revision_details())
+
     def test_upload_build_no_rev(self):
         path = self.create_mock_logfile("tdb", "charis", "cc", contents="""
 """)
@@ -166,6 +235,103 @@ BUILD COMMIT REVISION: myrev
     def test_get_latest_revision_none(self):
         self.assertRaises(NoSuchBuildError, self.x.get_latest_build, "tdb", "charis", "cc")
 
+    def test_get_builds_with_failed_stage(self):
+        self.upload_mock_logfile(self.x, "tdb", "charis", "cc",
+            "BUILD COMMIT REVISION: 12\nCONFIGURE STATUS: 0\nTEST STATUS: 1\n")
+        self.upload_mock_logfile(self.x, "tdb", "myhost", "cc",
+            "BUILD COMMIT REVISION: 12\nCONFIGURE STATUS: 0\nTEST STATUS: 0\n")
+        self.assertEquals(["charis"],
+            [b.host for b in self.x.get_builds_with_failed_stage("TEST")])
+        self.assertEquals([],
+            list(self.x.get_builds_with_failed_stage("CONFIGURE")))
+        self.assertEquals([],
+            list(self.x.get_builds_with_failed_stage("TEST", tree="other")))
+
+    def test_upload_test_results(self):
+        self.upload_mock_logfile(self.x, "tdb", "charis", "cc", """\
+BUILD COMMIT REVISION: 12
+Running action test
+success: foo
+failure: bar [
+Oops
+]
+ACTION FAILED: test
+""", mtime=1200)
+        self.upload_mock_logfile(self.x, "tdb", "myhost", "cc", """\
+BUILD COMMIT REVISION: 12
+Running action test
+success: foo
+success: bar
+ACTION PASSED: test
+""", mtime=1300)
+        self.assertEquals([("myhost", "success"), ("charis", "failure")],
+            [(b.host, r) for (b, r) in self.x.get_test_history("bar")])
+        self.assertEquals([("charis", "failure")],
+            [(b.host, r) for (b, r) in
+                self.x.get_test_history("bar", host="charis")])
+        self.assertEquals([], list(self.x.get_test_history("bar", tree="other")))
+        self.assertEquals([], list(self.x.get_test_history("unknown")))
+        build = self.x.get_build("tdb", "charis", "cc", "12")
+        self.assertEquals({"foo": "success", "bar": "failure"},
+            self.x.get_test_results(build))
+
+    def test_upload_no_test_results(self):
+        self.upload_mock_logfile(self.x, "tdb", "charis", "cc",
+            "BUILD COMMIT REVISION: 12\n")
+        build = self.x.get_build("tdb", "charis", "cc", "12")
+        self.assertEquals({}, self.x.get_test_results(build))
+        self.assertEquals({}, self.x.find_test_results(build))
+
+    def test_find_test_results(self):
+        path = self.upload_mock_logfile(self.x, "tdb", "charis", "cc", """\
+BUILD COMMIT REVISION: 12
+Running action test
+success: foo
+ACTION PASSED: test
+""")
+        build = self.x.get_build("tdb", "charis", "cc", "12")
+        # Stored results take precedence over the log
+        self.x.store.execute("UPDATE test_result SET result = ?",
+            (TEST_RESULTS.index("failure"), ), noresult=True)
+        self.assertEquals({"foo": "failure"}, self.x.find_test_results(build))
+        self.x.store.execute("DELETE FROM test_result", noresult=True)
+        self.assertEquals({"foo": "success"}, self.x.find_test_results(build))
+
+    def test_remove_test_results(self):
+        self.upload_mock_logfile(self.x, "tdb", "charis", "cc", """\
+BUILD COMMIT REVISION: 12
+Running action test
+success: foo
+ACTION PASSED: test
+""")
+        build = self.x.get_build("tdb", "charis", "cc", "12")
+        build.remove()
+        self.assertEquals([], list(self.x.get_test_history("foo")))
+
+    def upload_test_run(self, host, results, mtime):
+        self.upload_mock_logfile(self.x, "tdb", host, "cc",
+            "BUILD COMMIT REVISION: %d\nRunning action test\n%sACTION PASSED: test\n" % (
+                mtime, "".join(["%s: %s\n" % (r, n) for (n, r) in results])),
+            mtime=mtime)
+
+    def test_get_flaky_tests(self):
+        for (i, result) in enumerate(["success", "failure", "success", "failure"]):
+            self.upload_test_run("charis",
+                [("flaky", result), ("broken", i and "failure" or "success"),
+                 ("good", "success")], 1000 + i)
+        self.upload_test_run("myhost", [("flaky", "failure")], 2000)
+        self.assertEquals([("charis", "flaky", 4, 2, 3)],
+            [(f.host, f.test.name, f.runs, f.failures, f.flips)
+             for f in self.x.get_flaky_tests("tdb")])
+        self.assertEquals([], self.x.get_flaky_tests("tdb", host="myhost"))
+        self.assertEquals([], self.x.get_flaky_tests("other"))
+
+    def test_get_flaky_tests_skip(self):
+        for (i, result) in enumerate(["success", "skip", "failure", "skip", "success", "failure"]):
+            self.upload_test_run("charis", [("flaky", result)], 1000 + i)
+        [flaky] = self.x.get_flaky_tests("tdb")
+        self.assertEquals((4, 3), (flaky.runs, flaky.flips))
+
     def test_get_old_builds_none(self):
         self.assertEquals([],
             list(self.x.get_old_builds("tdb", "charis", "gcc")))
@@ -265,6 +431,39 @@ CC_CHECKER STATUS:	2
             [("CONFIGURE", 2), ("TEST", 3), ("CC_CHECKER", 2)])
 
 
+class LogAnalysisTests(testtools.TestCase):
+
+    def analyse(self, log, err=""):
+        return LogAnalysis.from_logs(StringIO(log), StringIO(err))
+
+    def test_checksum(self):
+        log = "foo\nBUILD COMMIT REVISION: 42\nbar"
+        self.assertEquals(hashlib.sha1(log).hexdigest(),
+            self.analyse(log).checksum)
+
+    def test_revision(self):
+        analysis = self.analyse("""
+BUILD COMMIT REVISION: 42
+BUILD COMMIT REVISION: 43
+bla
+""")
+        self.assertEquals("43", analysis.revision)
+
+    def test_no_revision(self):
+        self.assertIs(None, self.analyse("bla\n").revision)
+
+    def test_status(self):
+        analysis = self.analyse("""
+CONFIGURE STATUS: 2
+testsuite-success: toto
+testsuite-failure: foo
+TEST STATUS: 1
+""", "No space left on device\n")
+        self.assertEquals([("CONFIGURE", 2), ("TEST", 1)],
+            analysis.status.stages)
+        self.assertEquals(set(["disk full"]), analysis.status.other_failures)
+
+
 class BuildStatusTest(testtools.TestCase):
 
     def test_cmp_equal(self):
@@ -323,6 +522,27 @@ class BuildStatusTest(testtools.TestCase):
         e = BuildStatus([("CONFIGURE", 2), ("TEST", 3), ("CC_CHECKER", 1)], set(["super error"]))
         self.assertEquals(cmp(d, e), -1)
 
+    def test_serialize(self):
+        a = BuildStatus([("CONFIGURE", 3), ("BUILD", -1)], set(["panic", "timeout"]))
+        self.assertEquals("CONFIGURE=3/BUILD=-1|panic,timeout", a.__serialize__())
+        b = BuildStatus.__deserialize__(a.__serialize__())
+        self.assertEquals(a.stages, b.stages)
+        self.assertEquals(a.other_failures, b.other_failures)
+
+    def test_serialize_empty(self):
+        b = BuildStatus.__deserialize__(BuildStatus().__serialize__())
+        self.assertEquals([], b.stages)
+        self.assertEquals(set(), b.other_failures)
+
+    def test_deserialize_repr(self):
+        a = BuildStatus([("CONFIGURE", 0), ("TEST", 3)], set(["disk full"]))
+        b = BuildStatus.__deserialize__(repr(a))
+        self.assertEquals(a.stages, b.stages)
+        self.assertEquals(a.other_failures, b.other_failures)
+        b = BuildStatus.__deserialize__(repr(BuildStatus()))
+        self.assertEquals([], b.stages)
+        self.assertEquals(set(), b.other_failures)
+
     def test_str(self):
         a = BuildStatus([("CONFIGURE", 3), ("BUILD", 2)])
         self.assertEquals("3/2", str(a))
@@ -417,6 +637,226 @@ class UploadBuildResultStoreTests(UploadBuildResultStoreTestBase,BuildFarmTestCa
         self.x = UploadBuildResultStore(
             os.path.join(self.path, "data", "upload"))
 
+    def test_has_host(self):
+        self.assertFalse(self.x.has_host("charis"))
+        self.create_mock_logfile("tdb", "charis", "cc")
+        self.assertTrue(self.x.has_host("charis"))
+
+
+class IndexedUploadBuildResultStoreTests(UploadBuildResultStoreTestBase,BuildFarmTestCase):
+
+    def setUp(self):
+        super(IndexedUploadBuildResultStoreTests, self).setUp()
+        self.index_path = os.path.join(self.path, "data", "upload.index")
+        self.x = UploadBuildResultStore(
+            os.path.join(self.path, "data", "upload"), self.index_path)
+
+    def test_unseen_only(self):
+        self.create_mock_logfile("tdb", "charis", "cc", mtime=1200)
+        [build] = list(self.x.get_all_builds(unseen_only=True))
+        self.x.mark_seen(build)
+        self.x.save_index()
+        self.assertEquals([], list(self.x.get_all_builds(unseen_only=True)))
+        self.assertEquals(1, len(list(self.x.get_all_builds())))
+        x = UploadBuildResultStore(
+            os.path.join(self.path, "data", "upload"), self.index_path)
+        self.assertEquals([], list(x.get_all_builds(unseen_only=True)))
+
+    def test_changed(self):
+        self.create_mock_logfile("tdb", "charis", "cc", mtime=1200)
+        [build] = list(self.x.get_all_builds(unseen_only=True))
+        self.x.mark_seen(build)
+        self.create_mock_logfile("tdb", "charis", "cc", mtime=1300)
+        self.assertEquals(1, len(list(self.x.get_all_builds(unseen_only=True))))
+
+
+class TestFlakinessTests(testtools.TestCase):
+
+    def test_no_runs(self):
+        f = TestFlakiness("tdb", "charis", "cc", None)
+        self.assertEquals((0, 0, 0.0), (f.failures, f.flips, f.score))
+        self.assertFalse(f.is_flaky())
+
+    def test_broken(self):
+        # Passed twice, then failed three times
+        f = TestFlakiness("tdb", "charis", "cc", None, 5, 0x7)
+        self.assertEquals((3, 1, 0.25), (f.failures, f.flips, f.score))
+        self.assertFalse(f.is_flaky())
+
+    def test_flaky(self):
+        f = TestFlakiness("tdb", "charis", "cc", None, 5, 0xa)
+        self.assertEquals((2, 4, 1.0), (f.failures, f.flips, f.score))
+        self.assertTrue(f.is_flaky())
+
+    def test_ignores_older_runs(self):
+        # Bits beyond the number of runs are not looked at
+        f = TestFlakiness("tdb", "charis", "cc", None, 2, 0x5)
+        self.assertEquals(1, f.flips)
+
+
+class BuildDiffTests(BuildFarmTestCase):
+
+    def setUp(self):
+        super(BuildDiffTests, self).setUp()
+        self.old = self.create_build("myrev", "TEST STATUS: 1\n")
+
+    def create_build(self, rev, contents):
+        path = self.create_mock_logfile("tdb", "charis", "cc",
+            contents="BUILD COMMIT REVISION: %s\n%s" % (rev, contents))
+        build = Build(path[:-4], "tdb", "charis", "cc")
+        build.analysis()
+        os.remove(path)
+        return build
+
+    def test_new_test_failures(self):
+        new = self.create_build("newrev", "TEST STATUS: 2\n")
+        diff = BuildDiff(None, self.old, new,
+            {"a": "failure", "b": "success", "c": "success"},
+            {"a": "failure", "b": "failure", "c": "success", "d": "error"})
+        self.assertEquals(set(["b", "d"]), diff.new_test_failures())
+
+    def test_test_results_diff(self):
+        new = self.create_build("newrev", "TEST STATUS: 2\n")
+        self.assertEquals(None, BuildDiff(None, self.old, new).test_results_diff())
+        diff = BuildDiff(None, self.old, new, {"a": "failure"},
+            {"a": "success"}).test_results_diff()
+        self.assertEquals([("a", "failure", "success")], diff.newly_passing)
+
+    def test_new_test_failures_unknown(self):
+        new = self.create_build("newrev", "TEST STATUS: 2\n")
+        self.assertEquals(set(), BuildDiff(None, self.old, new).new_test_failures())
+
+    def test_is_regression_flaky(self):
+        new = self.create_build("newrev", "TEST STATUS: 2\n")
+        diff = BuildDiff(None, self.old, new, {"a": "failure", "b": "success"},
+            {"a": "failure", "b": "failure"})
+        self.assertTrue(diff.is_regression())
+        self.assertTrue(diff.is_regression(set(["a"])))
+        self.assertFalse(diff.is_regression(set(["b"])))
+
+    def test_is_regression_flaky_other_stage(self):
+        old = self.create_build("myrev", "CONFIGURE STATUS: 0\nTEST STATUS: 1\n")
+        new = self.create_build("newrev", "CONFIGURE STATUS: 1\nTEST STATUS: 2\n")
+        diff = BuildDiff(None, old, new, {"a": "failure", "b": "success"},
+            {"a": "failure", "b": "failure"})
+        self.assertTrue(diff.is_regression(set(["b"])))
+
+    def test_regressed_tests(self):
+        new = self.create_build("newrev", "TEST STATUS: 1\n")
+        diff = BuildDiff(None, self.old, new,
+            {"a": "failure", "b": "success", "f": "success"},
+            {"a": "success", "b": "error", "c": "failure", "f": "failure"})
+        self.assertEquals([("b", "success", "error"), ("c", None, "failure"),
+            ("f", "success", "failure")], diff.regressed_tests())
+        self.assertEquals([("b", "success", "error"), ("c", None, "failure")],
+            diff.regressed_tests(set(["f"])))
+
+    def test_regressed_tests_no_old_results(self):
+        new = self.create_build("newrev", "TEST STATUS: 1\n")
+        diff = BuildDiff(None, self.old, new, {}, {"a": "failure"})
+        self.assertEquals([], diff.regressed_tests())
+        self.assertFalse(diff.is_regression())
+
+    def test_is_regression_same_count(self):
+        # One test got fixed and another one broke
+        new = self.create_build("newrev", "TEST STATUS: 1\n")
+        self.assertFalse(BuildDiff(None, self.old, new).is_regression())
+        diff = BuildDiff(None, self.old, new, {"a": "failure", "b": "success"},
+            {"a": "success", "b": "failure"})
+        self.assertTrue(diff.is_regression())
+        self.assertFalse(diff.is_regression(set(["b"])))
+
+    def test_is_regression_disk_full(self):
+        new = self.create_build("newrev", "TEST STATUS: 1\nNo space left on device\n")
+        self.assertEquals(set(["disk full"]), new.status().other_failures)
+        diff = BuildDiff(None, self.old, new, {"a": "failure", "b": "success"},
+            {"a": "success", "b": "failure"})
+        self.assertEquals([("b", "success", "failure")], diff.regressed_tests())
+        self.assertFalse(diff.is_regression())
+
+    def test_is_regression_timeout(self):
+        old = self.create_build("myrev", "TEST STATUS: 1\nmaximum runtime exceeded\n")
+        new = self.create_build("newrev", "TEST STATUS: 1\nmaximum runtime exceeded\n")
+        self.assertEquals(set(["timeout"]), new.status().other_failures)
+        diff = BuildDiff(None, old, new, {"a": "failure", "b": "success"},
+            {"a": "success", "b": "failure"})
+        self.assertFalse(diff.is_regression())
+
+
+class CompareTestResultsTests(testtools.TestCase):
+
+    def test_same(self):
+        diff = compare_test_results({"a": "success"}, [("a", "success")])
+        self.assertFalse(diff)
+
+    def test_changes(self):
+        diff = compare_test_results(
+            [("same", "failure"), ("broke", "success"), ("fixed", "error"),
+             ("gone", "success"), ("skipped", "failure")],
+            [("new", "failure"), ("fixed", "success"), ("broke", "uxsuccess"),
+             ("same", "failure"), ("skipped", "skip")])
+        self.assertTrue(diff)
+        self.assertEquals([("broke", "success", "uxsuccess")], diff.newly_failing)
+        self.assertEquals([("fixed", "error", "success")], diff.newly_passing)
+        self.assertEquals([("new", "failure")], diff.added)
+        self.assertEquals([("gone", "success")], diff.removed)
+
+    def test_order_independent(self):
+        results = [("a", "success"), ("b", "failure"), ("c", "success")]
+        self.assertFalse(compare_test_results(results, reversed(results)))
+
+    def test_as_dict(self):
+        diff = compare_test_results({"a": "success", "b": "success"},
+            {"a": "failure"})
+        self.assertEquals({
+            "newly_failing": [{"test": "a", "old": "success", "new": "failure"}],
+            "newly_passing": [],
+            "added": [],
+            "removed": [{"test": "b", "result": "success"}],
+            }, diff.as_dict())
+
+
+class ParseTestResultsTests(testtools.TestCase):
+
+    def parse(self, text):
+        return list(parse_test_results(StringIO(text)))
+
+    def test_empty(self):
+        self.assertEquals([], self.parse(""))
+
+    def test_results(self):
+        self.assertEquals([("a", "success"), ("b", "failure"), ("c", "skip"),
+            ("d", "xfail"), ("e", "error"), ("f", "uxsuccess")], self.parse("""\
+time: 2010-11-01 12:00:00Z
+test: a
+successful: a
+test: b
+fail: b
+skip: c
+xfail: d
+error: e
+uxsuccess: f
+testsuite-success: samba4
+"""))
+
+    def test_details(self):
+        self.assertEquals([("a", "failure"), ("c", "success")], self.parse("""\
+failure: a [
+success: b
+]
+success: c
+"""))
+
+    def test_multipart(self):
+        self.assertEquals([("a", "error"), ("b", "success")], self.parse("""\
+error: a [ multipart
+Content-Type: text/plain
+traceback
+0
+]
+success: b
+"""))
+
 
 class ExtractSubunitTests(testtools.TestCase):
 
@@ -437,3 +877,49 @@ FOO
 ACTION PASSED: test
 
 """))
+
+    def test_unfinished(self):
+        self.assertEquals("FOO\n", self.extract_test_output(
+            "Running action test\nFOO\nRunning action install\n"))
+
+
+class IterTestOutputTests(testtools.TestCase):
+
+    def iter_test_output(self, log):
+        try:
+            return "".join(iter_test_output(StringIO(log)))
+        except NoTestOutput:
+            return None
+
+    def test_not_present(self):
+        self.assertEquals(None, self.iter_test_output(
+            "Running action build\nFOO\nACTION PASSED: build\n"))
+
+    def test_simple(self):
+        self.assertEquals("FOO\n", self.iter_test_output("""
+Running action build
+BAR
+ACTION PASSED: build
+Running action test
+FOO
+ACTION FAILED: test
+Running action install
+ACTION PASSED: install
+"""))
+
+    def test_unfinished(self):
+        self.assertEquals("FOO\n", self.iter_test_output(
+            "Running action test\nFOO\n"))
+
+    def test_unfinished_followed_by_action(self):
+        self.assertEquals("success: a\n", self.iter_test_output(
+            "Running action test\nsuccess: a\nRunning action install\n"
+            "BAR\nACTION PASSED: install\n"))
+
+    def test_empty(self):
+        self.assertEquals("", self.iter_test_output(
+            "Running action test\nACTION PASSED: test\n"))
+
+    def test_list(self):
+        self.assertEquals(["FOO\n"], list(iter_test_output(
+            ["Running action test\n", "FOO\n", "ACTION PASSED: test\n"])))
@@ -103,6 +103,31 @@ class BuildFarmTests(BuildFarmTestCase):
         builds = list(self.x.get_tree_builds("tdb"))
         self.assertEquals(["42", "12"], [x.revision for x in builds])
 
+    def test_get_tree_builds_with_platform(self):
+        self.x.hostdb.createhost("gentoohost", u"Gentoo")
+        self.x.hostdb.createhost("aixhost", u"AIX")
+        self.upload_mock_logfile(self.x.builds, "tdb", "aixhost", "cc",
+            stdout_contents="BUILD COMMIT REVISION: 12\n", mtime=1200)
+        self.upload_mock_logfile(self.x.builds, "tdb", "gentoohost", "cc",
+            stdout_contents="BUILD COMMIT REVISION: 13\n", mtime=1300)
+        self.assertEquals([("13", u"Gentoo"), ("12", u"AIX")],
+            [(b.revision, p) for (b, p) in self.x.get_tree_builds_with_platform("tdb")])
+        self.assertEquals([("12", u"AIX"), ("13", u"Gentoo")],
+            [(b.revision, p) for (b, p) in self.x.get_tree_builds_with_platform("tdb", "platform")])
+
+    def test_get_tree_builds_with_platform_unknown_host(self):
+        self.x.hostdb.createhost("gentoohost", u"Gentoo")
+        self.upload_mock_logfile(self.x.builds, "tdb", "gentoohost", "cc",
+            stdout_contents="BUILD COMMIT REVISION: 13\n", mtime=1300)
+        self.x.hostdb.createhost("gonehost", u"AIX")
+        self.upload_mock_logfile(self.x.builds, "tdb", "gonehost", "cc",
+            stdout_contents="BUILD COMMIT REVISION: 12\n", mtime=1200)
+        self.x.hostdb.deletehost("gonehost")
+        self.assertEquals([("13", u"Gentoo"), ("12", u"UNKNOWN")],
+            [(b.revision, p) for (b, p) in self.x.get_tree_builds_with_platform("tdb")])
+        self.assertEquals([("13", u"Gentoo"), ("12", u"UNKNOWN")],
+            [(b.revision, p) for (b, p) in self.x.get_tree_builds_with_platform("tdb", "platform")])
+
     def test_get_last_builds(self):
         path = self.upload_mock_logfile(self.x.builds, "other", "myhost", "cc",
             "BUILD COMMIT REVISION: 12\n", mtime=1200)
@@ -119,6 +144,15 @@ class BuildFarmTests(BuildFarmTestCase):
         self.assertEquals("12", builds[1].revision_details())
         self.assertEquals("other", builds[1].tree)
 
+    def test_last_upload_time(self):
+        self.assertIs(None, self.x.last_upload_time())
+        self.upload_mock_logfile(self.x.builds, "other", "myhost", "cc",
+            "BUILD COMMIT REVISION: 12\n", mtime=1200)
+        self.upload_mock_logfile(self.x.builds, "trivial", "myhost", "cc",
+            "BUILD COMMIT REVISION: 13\n", mtime=1300)
+        self.assertEquals(1300, self.x.last_upload_time())
+        self.assertEquals(1200, self.x.last_upload_time("other"))
+
     def test_get_summary_builds_empty(self):
         self.assertEquals([], list(self.x.get_summary_builds()))
 
@@ -141,6 +175,28 @@ class BuildFarmTests(BuildFarmTestCase):
     def test_get_host_builds_empty(self):
         self.assertEquals([], list(self.x.get_host_builds("myhost")))
 
+    def test_get_host_builds(self):
+        self.upload_mock_logfile(self.x.builds, "tdb", "myhost", "cc",
+            stdout_contents="BUILD COMMIT REVISION: 12\n", mtime=1200)
+        self.upload_mock_logfile(self.x.builds, "tdb", "myhost", "cc",
+            stdout_contents="BUILD COMMIT REVISION: 42\n", mtime=4200)
+        self.upload_mock_logfile(self.x.builds, "tdb", "charis", "cc",
+            stdout_contents="BUILD COMMIT REVISION: 13\n", mtime=1300)
+        self.assertEquals(["42"],
+            [x.revision for x in self.x.get_host_builds("myhost")])
+        self.assertEquals(4200, self.x.host_last_build("myhost"))
+        self.assertEquals({"myhost": 4200, "charis": 1300},
+            self.x.host_last_builds())
+
+    def test_get_host_builds_after_remove(self):
+        self.upload_mock_logfile(self.x.builds, "tdb", "myhost", "cc",
+            stdout_contents="BUILD COMMIT REVISION: 12\n", mtime=1200)
+        self.upload_mock_logfile(self.x.builds, "tdb", "myhost", "cc",
+            stdout_contents="BUILD COMMIT REVISION: 42\n", mtime=4200)
+        self.x.get_build("tdb", "myhost", "cc", "42").remove()
+        self.assertEquals(["12"],
+            [x.revision for x in self.x.get_host_builds("myhost")])
+
     def test_lcov_status_none(self):
         self.assertRaises(NoSuchBuildError, self.x.lcov_status, "trivial")
 
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import os
+import shutil
+import tempfile
+import testtools
+
+from buildfarm.cache import (
+    FileCache,
+    SWEEP_INTERVAL,
+    )
+
+
+class FileCacheTests(testtools.TestCase):
+
+    def setUp(self):
+        super(FileCacheTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.cache = FileCache(os.path.join(self.path, "cache"), 10)
+
+    def set_mtime(self, key, mtime):
+        p = self.cache._entry_path(key)
+        os.utime(p, (mtime, mtime))
+
+    def test_missing(self):
+        self.assertIs(None, self.cache.get("foo"))
+
+    def test_set_get(self):
+        self.cache.set("foo", "bar")
+        self.assertEquals("bar", self.cache.get("foo"))
+        self.cache.set("foo", "blah")
+        self.assertEquals("blah", self.cache.get("foo"))
+
+    def test_too_large(self):
+        self.cache.set("foo", "x" * 11)
+        self.assertIs(None, self.cache.get("foo"))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set("a", "aaaa")
+        self.set_mtime("a", 1000)
+        self.cache.set("b", "bbbb")
+        self.set_mtime("b", 2000)
+        self.cache.get("a")
+        self.cache.set("c", "cccc")
+        self.assertEquals("aaaa", self.cache.get("a"))
+        self.assertIs(None, self.cache.get("b"))
+        self.assertEquals("cccc", self.cache.get("c"))
+
+    def count_sweeps(self):
+        sweeps = []
+        orig_sweep = self.cache._sweep
+        def sweep():
+            sweeps.append(None)
+            orig_sweep()
+        self.cache._sweep = sweep
+        return sweeps
+
+    def test_keeps_size(self):
+        sweeps = self.count_sweeps()
+        self.cache.set("a", "aaaa")
+        self.cache.set("b", "bbbb")
+        self.cache.set("a", "aa")
+        self.assertEquals(6, self.cache._size)
+        # Only the first write had to look at the directory
+        self.assertEquals(1, len(sweeps))
+
+    def test_sweeps_periodically(self):
+        self.cache = FileCache(os.path.join(self.path, "cache"), 1000)
+        self.cache.set("a", "aaaa")
+        # Written by another process
+        FileCache(self.cache.path, 1000).set("b", "bbbb")
+        for i in range(SWEEP_INTERVAL):
+            self.assertEquals(4, self.cache._size)
+            self.cache.set("a", "aaaa")
+        self.assertEquals(8, self.cache._size)
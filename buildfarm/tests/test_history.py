@@ -15,10 +15,17 @@
 #   along with this program; if not, write to the Free Software
 #   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-from buildfarm.history import GitBranch
+from buildfarm.history import (
+    CommitIndex,
+    GitBranch,
+    author_email,
+    )
 
+from dulwich.objects import Blob, Commit, Tree
 from dulwich.repo import Repo
 
+import os
+import shutil
 import tempfile
 from testtools import TestCase
 
@@ -46,3 +53,212 @@ class GitBranchTests(TestCase):
         entry, diff = list(branch.diff(revid))
         self.assertEquals("message", entry.message)
         self.assertEquals("", diff)
+
+
+class GitBranchLogTests(TestCase):
+
+    def setUp(self):
+        super(GitBranchLogTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.repo = Repo.init(self.path)
+        tree = Tree()
+        self.repo.object_store.add_object(tree)
+        self.tree_id = tree.id
+
+    def commit(self, message, commit_time, parents=[]):
+        c = Commit()
+        c.tree = self.tree_id
+        c.parents = [p.id for p in parents]
+        c.author = c.committer = "Jelmer Vernooij <jelmer@samba.org>"
+        c.author_time = c.commit_time = commit_time
+        c.author_timezone = c.commit_timezone = 0
+        c.message = message
+        self.repo.object_store.add_object(c)
+        self.repo.refs["refs/heads/master"] = c.id
+        return c
+
+    def log(self, **kwargs):
+        branch = GitBranch(self.repo.path, "master")
+        return [entry.message for entry in branch.log(**kwargs)]
+
+    def test_unlimited(self):
+        parent = None
+        for i in range(5):
+            parent = self.commit(str(i), i, parent and [parent] or [])
+        self.assertEquals(["4", "3", "2", "1", "0"], self.log())
+        self.assertEquals(["4", "3"], self.log(limit=2))
+
+    def test_commit_time_order(self):
+        base = self.commit("base", 0)
+        a1 = self.commit("a1", 10, [base])
+        b1 = self.commit("b1", 20, [base])
+        a2 = self.commit("a2", 30, [a1])
+        self.commit("merge", 40, [a2, b1])
+        self.assertEquals(["merge", "a2", "b1", "a1", "base"], self.log())
+
+    def test_exclude_ancestors(self):
+        base = self.commit("base", 0)
+        old = self.commit("old", 10, [base])
+        side = self.commit("side", 5, [base])
+        new = self.commit("new", 20, [old, side])
+        self.assertEquals(["new", "side"],
+            self.log(from_rev=new.id, exclude_revs=set([old.id])))
+
+    def test_exclude_merged(self):
+        # old is only reachable from new through a merge
+        base = self.commit("base", 0)
+        old = self.commit("old", 10, [base])
+        other = self.commit("other", 15, [base])
+        merge = self.commit("merge", 20, [other, old])
+        new = self.commit("new", 30, [merge])
+        self.assertEquals(["new", "merge", "other"],
+            self.log(from_rev=new.id, exclude_revs=set([old.id])))
+
+    def test_exclude_self(self):
+        c = self.commit("c", 0)
+        self.assertEquals([], self.log(from_rev=c.id, exclude_revs=set([c.id])))
+
+    def test_exclude_unknown(self):
+        base = self.commit("base", 0)
+        new = self.commit("new", 10, [base])
+        self.assertEquals(["new", "base"],
+            self.log(from_rev=new.id, exclude_revs=set(["a" * 40])))
+
+
+class AuthorEmailTests(TestCase):
+
+    def test_email(self):
+        self.assertEquals("jelmer@samba.org",
+            author_email("Jelmer Vernooij <jelmer@samba.org>"))
+
+    def test_no_email(self):
+        self.assertEquals(None, author_email("Jelmer Vernooij"))
+
+
+class IndexedGitBranchTests(TestCase):
+
+    def setUp(self):
+        super(IndexedGitBranchTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.repo = Repo.init(os.path.join(self.path, "repo"), mkdir=True)
+        self.index_path = os.path.join(self.path, "history", "tree.sqlite")
+
+    def get_branch(self, update=True):
+        branch = GitBranch(self.repo.path, "master",
+            index_path=self.index_path)
+        self.addCleanup(branch.close)
+        if update:
+            branch.update_index()
+        return branch
+
+    def commit(self, message, author="Jelmer Vernooij <jelmer@samba.org>",
+               files=None):
+        tree = Tree()
+        for (name, contents) in (files or {}).items():
+            blob = Blob.from_string(contents)
+            self.repo.object_store.add_object(blob)
+            tree.add(name, 0100644, blob.id)
+        self.repo.object_store.add_object(tree)
+        return self.repo.do_commit(message, committer=author, author=author,
+            tree=tree.id)
+
+    def test_log_empty(self):
+        self.assertEquals([], list(self.get_branch().log()))
+
+    def test_log(self):
+        revs = [self.commit("one"), self.commit("two"), self.commit("three")]
+        log = list(self.get_branch().log(limit=10))
+        self.assertEquals(list(reversed(revs)), [e.revision for e in log])
+        self.assertEquals("three", log[0].message)
+
+    def test_update_incremental(self):
+        revs = [self.commit("one"), self.commit("two")]
+        self.get_branch()
+        revs.append(self.commit("three"))
+        branch = self.get_branch()
+        self.assertEquals(revs[2], branch.index.head())
+        self.assertEquals(list(reversed(revs)),
+            [e.revision for e in branch.recent_log(10)])
+
+    def test_update_rewound(self):
+        one = self.commit("one")
+        self.commit("two")
+        self.get_branch()
+        self.repo.refs["refs/heads/master"] = one
+        branch = self.get_branch()
+        self.assertEquals([one], [e.revision for e in branch.recent_log(10)])
+
+    def test_recent_log(self):
+        revs = [self.commit("msg%d" % i) for i in range(5)]
+        branch = self.get_branch()
+        self.assertEquals([revs[2], revs[1]],
+            [e.revision for e in branch.recent_log(10, offset=2, limit=2)])
+        self.assertEquals([revs[4], revs[3]],
+            [e.revision for e in branch.recent_log(2)])
+
+    def test_recent_log_author(self):
+        one = self.commit("one", author="Foo <foo@example.com>")
+        self.commit("two")
+        three = self.commit("three", author="Foo <foo@example.com>")
+        branch = self.get_branch()
+        self.assertEquals([three, one], [e.revision for e in
+            branch.recent_log(10, author="foo@example.com")])
+        self.assertEquals([three], [e.revision for e in
+            branch.recent_log(2, author="foo@example.com")])
+
+    def test_recent_authors(self):
+        self.commit("one", author="Foo <foo@example.com>")
+        self.commit("two")
+        self.assertEquals(
+            set(["Foo <foo@example.com>", "Jelmer Vernooij <jelmer@samba.org>"]),
+            self.get_branch().recent_authors(10))
+        self.assertEquals(set(["Jelmer Vernooij <jelmer@samba.org>"]),
+            self.get_branch().recent_authors(1))
+
+    def test_changes_summary(self):
+        self.commit("one", files={"a": "a", "b": "b"})
+        rev = self.commit("two", files={"a": "A", "c": "c"})
+        branch = self.get_branch()
+        expected = (set(["c"]), set(["a"]), set(["b"]))
+        self.assertEquals(expected, branch.index.changes_summary(rev))
+        self.assertEquals(expected, branch.changes_summary(rev))
+
+    def test_changes_summary_not_indexed(self):
+        self.commit("one", files={"a": "a", "b": "b"})
+        self.get_branch()
+        rev = self.commit("two", files={"a": "A", "c": "c"})
+        branch = self.get_branch(update=False)
+        self.assertEquals(None, branch.index.changes_summary(rev))
+        self.assertEquals((set(["c"]), set(["a"]), set(["b"])),
+            branch.changes_summary(rev))
+        self.assertEquals(None, branch.index.changes_summary(rev))
+
+    def test_no_index(self):
+        revs = [self.commit("one"), self.commit("two")]
+        branch = self.get_branch(update=False)
+        self.assertIs(None, branch.index)
+        self.assertFalse(os.path.exists(self.index_path))
+        self.assertEquals(list(reversed(revs)),
+            [e.revision for e in branch.recent_log(10)])
+
+    def test_stale_index(self):
+        revs = [self.commit("one"), self.commit("two")]
+        self.get_branch()
+        revs.append(self.commit("three",
+            author="Foo <foo@example.com>"))
+        branch = self.get_branch(update=False)
+        self.assertEquals(revs[1], branch.index.head())
+        self.assertEquals(list(reversed(revs)),
+            [e.revision for e in branch.recent_log(10)])
+        self.assertEquals(
+            set(["Foo <foo@example.com>", "Jelmer Vernooij <jelmer@samba.org>"]),
+            branch.recent_authors(10))
+        self.assertEquals(revs[1], CommitIndex(self.index_path).head())
+
+    def test_close(self):
+        self.commit("one")
+        branch = self.get_branch()
+        branch.close()
+        self.assertIs(None, branch.index)
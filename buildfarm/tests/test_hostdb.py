@@ -46,6 +46,12 @@ class HostDatabaseTests(object):
         samehost = self.db["charis"]
         self.assertEquals(samehost, newhost)
 
+    def test_platform_map(self):
+        self.db.createhost("charis", u"linux")
+        self.db.createhost("myhost", u"Debian")
+        self.assertEquals({"charis": u"linux", "myhost": u"Debian"},
+            self.db.platform_map())
+
     def test_create_already_exists(self):
         host = self.db.createhost(name="foo", owner=u"Jelmer", owner_email=u"jelmer@samba.org")
         self.assertRaises(hostdb.HostAlreadyExists,  self.db.createhost, name="foo",
@@ -67,6 +73,22 @@ class HostDatabaseTests(object):
         host = self.db.createhost(name="foo", owner=u"Jelmer", owner_email=u"jelmer@samba.org")
         host.update_owner(new_owner=u"Matthieu", new_owner_email=u"mat@samba.org")
 
+    def test_serial(self):
+        serials = [self.db.serial()]
+        host = self.db.createhost(name="foo")
+        serials.append(self.db.serial())
+        host.update_platform(u"Debian")
+        serials.append(self.db.serial())
+        self.db.deletehost("foo")
+        serials.append(self.db.serial())
+        self.assertEquals(len(serials), len(set(serials)))
+
+    def test_serial_unchanged(self):
+        host = self.db.createhost(name="foo")
+        serial = self.db.serial()
+        host.update_owner(new_owner=u"Matthieu", new_owner_email=u"mat@samba.org")
+        self.assertEquals(serial, self.db.serial())
+
     def test_create_rsync_secrets(self):
         self.db.createhost(name="foo")
         self.db.createhost(name="bla", owner=u"Jelmer", owner_email=u"jelmer@samba.org",
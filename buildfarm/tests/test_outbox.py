@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+from buildfarm.outbox import (
+    MAX_ATTEMPTS,
+    MAX_RETRY_DELAY,
+    MailOutbox,
+    QueuedNotice,
+    RETRY_DELAY,
+    format_digest,
+    retry_delay,
+    )
+import asyncore
+import email
+import smtpd
+import smtplib
+import testtools
+import threading
+
+
+class RecordingSMTPServer(smtpd.SMTPServer):
+    """SMTP server that keeps the mails it receives in memory."""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.messages = []
+        self.reject = set()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.reject.intersection(rcpttos):
+            return "550 No such user"
+        self.messages.append((rcpttos, email.message_from_string(data)))
+
+    def serve(self):
+        self.serving = True
+        while self.serving:
+            asyncore.loop(timeout=0.01, count=1)
+        asyncore.close_all()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve)
+        thread.start()
+        return thread
+
+    def stop(self, thread):
+        self.serving = False
+        thread.join()
+
+
+def notice(host, recipient="jelmer@samba.org", new_revision="newrev",
+        queue_time=1000, old_revision="oldrev",
+        change_log="revision: newrev\n"):
+    return QueuedNotice("tdb", "master", host, "cc", old_revision,
+        new_revision, recipient, "\nBroken build on %s\n" % host,
+        change_log, queue_time)
+
+
+class RetryDelayTests(testtools.TestCase):
+
+    def test_doubles(self):
+        self.assertEquals(RETRY_DELAY, retry_delay(1))
+        self.assertEquals(RETRY_DELAY * 4, retry_delay(3))
+
+    def test_maximum(self):
+        self.assertEquals(MAX_RETRY_DELAY, retry_delay(MAX_ATTEMPTS))
+
+
+class FormatDigestTests(testtools.TestCase):
+
+    def test_single(self):
+        msg = format_digest([notice("charis")])
+        self.assertEquals("BUILD of tdb:master BROKEN on charis with cc AT REVISION newrev",
+            msg["Subject"])
+        self.assertEquals("jelmer@samba.org", msg["To"])
+
+    def test_multiple(self):
+        msg = format_digest([notice("charis"), notice("gwen")])
+        self.assertEquals("BUILD of tdb:master BROKEN on 2 hosts AT REVISION newrev",
+            msg["Subject"])
+        body = msg.get_payload()
+        self.assertTrue("Broken build on charis" in body)
+        self.assertTrue("Broken build on gwen" in body)
+        self.assertEquals(1, body.count("revision: newrev"))
+
+    def test_different_old_revisions(self):
+        msg = format_digest([notice("charis"),
+            notice("gwen", old_revision="olderrev",
+                change_log="revision: newrev\nrevision: oldrev\n")])
+        body = msg.get_payload()
+        self.assertTrue("charis with cc (previous build at revision oldrev)" in body)
+        self.assertTrue("gwen with cc (previous build at revision olderrev)" in body)
+        self.assertTrue("revision: newrev\nrevision: oldrev\n" in body)
+
+
+class MailOutboxTests(testtools.TestCase):
+
+    def setUp(self):
+        super(MailOutboxTests, self).setUp()
+        self.outbox = MailOutbox()
+        self.server = RecordingSMTPServer()
+        self.addCleanup(self.server.stop, self.server.start())
+        self.smtp = smtplib.SMTP("127.0.0.1", self.server.socket.getsockname()[1])
+        self.addCleanup(self.smtp.quit)
+
+    def test_digest_per_recipient(self):
+        self.outbox.queue(notice("charis"))
+        self.outbox.queue(notice("charis", recipient="andrew@samba.org"))
+        self.outbox.queue(notice("gwen", old_revision="olderrev"))
+        self.outbox.queue(notice("gwen", new_revision="otherrev"))
+        self.assertEquals((3, 0), self.outbox.send(self.smtp, 1000))
+        self.assertEquals([
+            (["jelmer@samba.org"], "BUILD of tdb:master BROKEN on 2 hosts AT REVISION newrev"),
+            (["andrew@samba.org"], "BUILD of tdb:master BROKEN on charis with cc AT REVISION newrev"),
+            (["jelmer@samba.org"], "BUILD of tdb:master BROKEN on gwen with cc AT REVISION otherrev"),
+            ], [(to, msg["Subject"]) for (to, msg) in self.server.messages])
+        self.assertEquals([], list(self.outbox.pending()))
+        self.assertEquals((0, 0), self.outbox.send(self.smtp, 1000))
+
+    def test_not_due(self):
+        self.outbox.queue(notice("charis", queue_time=2000))
+        self.assertEquals((0, 0), self.outbox.send(self.smtp, 1000))
+        self.assertEquals([], self.server.messages)
+
+    def test_retry(self):
+        self.server.reject.add("jelmer@samba.org")
+        self.outbox.queue(notice("charis"))
+        self.outbox.queue(notice("charis", recipient="andrew@samba.org"))
+        self.assertEquals((1, 1), self.outbox.send(self.smtp, 1000))
+        [n] = list(self.outbox.pending())
+        self.assertEquals(1, n.attempts)
+        self.assertEquals(1000 + RETRY_DELAY, n.next_attempt)
+        # Another host broke in the meantime; it is part of the retry
+        self.outbox.queue(notice("gwen", queue_time=1100))
+        self.server.reject.clear()
+        self.assertEquals((0, 0), self.outbox.send(self.smtp, 1100))
+        self.assertEquals((1, 0), self.outbox.send(self.smtp, 1000 + RETRY_DELAY))
+        self.assertEquals("BUILD of tdb:master BROKEN on 2 hosts AT REVISION newrev",
+            self.server.messages[-1][1]["Subject"])
+        self.assertEquals([], list(self.outbox.pending()))
+
+    def test_give_up(self):
+        self.server.reject.add("jelmer@samba.org")
+        self.outbox.queue(notice("charis"))
+        now = 1000
+        for i in range(MAX_ATTEMPTS):
+            self.assertEquals((0, 1), self.outbox.send(self.smtp, now))
+            now += MAX_RETRY_DELAY
+        self.assertEquals([], list(self.outbox.pending()))
@@ -22,10 +22,17 @@ from buildfarm.build import (
     )
 from buildfarm.tests import BuildFarmTestCase
 from buildfarm.tests.test_hostdb import HostDatabaseTests
+from buildfarm.hostdb import NoSuchHost
 from buildfarm.sqldb import (
     StormHostDatabase,
+    StormLatestBuild,
+    StormTestResult,
+    memory_store,
+    upgrade_schema,
     )
 
+from storm.database import create_database
+from storm.store import Store
 import testtools
 
 
@@ -36,4 +43,76 @@ class StormHostDatabaseTests(testtools.TestCase, HostDatabaseTests):
         self.db = StormHostDatabase()
 
 
+class UpgradeSchemaTests(testtools.TestCase):
 
+    def test_migrate_build_status(self):
+        store = memory_store()
+        store.execute("PRAGMA user_version = 0", noresult=True)
+        store.execute("INSERT INTO build (id, tree, host, compiler, status) "
+            "VALUES (1, 'tdb', 'charis', 'cc', ?)",
+            ("BuildStatus([BuildStageResult(name='CONFIGURE', result=0), "
+             "BuildStageResult(name='TEST', result=2)], set(['panic']))", ),
+            noresult=True)
+        upgrade_schema(store)
+        self.assertEquals("CONFIGURE=0/TEST=2|panic",
+            str(store.execute("SELECT status FROM build").get_one()[0]))
+        self.assertEquals([("CONFIGURE", 0), ("TEST", 2)],
+            [(str(name), result) for (name, result) in store.execute(
+                "SELECT name, result FROM build_stage ORDER BY id")])
+
+    def test_migrate_blob_columns(self):
+        store = memory_store()
+        store.execute("PRAGMA user_version = 1", noresult=True)
+        store.execute("INSERT INTO host (name) VALUES ('charis')",
+            noresult=True)
+        self.assertRaises(NoSuchHost, StormHostDatabase(store).__getitem__,
+            "charis")
+        upgrade_schema(store)
+        self.assertEquals("blob",
+            store.execute("SELECT typeof(name) FROM host").get_one()[0])
+        self.assertEquals("charis", StormHostDatabase(store)["charis"].name)
+
+    def test_add_err_columns(self):
+        store = Store(create_database("sqlite:"))
+        store.execute("CREATE TABLE build (id integer primary key, "
+            "tree blob, host blob, compiler blob)", noresult=True)
+        store.execute("PRAGMA user_version = 3", noresult=True)
+        upgrade_schema(store)
+        store.execute("INSERT INTO build (id, err_count, err_size) "
+            "VALUES (1, 3, 20)", noresult=True)
+        self.assertEquals(4,
+            store.execute("PRAGMA user_version").get_one()[0])
+
+    def test_populate_latest_build(self):
+        store = memory_store()
+        store.execute("PRAGMA user_version = 2", noresult=True)
+        for (build_id, age) in [(1, 10), (2, 30), (3, 20)]:
+            store.execute("INSERT INTO build (id, tree, host, compiler, age) "
+                "VALUES (?, ?, ?, ?, ?)", (build_id, "tdb", "charis", "cc", age),
+                noresult=True)
+        store.execute("DELETE FROM latest_build", noresult=True)
+        upgrade_schema(store)
+        self.assertEquals([(2, 30)],
+            list(store.execute("SELECT build, age FROM latest_build")))
+
+
+class ReferenceTests(testtools.TestCase):
+
+    def setUp(self):
+        super(ReferenceTests, self).setUp()
+        self.store = memory_store()
+        self.store.execute("INSERT INTO build (id, tree, host, compiler, age) "
+            "VALUES (1, ?, ?, ?, 10)", ("tdb", "charis", "cc"), noresult=True)
+
+    def test_latest_build(self):
+        latest = self.store.find(StormLatestBuild).one()
+        self.assertEquals(1, latest.build.id)
+
+    def test_test_result(self):
+        self.store.execute("INSERT INTO test (id, name) VALUES (1, ?)",
+            ("foo", ), noresult=True)
+        self.store.execute("INSERT INTO test_result (build, test, result) "
+            "VALUES (1, 1, 0)", noresult=True)
+        result = self.store.find(StormTestResult).one()
+        self.assertEquals(1, result.build.id)
+        self.assertEquals("foo", result.test.name)
@@ -16,6 +16,7 @@
 #   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 import os
+import shutil
 import tempfile
 import testtools
 import unittest
@@ -67,3 +68,61 @@ class SambaWebFileLoadTest(testtools.TestCase):
         l1 = util.SambaWebFileLoad(os.path.dirname(os.path.realpath("name1")),name1)
         self.assertEquals('', l1)
 
+
+
+class FileLoadCacheTests(testtools.TestCase):
+
+    def setUp(self):
+        super(FileLoadCacheTests, self).setUp()
+        fd, self.name = tempfile.mkstemp()
+        self.addCleanup(os.remove, self.name)
+        os.close(fd)
+        self.write("one")
+        self.cache = util.FileLoadCache(check_interval=0)
+        self.loads = 0
+
+    def write(self, contents, mtime=1000):
+        f = open(self.name, 'w')
+        try:
+            f.write(contents)
+        finally:
+            f.close()
+        os.utime(self.name, (mtime, mtime))
+
+    def load(self, deps):
+        self.loads += 1
+        return util.FileLoad(self.name, deps)
+
+    def test_reused(self):
+        self.assertEquals("one", self.cache.get("foo", self.load))
+        self.assertEquals("one", self.cache.get("foo", self.load))
+        self.assertEquals(1, self.loads)
+
+    def test_changed(self):
+        self.assertEquals("one", self.cache.get("foo", self.load))
+        self.write("two", mtime=2000)
+        self.assertEquals("two", self.cache.get("foo", self.load))
+        self.assertEquals(2, self.loads)
+
+    def test_check_interval(self):
+        self.cache.check_interval = 3600
+        self.assertEquals("one", self.cache.get("foo", self.load))
+        self.write("two", mtime=2000)
+        self.assertEquals("one", self.cache.get("foo", self.load))
+
+    def test_samba_web_includes(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        f = open(os.path.join(path, "main.html"), 'w')
+        try:
+            f.write('<!--#include virtual="/samba/included.html" -->')
+        finally:
+            f.close()
+        load = lambda deps: util.SambaWebFileLoad(path, "main.html", deps)
+        self.assertEquals("", self.cache.get("main", load))
+        f = open(os.path.join(path, "included.html"), 'w')
+        try:
+            f.write("included")
+        finally:
+            f.close()
+        self.assertEquals("included", self.cache.get("main", load))
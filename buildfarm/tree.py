@@ -28,7 +28,8 @@ GIT_ROOT = "/data/git"
 class Tree(object):
     """A tree to build."""
 
-    def __init__(self, name, scm, repo, branch, subdir="", srcdir=""):
+    def __init__(self, name, scm, repo, branch, subdir="", srcdir="",
+                 history_index=None):
         self.name = name
         self.repo = repo
         self.scm = scm
@@ -36,10 +37,12 @@ class Tree(object):
         self.subdir = subdir
         self.srcdir = srcdir
         self.scm = scm
+        self.history_index = history_index
 
     def get_branch(self):
         if self.scm == "git":
-            return GitBranch(os.path.join(GIT_ROOT, self.repo), self.branch)
+            return GitBranch(os.path.join(GIT_ROOT, self.repo), self.branch,
+                index_path=self.history_index)
         else:
             raise NotImplementedError(self.scm)
 
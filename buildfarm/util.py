@@ -19,6 +19,7 @@
 
 import re
 import os
+import time
 
 def load_list(fname):
     """load a list from a file, using : to separate"""
@@ -35,36 +36,92 @@ def load_list(fname):
     return ret
 
 
-def FileLoad(filename):
-    """read a file into a string"""
+def file_stamp(path):
+    """get the mtime and size of a file, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def FileLoad(filename, deps=None):
+    """read a file into a string
+
+    :param deps: Optional list to add the path and stamp of the file to
+    """
+    if deps is not None:
+        deps.append((filename, file_stamp(filename)))
     f = open(filename, 'r')
     try:
         return f.read()
     finally:
         f.close()
 
-def SambaWebFileLoad(webdir, filename):
-    """loads file and changes the links to suit buildfarm"""
+def SambaWebFileLoad(webdir, filename, deps=None):
+    """loads file and changes the links to suit buildfarm
+
+    :param deps: Optional list to add the paths and stamps of the file and
+        the files it includes to
+    """
+    def load(path):
+        if deps is not None:
+            deps.append((path, file_stamp(path)))
+        f = open(path, 'r')
+        try:
+            return f.read()
+        finally:
+            f.close()
     try:
-        f = open(os.path.join(webdir, filename), 'r')
-        text = f.read()
+        text = load(os.path.join(webdir, filename))
     except IOError:
         return ''
-    else:
-        f.close()
     def add_virtual_headers(m):
         try:
-            f = open(os.path.join(webdir, m.group(1)), 'r')
-            text = f.read()
+            return load(os.path.join(webdir, m.group(1)))
         except:
             return ''
-        else:
-            f.close()
-            return text
     text = re.sub('<!--#include virtual="/samba/(.*)" -->',add_virtual_headers , text)
     text = re.sub('href="/samba', 'href="http://www.samba.org/samba', text)
     return text
 
+
+class FileLoadCache(object):
+    """Keeps values computed from files around until one of the files
+    changes.
+    """
+
+    def __init__(self, check_interval=1):
+        """Create a new cache.
+
+        :param check_interval: Minimum number of seconds between checks
+            whether the files of an entry have changed
+        """
+        self.check_interval = check_interval
+        self._entries = {}
+
+    def get(self, key, load):
+        """Look up a value, computing it if it is missing or out of date.
+
+        :param key: Key of the value
+        :param load: Function that computes the value; it is passed a list
+            to add the paths and stamps of the files it reads to, as the
+            deps argument of `FileLoad` and `SambaWebFileLoad` does
+        """
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            (checked, deps, value) = entry
+            if now - checked < self.check_interval:
+                return value
+            if all(file_stamp(path) == stamp for (path, stamp) in deps):
+                self._entries[key] = (now, deps, value)
+                return value
+        deps = []
+        value = load(deps)
+        self._entries[key] = (now, deps, value)
+        return value
+
 def dhm_time(sec):
     """display a time as days, hours, minutes"""
     days = int(sec / (60*60*24));
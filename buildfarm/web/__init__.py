@@ -31,7 +31,12 @@
 # TODO: Allow filtering of the "Recent builds" list to show
 # e.g. only broken builds or only builds that you care about.
 
-from collections import defaultdict
+import bz2
+from collections import defaultdict, deque
+from cStringIO import StringIO
+from email.utils import formatdate, mktime_tz, parsedate_tz
+import gzip
+import json
 import os
 import sys
 
@@ -39,10 +44,16 @@ from buildfarm import (
     hostdb,
     util,
     )
+from buildfarm.cache import FileCache
+from buildfarm.history import re_author
 from buildfarm.build import (
+    FLAKINESS_WINDOW,
+    FLAKY_MIN_FLIPS,
     LogFileMissing,
     NoSuchBuildError,
     NoTestOutput,
+    compare_test_results,
+    iter_test_output,
     )
 
 import cgi
@@ -50,6 +61,7 @@ from pygments import highlight
 from pygments.lexers.text import DiffLexer
 from pygments.formatters import HtmlFormatter
 import re
+import tempfile
 import time
 
 import wsgiref.util
@@ -57,6 +69,15 @@ webdir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "we
 
 GITWEB_BASE = "//gitweb.samba.org"
 HISTORY_HORIZON = 1000
+RENDER_CACHE_SIZE = 256 * 1024 * 1024
+DIFF_CACHE_SIZE = 64 * 1024 * 1024
+# Diffs larger than this are not highlighted or cached
+MAX_DIFF_SIZE = 1024 * 1024
+STREAM_BLOCK_SIZE = 64 * 1024
+# Bounds for the max-age of pages that change when new builds come in.
+MIN_PAGE_MAX_AGE = 10
+MAX_PAGE_MAX_AGE = 300
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
 
 # this is automatically filled in
 deadhosts = []
@@ -85,6 +106,144 @@ def get_param(form, param):
     return result[0]
 
 
+def get_count_param(form, param):
+    """get a non-negative number from the request, or None if it is missing
+    or not a number"""
+    value = get_param(form, param)
+    if value is None:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return None
+
+
+def get_paging_params(form):
+    """get the limit and offset parameters from the request
+
+    Missing or invalid parameters fall back to the defaults: no limit and
+    no offset. An offset is only used together with a limit.
+    """
+    limit = get_count_param(form, "limit")
+    offset = get_count_param(form, "offset")
+    if offset is None or limit is None:
+        offset = 0
+    return (limit, offset)
+
+
+def accepts_encoding(environ, encoding):
+    """check whether the client accepts a particular content encoding"""
+    for item in environ.get('HTTP_ACCEPT_ENCODING', '').split(","):
+        params = [p.strip() for p in item.split(";")]
+        if params[0].lower() != encoding:
+            continue
+        for p in params[1:]:
+            if p.startswith("q="):
+                try:
+                    return float(p[2:]) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def is_not_modified(environ, etag, last_modified):
+    """check whether the client already has the current version of a resource
+
+    :param etag: ETag of the resource
+    :param last_modified: Time the resource was last modified
+    """
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag in ("*", etag.replace("W/", "", 1)):
+                return True
+        return False
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        date = parsedate_tz(if_modified_since)
+        if date is not None:
+            return last_modified <= mktime_tz(date)
+    return False
+
+
+def iter_file(f, block_size=STREAM_BLOCK_SIZE):
+    """Iterate over the contents of a file in blocks, closing it afterwards."""
+    try:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+
+def join_chunks(lines, block_size=STREAM_BLOCK_SIZE):
+    """Join lines into chunks of roughly block_size bytes."""
+    chunk = []
+    size = 0
+    for l in lines:
+        chunk.append(l)
+        size += len(l)
+        if size >= block_size:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield "".join(chunk)
+
+
+def build_test_output(build):
+    """Extract the test output of a build while it is being sent."""
+    try:
+        f = build.read_log()
+    except LogFileMissing:
+        yield "There was no test output"
+        return
+    try:
+        try:
+            for l in iter_test_output(f):
+                yield l
+        except NoTestOutput:
+            yield "There was no test output"
+    finally:
+        f.close()
+
+
+def file_response(environ, start_response, path, compression, headers):
+    """Send the contents of a file.
+
+    Compressed files are sent as they are if the client accepts their
+    compression as content encoding, and decompressed on the fly otherwise.
+
+    :param path: Path of the file
+    :param compression: Compression of the file ("bzip2", "gzip" or None)
+    :param headers: Headers to send
+    """
+    headers = list(headers)
+    if compression is not None:
+        headers.append(('Vary', 'Accept-Encoding'))
+    if compression is None or accepts_encoding(environ, compression):
+        f = open(path, 'rb')
+        headers.append(('Content-Length', str(os.fstat(f.fileno()).st_size)))
+        if compression is not None:
+            headers.append(('Content-Encoding', compression))
+        start_response('200 OK', headers)
+        if 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](f, STREAM_BLOCK_SIZE)
+        return iter_file(f)
+    if compression == "bzip2":
+        f = bz2.BZ2File(path, 'r')
+    else:
+        f = gzip.open(path, 'rb')
+    start_response('200 OK', headers)
+    return iter_file(f)
+
+
 def html_build_status(status):
     def span(classname, contents):
         return "<span class=\"%s\">%s</span>" % (classname, contents)
@@ -182,97 +341,410 @@ def format_subunit_reason(reason):
 
 
 class LogPrettyPrinter(object):
+    """Pretty printer for build logs.
 
-    def __init__(self):
-        self.indice = 0
+    The log is rewritten by a pipeline of passes, each of which is a generator
+    that reads and yields lines. Every pass looks at each line a bounded
+    number of times, so rendering takes time linear in the size of the log.
+
+    Collapsible sections are numbered pass by pass. Since the number of
+    sections created by each pass is only known once the whole log has been
+    read, the ids are filled in at the end.
+    """
+
+    _action_start_re = re.compile("Running action\s+([\w\-]+)$")
+    _action_end_re = re.compile("ACTION (PASSED|FAILED): [\w\-]+$")
 
-    def _pretty_print(self, m):
-        output = m.group(1)
-        actionName = m.group(2)
-        status = m.group(3)
-        # handle pretty-printing of static-analysis tools
-        if actionName == 'cc_checker':
-             output = print_log_cc_checker(output)
+    # Old-style test stages; these have to be indented exactly like this.
+    _stage_res = [
+        re.compile(" {14}--==--==--==--==--==--==--==--==--==--==--"),
+        re.compile(" {14}Running test ([\w\-=,_:\ /.&;]+)"),
+        re.compile(" {14}--==--==--==--==--==--==--==--==--==--==--$"),
+        re.compile(" {18}(.*)"),
+        re.compile(" {14}=========================================="),
+        re.compile(" {14}TEST (FAILED|PASSED|SKIPPED):"),
+        re.compile(" {14}==========================================(\s*)$"),
+        ]
+    _stage_start = " " * 14 + "--=="
+    _whitespace_re = re.compile("\s*")
 
-        self.indice += 1
-        return "".join(make_collapsible_html('action', actionName, output, self.indice, status))
+    _skip_testsuite_re = re.compile("skip-testsuite: ([\w\-=,_:\ /.&; \(\)]+).*?")
+    _testsuite_end_re = re.compile("testsuite-(\w+): ")
 
-    # log is already CGI-escaped, so handle '>' in test name by handling &gt
-    def _format_stage(self, m):
-        self.indice += 1
-        return "".join(make_collapsible_html('test', m.group(1), m.group(2), self.indice, m.group(3)))
+    # The log is escaped, so this can not occur in it
+    _id_re = re.compile("<#(\d+):(\d+)>")
+
+    def __init__(self):
+        self.indice = 0
+
+    def _next_id(self, i):
+        """Allocate an id for a collapsible section.
+
+        :param i: Index of the pass creating the section
+        :return: Placeholder for the id
+        """
+        self._counts[i] += 1
+        return "<#%d:%d>" % (i, self._counts[i])
+
+    def _collapsible_lines(self, prefix, type, title, output, id, status=""):
+        html = "".join(make_collapsible_html(type, title, output, id, status))
+        return (prefix + html).split("\n")
+
+    def _format_actions(self, lines):
+        """Collapse everything from "Running action" to "ACTION PASSED/FAILED".
+        """
+        block = None
+        for l in lines:
+            if block is None:
+                m = "Running action" in l and self._action_start_re.search(l)
+                if not m:
+                    yield l
+                    continue
+                prefix = l[:m.start()]
+                action_name = m.group(1)
+                block = [l[m.start():]]
+                continue
+            block.append(l)
+            m = l.startswith("ACTION ") and self._action_end_re.match(l)
+            if not m:
+                continue
+            output = "\n".join(block)
+            # handle pretty-printing of static-analysis tools
+            if action_name == 'cc_checker':
+                output = print_log_cc_checker(output)
+            for x in self._collapsible_lines(prefix, 'action', action_name,
+                    output, self._next_id(0), m.group(1)):
+                yield x
+            block = None
+        if block is not None:
+            # The last action was never finished
+            yield prefix + block[0]
+            for l in block[1:]:
+                yield l
+
+    def _match_stage(self, window, fill):
+        """Check whether an old-style test stage starts at the next line.
+
+        :param window: Lines after the current line
+        :param fill: Function to read up to a given number of lines into
+            the window
+        :return: None, or tuple with the HTML for the stage, the number of
+            lines it takes up and what is left of the last of those lines
+        """
+        if not fill(len(self._stage_res)):
+            return None
+        groups = []
+        for (regex, l) in zip(self._stage_res, window):
+            m = regex.match(l)
+            if m is None:
+                return None
+            groups.extend(m.groups())
+        (title, output, status, trailing) = groups
+        # The stage ends with whitespace, followed by a line break and
+        # twelve spaces. The whitespace can span multiple lines.
+        i = len(self._stage_res)
+        end = None
+        line_break_ok = (trailing != "")
+        while fill(i + 1):
+            if line_break_ok and window[i].startswith(" " * 12):
+                end = i
+            if self._whitespace_re.match(window[i]).end() < len(window[i]):
+                break
+            line_break_ok = True
+            i += 1
+        if end is None:
+            return None
+        html = "".join(make_collapsible_html('test', title, output,
+            self._next_id(1), status))
+        return (html, end + 1, window[end][12:])
+
+    def _format_stages(self, lines):
+        """Collapse the output of old-style test stages.
+
+        These take up the line break before them, so are appended to the
+        previous line.
+        """
+        lines = iter(lines)
+        window = deque()
+        def fill(n):
+            while len(window) < n:
+                l = next(lines, None)
+                if l is None:
+                    return False
+                window.append(l)
+            return True
+        line = next(lines, None)
+        if line is None:
+            return
+        for l in lines:
+            window.append(l)
+            while window:
+                if window[0].startswith(self._stage_start):
+                    m = self._match_stage(window, fill)
+                    if m is not None:
+                        (html, count, rest) = m
+                        for i in range(count):
+                            window.popleft()
+                        line += html + rest
+                        continue
+                yield line
+                line = window.popleft()
+        yield line
+
+    def _format_pretestsuite(self, lines):
+        """Collapse the output of the test action before the first testsuite.
+        """
+        block = None
+        for l in lines:
+            pos = 0
+            if block is not None:
+                if l.startswith("testsuite: "):
+                    pos = len("testsuite: ")
+                elif l.startswith("skip-testsuite: "):
+                    pos = len("skip-testsuite: ")
+                else:
+                    block.append(l)
+                    continue
+                for x in self._collapsible_lines(
+                        start_line[:start] + "Running action test", 'pretest',
+                        'Pretest infos', "".join([x + "\n" for x in block]),
+                        self._next_id(2), 'ok'):
+                    yield x
+                block = None
+            start = l.find("Running action test", pos)
+            if start == -1:
+                yield l
+            else:
+                start_line = l
+                block = []
+        if block is not None:
+            # There was no testsuite after the test action
+            yield start_line
+            for l in block:
+                yield l
 
     def _format_skip_testsuite(self, m):
-        self.indice += 1
-        return "".join(make_collapsible_html('test', m.group(1), '', self.indice, 'skipped'))
-
-    def _format_pretestsuite(self, m):
-        self.indice += 1
-        return m.group(1)+"".join(make_collapsible_html('pretest', 'Pretest infos', m.group(2), self.indice, 'ok'))+"\n"+m.group(3)
-
-    def _format_testsuite(self, m):
-        testName = m.group(1)
-        content = m.group(2)
-        status = subunit_to_buildfarm_result(m.group(3))
-        if m.group(4):
-            errorReason = format_subunit_reason(m.group(4))
+        return "".join(make_collapsible_html('test', m.group(1), '',
+            self._next_id(3), 'skipped'))
+
+    def _format_skip_testsuites(self, lines):
+        """Collapse skipped testsuites."""
+        for l in lines:
+            if "skip-testsuite: " in l:
+                l = self._skip_testsuite_re.sub(self._format_skip_testsuite, l)
+            yield l
+
+    def _testsuite_lines(self, name, content, result, reason):
+        if reason:
+            errorReason = format_subunit_reason(reason)
         else:
             errorReason = ""
-        self.indice += 1
+        id = self._next_id(4)
         backlink = ""
-        if m.group(3) in ("error", "failure"):
-            self.test_links.append([testName, 'lnk-test-%d' %self.indice])
+        if result in ("error", "failure"):
+            self.test_links.append((name, id))
             backlink = "<p><a href='#shortcut2errors'>back to error list</a>"
-        return "".join(make_collapsible_html('test', testName, content+errorReason+backlink, self.indice, status))
-
-    def _format_test(self, m):
-        self.indice += 1
-        return "".join(make_collapsible_html('test', m.group(1), m.group(2)+format_subunit_reason(m.group(4)), self.indice, subunit_to_buildfarm_result(m.group(3))))
-
-    def pretty_print(self, log):
-        # do some pretty printing for the actions
-        pattern = re.compile("(Running action\s+([\w\-]+)$(?:\s^.*$)*?\sACTION\ (PASSED|FAILED):\ ([\w\-]+)$)", re.M)
-        log = pattern.sub(self._pretty_print, log)
-        buf = ""
-
-        log = re.sub("""
-              --==--==--==--==--==--==--==--==--==--==--.*?
-              Running\ test\ ([\w\-=,_:\ /.&;]+).*?
-              --==--==--==--==--==--==--==--==--==--==--
-                  (.*?)
-              ==========================================.*?
-              TEST\ (FAILED|PASSED|SKIPPED):.*?
-              ==========================================\s+
-            """, self._format_stage, log)
-
-        pattern = re.compile("(Running action test).*$\s((?:^.*$\s)*?)^((?:skip-)?testsuite: )", re.M)
-        log = pattern.sub(self._format_pretestsuite, log)
-
-        log = re.sub("skip-testsuite: ([\w\-=,_:\ /.&; \(\)]+).*?",
-                self._format_skip_testsuite, log)
-
+        output = "".join([l + "\n" for l in content])
+        return self._collapsible_lines("", 'test', name,
+            output+errorReason+backlink, id, subunit_to_buildfarm_result(result))
+
+    def _format_testsuites(self, lines, reason_unclosed=False):
+        """Collapse testsuites, along with the reason they failed.
+
+        :param reason_unclosed: Whether it is known that none of the lines
+            closes a failure reason
+        """
+        name = None
+        reason = None
+        for l in lines:
+            if reason is not None:
+                if l != "]":
+                    reason.append(l)
+                    continue
+                reason = "\n".join(["["] + reason + ["]"])
+                for x in self._testsuite_lines(name, content, result, reason):
+                    yield x
+                name = reason = None
+            elif name is not None:
+                m = l.startswith("testsuite-") and self._testsuite_end_re.match(l)
+                if not m:
+                    content.append(l)
+                    continue
+                result = m.group(1)
+                if (not reason_unclosed and l.endswith("[") and
+                    len(l) > m.end()):
+                    reason = []
+                    continue
+                for x in self._testsuite_lines(name, content, result, None):
+                    yield x
+                name = None
+            elif l.startswith("testsuite: ") and l != "testsuite: ":
+                name = l[len("testsuite: "):]
+                content = []
+            else:
+                yield l
+        if reason is not None:
+            # The reason was never closed, so it is just part of the log
+            for x in self._testsuite_lines(name, content, result, None):
+                yield x
+            for x in self._format_testsuites(reason, True):
+                yield x
+        elif name is not None:
+            # The last testsuite was never finished
+            yield "testsuite: " + name
+            for l in content:
+                yield l
+
+    def iter_pretty_print(self, lines):
+        """Pretty print a log.
+
+        :param lines: Iterator over the (CGI-escaped) lines of the log,
+            without line endings
+        :return: Iterator over HTML chunks
+        """
+        self._counts = [0] * 5
         self.test_links = []
-        pattern = re.compile("^testsuite: (.+)$\s((?:^.*$\s)*?)testsuite-(\w+): .*?(?:(\[$\s(?:^.*$\s)*?^\]$)|$)", re.M)
-        log = pattern.sub(self._format_testsuite, log)
-        log = re.sub("""
-              ^test: ([\w\-=,_:\ /.&; \(\)]+).*?
-              (.*?)
-              (success|xfail|failure|skip|uxsuccess): [\w\-=,_:\ /.&; \(\)]+( \[.*?\])?.*?
-           """, self._format_test, log)
-
-        for tst in self.test_links:
-            buf = "%s\n<A href='#%s'>%s</A>" % (buf, tst[1], tst[0])
 
+        lines = self._format_actions(lines)
+        lines = self._format_stages(lines)
+        lines = self._format_pretestsuite(lines)
+        lines = self._format_skip_testsuites(lines)
+        lines = self._format_testsuites(lines)
+
+        # The ids of the collapsible sections and the shortcuts to the
+        # failed tests are only known once the whole log has been
+        # formatted, but are needed from the start. Rather than keeping
+        # the formatted log in memory, spool it to disk and send it from
+        # there. The placeholders for the ids never span lines.
+        spool = tempfile.TemporaryFile()
+        try:
+            for i, l in enumerate(lines):
+                if i > 0:
+                    spool.write("\n")
+                spool.write(l)
+            spool.seek(0)
+            for chunk in self._pretty_print_spooled(spool):
+                yield chunk
+        finally:
+            spool.close()
+
+    def _pretty_print_spooled(self, spool):
+        bases = [0]
+        for count in self._counts[:-1]:
+            bases.append(bases[-1] + count)
+        self.indice = bases[-1] + self._counts[-1]
+        def resolve_ids(text):
+            return self._id_re.sub(
+                lambda m: str(bases[int(m.group(1))] + int(m.group(2))), text)
+
+        buf = "".join(["\n<A href='#lnk-test-%s'>%s</A>" % (id, name)
+            for (name, id) in self.test_links])
         if not buf == "":
+            buf = resolve_ids(buf)
             divhtml = "".join(make_collapsible_html('testlinks', 'Shortcut to failed tests', "<a name='shortcut2errors'></a>%s" % buf, self.indice, ""))+"\n"
-            log = re.sub("Running action\s+test", divhtml, log)
-        return "<pre>%s</pre>" % log
+
+        yield "<pre>"
+        for l in spool:
+            if "<#" in l:
+                l = resolve_ids(l)
+            if not buf == "" and "Running action" in l:
+                l = re.sub("Running action\s+test", divhtml, l)
+            yield l
+        yield "</pre>"
+
+    def pretty_print(self, log):
+        return "".join(self.iter_pretty_print(log.split("\n")))
 
 
 def print_log_pretty(log):
     return LogPrettyPrinter().pretty_print(log)
 
 
+def split_lines(f):
+    """Iterate over the lines in a file, without line endings.
+
+    Like str.split("\\n"), this yields an empty string after a final newline.
+    """
+    l = ""
+    for l in f:
+        if l.endswith("\n"):
+            yield l[:-1]
+        else:
+            yield l
+    if l == "" or l.endswith("\n"):
+        yield ""
+
+
+def read_log_lines(build):
+    """Iterate over the CGI-escaped lines of the log of a build.
+
+    :raise LogFileMissing: if the build has no log
+    """
+    f = build.read_log()
+    try:
+        for l in split_lines(f):
+            yield cgi.escape(l)
+    finally:
+        f.close()
+
+
+def find_build_info(lines):
+    """Find the uname, CFLAGS and configure options in a build log.
+
+    :param lines: Iterator over the lines of the log
+    :return: Tuple with uname, CFLAGS, configure options and whether
+        the log is empty
+    """
+    uname = None
+    cflags = None
+    config = None
+    empty = True
+    for l in lines:
+        if uname is None:
+            uname = l
+            empty = (l == "")
+        else:
+            empty = False
+        if cflags is None:
+            m = re.search("CFLAGS=(.*)", l)
+            if m:
+                cflags = m.group(1)
+        if config is None:
+            m = re.search("configure options: (.*)", l)
+            if m:
+                config = m.group(1)
+        if cflags is not None and config is not None:
+            break
+    if empty:
+        return (None, None, None, True)
+    return (uname, cflags, config, False)
+
+
+def encode_rendered_logs(uname, cflags, config, html):
+    """Serialize the result of `ViewBuildPage.render_logs` for the cache."""
+    lines = []
+    for value in (uname, cflags, config):
+        if value is None:
+            lines.append("")
+        else:
+            lines.append("=" + value)
+    lines.append(html)
+    return "\n".join(lines)
+
+
+def decode_rendered_logs(text):
+    """Parse the output of `encode_rendered_logs`."""
+    fields = text.split("\n", 3)
+    ret = []
+    for value in fields[:3]:
+        if value == "":
+            ret.append(None)
+        else:
+            ret.append(value[1:])
+    ret.append(fields[3])
+    return tuple(ret)
+
+
 def print_log_cc_checker(input):
     # generate pretty-printed html for static analysis tools
     output = ""
@@ -384,6 +856,25 @@ def history_row_text(entry, tree, changes):
     yield "\n\n%s\n\n\n" % msg
 
 
+def test_results_diff_text(diff):
+    """Describe the differences between the test results of two builds."""
+    if not diff:
+        yield "No differences in test results.\n"
+        return
+    for (title, entries) in [("Newly failing tests", diff.newly_failing),
+                             ("Newly passing tests", diff.newly_passing)]:
+        if entries:
+            yield "%s:\n" % title
+            for (name, old, new) in entries:
+                yield "    %s (%s -> %s)\n" % (name, old, new)
+    for (title, entries) in [("Added tests", diff.added),
+                             ("Removed tests", diff.removed)]:
+        if entries:
+            yield "%s:\n" % title
+            for (name, result) in entries:
+                yield "    %s: %s\n" % (name, result)
+
+
 class BuildFarmPage(object):
 
     def __init__(self, buildfarm):
@@ -432,41 +923,133 @@ class ViewBuildPage(BuildFarmPage):
 
         yield "<p><a href='%s/limit/-1'>Show all previous build list</a>\n" % (build_uri(myself, build))
 
-    def render(self, myself, build, plain_logs=False, limit=10):
-        """view one build in detail"""
+    # Bump this whenever the HTML produced by render_logs changes, so that
+    # stale entries in the render cache are no longer used.
+    render_version = 1
+
+    def __init__(self, buildfarm, cache=None):
+        """Create a new build page.
+
+        :param buildfarm: BuildFarm instance
+        :param cache: Optional FileCache for the rendered logs
+        """
+        super(ViewBuildPage, self).__init__(buildfarm)
+        self.cache = cache
+
+    def render_logs(self, build, plain_logs=False):
+        """Render the error and build log of a build.
 
+        :return: Tuple with the uname, CFLAGS and configure options found in
+            the build log, and the HTML for the logs.
+        """
         uname = None
         cflags = None
         config = None
 
         try:
-            f = build.read_log()
+            lines = read_log_lines(build)
             try:
-                log = f.read()
+                (uname, cflags, config, log_empty) = find_build_info(lines)
             finally:
-                f.close()
+                lines.close()
         except LogFileMissing:
-            log = None
+            log_exists = False
+        else:
+            log_exists = True
         f = build.read_err()
         try:
             err = f.read()
         finally:
             f.close()
 
-        if log:
-            log = cgi.escape(log)
+        err = cgi.escape(err)
+        html = []
+        if not plain_logs:
+            # These can be pretty wide -- perhaps we need to
+            # allow them to wrap in some way?
+            if err == "":
+                html.append("<h2>No error log available</h2>\n")
+            else:
+                html.append("<h2>Error log:</h2>")
+                html.extend(make_collapsible_html('action', "Error Output", "\n%s" % err, "stderr-0", "errorlog"))
 
-            m = re.search("(.*)", log)
-            if m:
-                uname = m.group(1)
-            m = re.search("CFLAGS=(.*)", log)
-            if m:
-                cflags = m.group(1)
-            m = re.search("configure options: (.*)", log)
-            if m:
-                config = m.group(1)
+            if not log_exists:
+                html.append("<h2>No build log available</h2>")
+            else:
+                html.append("<h2>Build log:</h2>\n")
+                html.extend(LogPrettyPrinter().iter_pretty_print(
+                    read_log_lines(build)))
+        else:
+            if err == "":
+                html.append("<h2>No error log available</h2>")
+            else:
+                html.append('<h2>Error log:</h2>\n')
+                html.append('<div id="errorLog"><pre>%s</pre></div>' % err)
+            if not log_exists or log_empty:
+                html.append('<h2>No build log available</h2>')
+            else:
+                html.append('<h2>Build log:</h2>\n')
+                html.append('<div id="buildLog"><pre>')
+                html.append("\n".join(read_log_lines(build)))
+                html.append('</pre></div>')
+        return (uname, cflags, config, "".join(html))
+
+    def get_rendered_logs(self, build, plain_logs=False):
+        """Render the logs of a build, using the logs prerendered at import
+        time or the render cache if possible.
+
+        Builds are identified by the checksum of their log, so cache entries
+        never have to be invalidated.
+
+        :return: Same as `render_logs`
+        """
+        if not plain_logs:
+            ret = self.read_prerendered_logs(build)
+            if ret is not None:
+                return ret
+        if self.cache is None:
+            return self.render_logs(build, plain_logs)
+        key = "%s-%d-%s" % (build.log_checksum(), self.render_version,
+            plain_logs and "plain" or "enhanced")
+        cached = self.cache.get(key)
+        if cached is not None:
+            return decode_rendered_logs(cached)
+        ret = self.render_logs(build, plain_logs)
+        self.cache.set(key, encode_rendered_logs(*ret))
+        return ret
+
+    def prerender_logs(self, build):
+        """Render the logs of a build ahead of time.
+
+        The enhanced view of the logs is stored next to the logs of the
+        build, where `get_rendered_logs` will pick it up.
+        """
+        build.write_sidecar("html", "%d\n%s" % (self.render_version,
+            encode_rendered_logs(*self.render_logs(build))))
+
+    def read_prerendered_logs(self, build):
+        """Read the logs of a build as stored by `prerender_logs`.
+
+        :return: Same as `render_logs`, or None if the logs have not been
+            prerendered by the current version of `render_logs`
+        """
+        f = build.read_sidecar("html")
+        if f is None:
+            return None
+        try:
+            (version, text) = f.read().split("\n", 1)
+        finally:
+            f.close()
+        if int(version) != self.render_version:
+            return None
+        return decode_rendered_logs(text)
+
+    def render(self, myself, build, plain_logs=False, limit=10):
+        """view one build in detail"""
+
+        (uname, cflags, config, logs_html) = self.get_rendered_logs(build,
+            plain_logs)
 
-        err = cgi.escape(err)
         yield '<h2>Host information:</h2>'
 
         host_web_file = "../web/%s.html" % build.host
@@ -505,7 +1088,7 @@ class ViewBuildPage(BuildFarmPage):
         except NoSuchBuildError:
             pass
         else:
-            yield ", <a href='%s/+subunit-diff/%s'>diff against previous</a>" % (
+            yield ", <a href='%s/+test-diff/%s'>changes since previous</a>" % (
                 build_uri(myself, build), previous_build.log_checksum())
         yield "</p>"
         yield "<p><a href='%s/+stdout'>Standard output (as plain text)</a>, " % build_uri(myself, build)
@@ -518,81 +1101,150 @@ class ViewBuildPage(BuildFarmPage):
                   " unstyled view'>Plain View</a></p>" % (myself, build.host, build.tree, build.compiler, rev_var)
 
             yield "<div id='actionList'>"
-            # These can be pretty wide -- perhaps we need to
-            # allow them to wrap in some way?
-            if err == "":
-                yield "<h2>No error log available</h2>\n"
-            else:
-                yield "<h2>Error log:</h2>"
-                yield "".join(make_collapsible_html('action', "Error Output", "\n%s" % err, "stderr-0", "errorlog"))
-
-            if log is None:
-                yield "<h2>No build log available</h2>"
-            else:
-                yield "<h2>Build log:</h2>\n"
-                yield print_log_pretty(log)
-
+            yield logs_html
             yield "<p><small>Some of the above icons derived from the <a href='//www.gnome.org'>Gnome Project</a>'s stock icons.</small></p>"
             yield "</div>"
         else:
             yield "<p>Switch to the <a href='%s?function=View+Build;host=%s;tree=%s;"\
                   "compiler=%s%s' title='Switch to colourful, javascript-enabled, styled"\
                   " view'>Enhanced View</a></p>" % (myself, build.host, build.tree, build.compiler, rev_var)
-            if err == "":
-                yield "<h2>No error log available</h2>"
-            else:
-                yield '<h2>Error log:</h2>\n'
-                yield '<div id="errorLog"><pre>%s</pre></div>' % err
-            if log == "":
-                yield '<h2>No build log available</h2>'
-            else:
-                yield '<h2>Build log:</h2>\n'
-                yield '<div id="buildLog"><pre>%s</pre></div>' % log
+            yield logs_html
 
         yield '</div>'
 
 
-class ViewRecentBuildsPage(BuildFarmPage):
+class TestDiffPage(BuildFarmPage):
+
+    def render(self, myself, old, new, diff):
+        """Draw the differences between the test results of two builds.
+
+        :param old: The older build
+        :param new: The newer build
+        :param diff: `TestResultsDiff` for the two builds
+        """
+        yield "<div id='test-diff' class='build-section'>"
+        yield "<h2>Test results of %s on %s with %s</h2>" % (
+            new.tree, host_link(myself, new.host), new.compiler)
+        yield "<p>Comparing <a href='%s'>revision %s</a> against <a href='%s'>revision %s</a> " % (
+            build_uri(myself, new), new.revision,
+            build_uri(myself, old), old.revision)
+        yield "(<a href='%s/+subunit-diff/%s'>as text</a>).</p>" % (
+            build_uri(myself, new), old.log_checksum())
+        if not diff:
+            yield "<p>No differences in test results.</p></div>"
+            return
+        for (title, entries) in [("Newly failing tests", diff.newly_failing),
+                                 ("Newly passing tests", diff.newly_passing)]:
+            if not entries:
+                continue
+            yield "<h3>%s</h3>" % title
+            yield "<table class='newtable'>"
+            yield "<thead><tr><th>Test</th><th>Old result</th><th>New result</th></tr></thead>"
+            yield "<tbody>"
+            for (name, old_result, new_result) in entries:
+                yield "<tr><td>%s</td><td>%s</td><td>%s</td></tr>" % (
+                    cgi.escape(name), old_result, new_result)
+            yield "</tbody></table>"
+        for (title, entries) in [("Added tests", diff.added),
+                                 ("Removed tests", diff.removed)]:
+            if not entries:
+                continue
+            yield "<h3>%s</h3>" % title
+            yield "<table class='newtable'>"
+            yield "<thead><tr><th>Test</th><th>Result</th></tr></thead>"
+            yield "<tbody>"
+            for (name, result) in entries:
+                yield "<tr><td>%s</td><td>%s</td></tr>" % (
+                    cgi.escape(name), result)
+            yield "</tbody></table>"
+        yield "</div>"
 
-    def render(self, myself, tree, sort_by=None):
-        """Draw the "recent builds" view"""
-        all_builds = []
 
-        def build_platform(build):
-            host = self.buildfarm.hostdb[build.host]
-            return host.platform.encode("utf-8")
+class FlakyTestsPage(BuildFarmPage):
+
+    def render(self, myself, tree, limit=100):
+        """Draw the list of the flakiest tests of a tree.
+
+        :param limit: Maximum number of tests to show
+        """
+        try:
+            t = self.buildfarm.trees[tree]
+        except KeyError:
+            yield "Unknown tree %s" % tree
+            return
+        flaky_tests = self.buildfarm.builds.get_flaky_tests(tree)[:limit]
+        yield "<div id='flaky-tests' class='build-section'>"
+        yield "<h2>Flaky tests in %s (%s branch %s)</h2>" % (tree, t.scm, t.branch)
+        if not flaky_tests:
+            yield "<p>No flaky tests.</p></div>"
+            return
+        yield "<p>Tests that changed between passing and failing at least "
+        yield "%d times in their last %d runs on a host.</p>" % (
+            FLAKY_MIN_FLIPS, FLAKINESS_WINDOW)
+        yield "<table class='newtable'>"
+        yield "<thead>"
+        yield "<tr>"
+        yield "<th>Test</th>"
+        yield "<th>Host</th>"
+        yield "<th>Compiler</th>"
+        yield "<th>Runs</th>"
+        yield "<th>Failures</th>"
+        yield "<th>Changes</th>"
+        yield "</tr>"
+        yield "</thead>"
+        yield "<tbody>"
+        for flaky in flaky_tests:
+            yield "<tr>"
+            yield "<td>%s</td>" % cgi.escape(flaky.test.name)
+            yield "<td>%s</td>" % host_link(myself, flaky.host)
+            yield "<td>%s</td>" % flaky.compiler
+            yield "<td>%d</td>" % flaky.runs
+            yield "<td>%d</td>" % flaky.failures
+            yield "<td>%d</td>" % flaky.flips
+            yield "</tr>"
+        yield "</tbody></table>"
+        yield "</div>"
 
-        def build_platform_safe(build):
-            try:
-                host = self.buildfarm.hostdb[build.host]
-            except hostdb.NoSuchHost:
-                return "UNKNOWN"
-            else:
-                return host.platform.encode("utf-8")
-
-        cmp_funcs = {
-            "revision": lambda a, b: cmp(a.revision, b.revision),
-            "age": lambda a, b: cmp(a.age, b.age),
-            "host": lambda a, b: cmp(a.host, b.host),
-            "platform": lambda a, b: cmp(build_platform_safe(a), build_platform_safe(b)),
-            "compiler": lambda a, b: cmp(a.compiler, b.compiler),
-            "status": lambda a, b: cmp(a.status(), b.status()),
-            }
 
+class ViewRecentBuildsPage(BuildFarmPage):
+
+    sort_keys = ("revision", "age", "host", "platform", "compiler", "status")
+
+    def render(self, myself, tree, sort_by=None, limit=None, offset=0):
+        """Draw the "recent builds" view
+
+        :param limit: Maximum number of builds to show, or None for all
+        :param offset: Number of builds to skip
+        """
         if sort_by is None:
             sort_by = "age"
 
-        if sort_by not in cmp_funcs:
+        if sort_by not in self.sort_keys:
             yield "not a valid sort mechanism: %r" % sort_by
             return
 
-        all_builds = list(self.buildfarm.get_tree_builds(tree))
-
-        all_builds.sort(cmp_funcs[sort_by])
+        if sort_by == "status":
+            # The status is not stored in a sortable form, so sort in Python;
+            # status() is only called once per build.
+            all_builds = list(self.buildfarm.get_tree_builds_with_platform(tree))
+            all_builds.sort(key=lambda (build, platform): build.status())
+        else:
+            all_builds = self.buildfarm.get_tree_builds_with_platform(tree,
+                sort_by)
+
+        if limit is not None:
+            # Fetch one extra build to find out whether there is a next page
+            all_builds = list(all_builds[offset:offset+limit+1])
+            has_next = (len(all_builds) > limit)
+            all_builds = all_builds[:limit]
+        else:
+            has_next = False
 
         t = self.buildfarm.trees[tree]
 
         sorturl = "%s?tree=%s;function=Recent+Builds" % (myself, tree)
+        if limit is not None:
+            sorturl += ";limit=%d" % limit
 
         yield "<div id='recent-builds' class='build-section'>"
         yield "<h2>Recent builds of %s (%s branch %s)</h2>" % (tree, t.scm, t.branch)
@@ -608,21 +1260,23 @@ class ViewRecentBuildsPage(BuildFarmPage):
         yield "<th><a href='%s;sortby=status' title='Sort by status'>Status</a></th>" % sorturl
         yield "<tbody>"
 
-        for build in all_builds:
-            try:
-                build_platform_name = build_platform(build)
-                yield "<tr>"
-                yield "<td>%s</td>" % util.dhm_time(build.age)
-                yield "<td>%s</td>" % revision_link(myself, build.revision, build.tree)
-                yield "<td>%s</td>" % build.tree
-                yield "<td>%s</td>" % build_platform_name
-                yield "<td>%s</td>" % host_link(myself, build.host)
-                yield "<td>%s</td>" % build.compiler
-                yield "<td>%s</td>" % build_link(myself, build)
-                yield "</tr>"
-            except hostdb.NoSuchHost:
-                pass
+        for build, platform in all_builds:
+            yield "<tr>"
+            yield "<td>%s</td>" % util.dhm_time(build.age)
+            yield "<td>%s</td>" % revision_link(myself, build.revision, build.tree)
+            yield "<td>%s</td>" % build.tree
+            yield "<td>%s</td>" % platform.encode("utf-8")
+            yield "<td>%s</td>" % host_link(myself, build.host)
+            yield "<td>%s</td>" % build.compiler
+            yield "<td>%s</td>" % build_link(myself, build)
+            yield "</tr>"
         yield "</tbody></table>"
+        if offset > 0:
+            yield "<a href='%s;sortby=%s;offset=%d'>Previous</a> " % (
+                sorturl, sort_by, max(0, offset - limit))
+        if has_next:
+            yield "<a href='%s;sortby=%s;offset=%d'>Next</a>" % (
+                sorturl, sort_by, offset + limit)
         yield "</div>"
 
 
@@ -702,13 +1356,19 @@ class ViewHostPage(BuildFarmPage):
         yield "<thead><tr><th>Host</th><th>OS</th><th>Min Age</th></tr></thead>"
         yield "<tbody>"
 
+        platforms = self.buildfarm.hostdb.platform_map()
+        last_builds = self.buildfarm.host_last_builds()
         for host in deadhosts:
-            last_build = self.buildfarm.host_last_build(host)
-            age = time.time() - last_build
             try:
-                platform = self.buildfarm.hostdb[host].platform.encode("utf-8")
-            except hostdb.NoSuchHost:
+                platform = platforms[host].encode("utf-8")
+            except KeyError:
                 continue
+            last_build = last_builds.get(host)
+            if last_build is None:
+                # Never built anything; dhm_time shows negative ages as "-"
+                age = -1
+            else:
+                age = time.time() - last_build
             yield "<tr><td>%s</td><td>%s</td><td>%s</td></tr>" %\
                     (host, platform, util.dhm_time(age))
 
@@ -727,7 +1387,7 @@ class ViewSummaryPage(BuildFarmPage):
         # output when we want
         broken_table = ""
 
-        builds = self.buildfarm.get_summary_builds(min_age=time.time() - BuildFarm.DEADAGE)
+        builds = self.buildfarm.get_summary_builds(min_age=time.time() - self.buildfarm.DEADAGE)
 
         for tree, status in builds:
             host_count[tree]+=1
@@ -880,8 +1540,143 @@ class HistoryPage(BuildFarmPage):
         yield "</div>\n"
 
 
+class DiffTooLarge(Exception):
+    """Raised when a diff is larger than allowed."""
+
+
+class LimitedStringIO(object):
+    """In-memory file that refuses to grow beyond a maximum size."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.chunks = []
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise DiffTooLarge()
+        self.chunks.append(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+
+def resolve_revision(branch, revision):
+    """Find the commit id of a revision.
+
+    Revisions can also be given as branch names like "HEAD", which should
+    not be used as cache keys since they move.
+    """
+    return branch.get_revision(revision).revision
+
+
+def get_diff(branch, revision, cache=None, max_size=MAX_DIFF_SIZE):
+    """Retrieve the diff of a revision, from the cache if possible.
+
+    Generating the diff is aborted as soon as it grows beyond max_size,
+    so that huge merges don't end up in memory. That a diff is too large
+    is cached as well.
+
+    :param branch: Branch to retrieve the diff from
+    :param revision: Revision id
+    :param cache: Optional FileCache for diffs
+    :param max_size: Maximum size of the diff, in bytes
+    :return: The diff, or None if it is too large
+    """
+    revision = resolve_revision(branch, revision)
+    key = "diff-%s" % revision
+    too_large_key = "diff-too-large-%s" % revision
+    if cache is not None:
+        diff = cache.get(key)
+        if diff is not None:
+            return diff
+        if cache.get(too_large_key) is not None:
+            return None
+    f = LimitedStringIO(max_size)
+    try:
+        branch.write_diff(f, revision)
+    except DiffTooLarge:
+        if cache is not None:
+            cache.set(too_large_key, "")
+        return None
+    diff = f.getvalue()
+    if cache is not None:
+        cache.set(key, diff)
+    return diff
+
+
+def open_diff(branch, revision, cache=None, max_size=MAX_DIFF_SIZE):
+    """Open the diff of a revision, of any size.
+
+    The diff is generated at most once. Diffs up to max_size are cached,
+    larger ones are spooled to a temporary file.
+
+    :param branch: Branch to retrieve the diff from
+    :param revision: Revision id
+    :param cache: Optional FileCache for diffs
+    :param max_size: Maximum size of diffs to keep in memory, in bytes
+    :return: File-like object positioned at the start of the diff
+    """
+    revision = resolve_revision(branch, revision)
+    key = "diff-%s" % revision
+    too_large_key = "diff-too-large-%s" % revision
+    if cache is not None:
+        diff = cache.get(key)
+        if diff is not None:
+            return StringIO(diff)
+    f = tempfile.SpooledTemporaryFile(max_size)
+    branch.write_diff(f, revision)
+    size = f.tell()
+    f.seek(0)
+    if cache is not None:
+        if size > max_size:
+            cache.set(too_large_key, "")
+        else:
+            cache.set(key, f.read())
+            f.seek(0)
+    return f
+
+
 class DiffPage(HistoryPage):
 
+    # Bump when the highlighted output changes, to invalidate the cache
+    highlight_version = 1
+
+    def __init__(self, buildfarm, cache=None):
+        """Create a new diff page.
+
+        :param buildfarm: BuildFarm instance
+        :param cache: Optional FileCache for the diffs
+        """
+        super(DiffPage, self).__init__(buildfarm)
+        self.cache = cache
+
+    def get_highlighted_diff(self, branch, revision):
+        """Highlight the diff of a revision, using the cache if possible.
+
+        Commits never change, so the cache is keyed on just the commit id.
+
+        :return: HTML, or None if the diff is too large to highlight
+        """
+        revision = resolve_revision(branch, revision)
+        key = "diff-html-%d-%s" % (self.highlight_version, revision)
+        if self.cache is not None:
+            html = self.cache.get(key)
+            if html is not None:
+                return html
+        diff = get_diff(branch, revision, self.cache)
+        if diff is None:
+            return None
+        html = highlight(diff, DiffLexer(), HtmlFormatter()).encode("utf-8")
+        if self.cache is not None:
+            self.cache.set(key, html)
+        return html
+
     def render(self, myself, tree, revision):
         try:
             t = self.buildfarm.trees[tree]
@@ -889,16 +1684,24 @@ class DiffPage(HistoryPage):
             yield "Unknown tree %s" % tree
             return
         branch = t.get_branch()
-        (entry, diff) = branch.diff(revision)
+        try:
+            entry = branch.get_revision(revision)
+            changes = branch.changes_summary(revision)
+            diff = self.get_highlighted_diff(branch, revision)
+        finally:
+            branch.close()
         # get information about the current diff
         title = "GIT Diff in %s:%s for revision %s" % (
             tree, t.branch, revision)
         yield "<h2>%s</h2>" % title
-        changes = branch.changes_summary(revision)
         yield "".join(self.history_row_html(myself, entry, t, changes))
-        diff = highlight(diff, DiffLexer(), HtmlFormatter())
         yield "<h2>Diff Result:</h2>"
-        yield "<pre>%s</pre>" % diff.encode("utf-8")
+        if diff is None:
+            yield "<p>This diff is too large to show here, but it can be "
+            yield "<a href=\"%s?function=text_diff;tree=%s;revision=%s\">downloaded</a>.</p>" % (
+                myself, tree, revision)
+        else:
+            yield "<pre>%s</pre>" % diff
 
 
 class RecentCheckinsPage(HistoryPage):
@@ -907,16 +1710,26 @@ class RecentCheckinsPage(HistoryPage):
 
     def render(self, myself, tree, gitstart, author=None):
         t = self.buildfarm.trees[tree]
-        interesting = list()
         authors = {"ALL": "ALL"}
         branch = t.get_branch()
-        re_author = re.compile("^(.*) <(.*)>$")
+        try:
+            for entry_author in branch.recent_authors(HISTORY_HORIZON):
+                m = re_author.match(entry_author)
+                if m is not None:
+                    authors[m.group(2)] = m.group(1)
 
-        for entry in branch.log(limit=HISTORY_HORIZON):
-            m = re_author.match(entry.author)
-            authors[m.group(2)] = m.group(1)
-            if author in (None, "ALL", m.group(2)):
-                interesting.append(entry)
+            if author in (None, "ALL"):
+                author_filter = None
+            else:
+                author_filter = author
+            # Fetch one more entry than is shown, to see if there is a next
+            # page
+            interesting = branch.recent_log(HISTORY_HORIZON, offset=gitstart,
+                limit=self.limit + 1, author=author_filter)
+            changes = [branch.changes_summary(entry.revision)
+                       for entry in interesting[:self.limit]]
+        finally:
+            branch.close()
 
         yield "<h2>Recent checkins for %s (%s branch %s)</h2>\n" % (
             tree, t.scm, t.branch)
@@ -932,16 +1745,16 @@ class RecentCheckinsPage(HistoryPage):
 
         gitstop = gitstart + self.limit
 
-        for entry in interesting[gitstart:gitstop]:
-            changes = branch.changes_summary(entry.revision)
-            yield "".join(self.history_row_html(myself, entry, t, changes))
+        for (entry, entry_changes) in zip(interesting[:self.limit], changes):
+            yield "".join(self.history_row_html(myself, entry, t,
+                entry_changes))
         yield "\n"
 
         yield "<form method='GET'>"
         yield "<div class='newform'>\n"
         if gitstart != 0:
             yield "<button name='gitstart' type='submit' value=" + str(gitstart - self.limit) + " style='position:absolute;left:0px;'>Previous</button>"
-        if len(interesting) > gitstop:
+        if len(interesting) > self.limit:
             yield "<button name='gitstart' type='submit' value=" + str(gitstop) + " style='position:absolute;right:0px;'>Next</button>"
         yield "<input type='hidden' name='function', value='Recent Checkins'/>"
         yield "<input type='hidden' name='gitcount' value='%s'/>" % gitstop
@@ -952,20 +1765,47 @@ class RecentCheckinsPage(HistoryPage):
         yield "</form>"
 
 
+def open_render_cache(buildfarm, max_size=RENDER_CACHE_SIZE):
+    """Open the cache of rendered build logs of a build farm.
+
+    :param buildfarm: BuildFarm instance
+    :param max_size: Maximum size of the cache, in bytes
+    """
+    return FileCache(os.path.join(buildfarm.path, "data", "cache", "render"),
+        max_size)
+
+
+def open_diff_cache(buildfarm, max_size=DIFF_CACHE_SIZE):
+    """Open the cache of raw and highlighted diffs of a build farm.
+
+    :param buildfarm: BuildFarm instance
+    :param max_size: Maximum size of the cache, in bytes
+    """
+    return FileCache(os.path.join(buildfarm.path, "data", "cache", "diff"),
+        max_size)
+
+
 class BuildFarmApp(object):
 
-    def __init__(self, buildfarm):
+    def __init__(self, buildfarm, render_cache=None, diff_cache=None):
+        """Create the web application.
+
+        :param buildfarm: BuildFarm instance
+        :param render_cache: Optional FileCache for rendered build logs
+        :param diff_cache: Optional FileCache for diffs
+        """
         self.buildfarm = buildfarm
+        self.render_cache = render_cache
+        self.diff_cache = diff_cache
+        self.file_cache = util.FileLoadCache()
+        self._host_menu = (None, None)
 
     def main_menu(self, tree, host, compiler, function):
         """main page"""
 
         yield "<form method='GET'>\n"
         yield "<div id='newbuildmenu'>\n"
-        host_dict = {}
-        for h in self.buildfarm.hostdb.hosts():
-            host_dict[h.name] = "%s-%s" % (h.platform.encode("utf-8"), h.name)
-        yield "".join(select("host", host_dict, default=host))
+        yield "".join(select("host", self.host_menu(), default=host))
         yield "<br/><br/>"
 
         tree_dict = {}
@@ -978,6 +1818,7 @@ class BuildFarmApp(object):
         functions_dict = {
             'View Build': 'View Build', 'Summary': 'Summary', 'View Host': 'View Host',
             'Recent Builds': 'Recent Builds', 'Recent Checkins': 'Recent Checkins',
+            'Flaky Tests': 'Flaky Tests',
             }
         yield "".join(select("function", functions_dict, default=function))
         yield "<br/><br/>"
@@ -985,15 +1826,66 @@ class BuildFarmApp(object):
         yield "</div>"
         yield "</form>"
 
+    def host_menu(self):
+        """Retrieve the entries for the host menu.
+
+        The entries are only rebuilt when the host table has changed.
+        """
+        serial = self.buildfarm.hostdb.serial()
+        if self._host_menu[0] != serial:
+            host_dict = {}
+            for name, platform in self.buildfarm.hostdb.platform_map().iteritems():
+                host_dict[name] = "%s-%s" % (platform.encode("utf-8"), name)
+            self._host_menu = (serial, host_dict)
+        return self._host_menu[1]
+
+    def load_chrome(self, deps):
+        """Load the parts of the page around the content.
+
+        :param deps: List to add the files that were read to
+        :return: Tuple with the HTML that goes between the main menu and
+            the content, and the HTML that goes after the content
+        """
+        samba_web = os.path.join(webdir, "samba-web")
+        banner = [util.FileLoad(os.path.join(webdir, "bannernav1.html"), deps)]
+        for name in ["think", "get", "learn", "talk", "hack", "contact"]:
+            banner.append(util.SambaWebFileLoad(samba_web,
+                "menu_%s_samba_closed.html" % name, deps))
+        banner.append(util.FileLoad(os.path.join(webdir, "bannernav2.html"), deps))
+        footer = [
+            util.SambaWebFileLoad(samba_web, "footer.html", deps),
+            util.FileLoad(os.path.join(webdir, "closingtags.html"), deps)]
+        return ("".join(banner), "".join(footer))
+
+    def load_file(self, path):
+        """Read a file, reusing its contents until it changes."""
+        return self.file_cache.get(path,
+            lambda deps: util.FileLoad(path, deps))
+
+    def static_url(self, name):
+        """Return the URL of a file in the web directory.
+
+        The URL includes the mtime of the file, so that it changes whenever
+        the file does and the file can be cached for a long time.
+        """
+        path = os.path.join(webdir, name)
+        def load(deps):
+            stamp = util.file_stamp(path)
+            deps.append((path, stamp))
+            if stamp is None:
+                return "/%s" % name
+            return "/%s?%x" % (name, int(stamp[0]))
+        return self.file_cache.get(("static_url", name), load)
+
     def html_page(self, form, lines):
         yield "<html>\n"
         yield "  <head>\n"
         yield "    <title>samba.org build farm</title>\n"
-        yield "    <script language='javascript' src='/build_farm.js'></script>\n"
+        yield "    <script language='javascript' src='%s'></script>\n" % self.static_url("build_farm.js")
         yield "    <meta name='keywords' contents='Samba SMB CIFS Build Farm'/>\n"
         yield "    <meta name='description' contents='Home of the Samba Build Farm, the automated testing facility.'/>\n"
         yield "    <meta name='robots' contents='noindex'/>"
-        yield "    <link rel='stylesheet' href='/build_farm.css' type='text/css' media='all'/>"
+        yield "    <link rel='stylesheet' href='%s' type='text/css' media='all'/>" % self.static_url("build_farm.css")
         yield "    <link rel='shortcut icon' href='//www.samba.org/samba/images/favicon.ico'/>"
         yield "    <link rel='shortcut icon' href='//www.samba.org/samba/style/2010/grey/favicon.ico'/>"
         yield "    <link rel='stylesheet' type='text/css' media='screen,projection' href='//www.samba.org/samba/style/2010/grey/screen.css'/>"
@@ -1005,20 +1897,89 @@ class BuildFarmApp(object):
         host = get_param(form, "host")
         compiler = get_param(form, "compiler")
         function = get_param(form, "function")
+        (banner, footer) = self.file_cache.get("chrome", self.load_chrome)
         yield "".join(self.main_menu(tree, host, compiler, function))
-        yield util.FileLoad(os.path.join(webdir, "bannernav1.html"))
-        yield util.SambaWebFileLoad(os.path.join(webdir, "samba-web"), "menu_think_samba_closed.html")
-        yield util.SambaWebFileLoad(os.path.join(webdir, "samba-web"), "menu_get_samba_closed.html")
-        yield util.SambaWebFileLoad(os.path.join(webdir, "samba-web"), "menu_learn_samba_closed.html")
-        yield util.SambaWebFileLoad(os.path.join(webdir, "samba-web"), "menu_talk_samba_closed.html")
-        yield util.SambaWebFileLoad(os.path.join(webdir, "samba-web"), "menu_hack_samba_closed.html")
-        yield util.SambaWebFileLoad(os.path.join(webdir, "samba-web"), "menu_contact_samba_closed.html")
-        yield util.FileLoad(os.path.join(webdir, "bannernav2.html"))
+        yield banner
         yield "".join(lines)
-        yield util.SambaWebFileLoad(os.path.join(webdir, "samba-web"), "footer.html")
-        yield util.FileLoad(os.path.join(webdir, "closingtags.html"))
+        yield footer
+
+    def page_cache_headers(self, tree=None):
+        """Caching headers for pages that change when new builds come in.
+
+        The longer ago the last upload, the less likely it is that a new
+        build will come in soon, so the longer the page can be cached.
+
+        :param tree: Only consider uploads for this tree
+        """
+        last_upload_time = self.buildfarm.last_upload_time(tree)
+        if last_upload_time is None:
+            max_age = MAX_PAGE_MAX_AGE
+        else:
+            max_age = int(time.time() - last_upload_time) / 10
+            max_age = max(MIN_PAGE_MAX_AGE, min(MAX_PAGE_MAX_AGE, max_age))
+        return [('Cache-Control', 'max-age=%d' % max_age)]
+
+    def immutable_headers(self, etag, last_modified):
+        """Caching headers for resources that never change."""
+        return [
+            ('ETag', etag),
+            ('Last-Modified', formatdate(last_modified, usegmt=True)),
+            ('Cache-Control', 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE),
+            ]
 
     def __call__(self, environ, start_response):
+        # The raw output of builds can be huge, so it is streamed straight
+        # from disk rather than generated like the other pages.
+        m = re.match("^/build/([^/]+)/\+(stdout|stderr|subunit)$",
+            environ.get('PATH_INFO') or "")
+        if m:
+            return self.build_output(environ, start_response, m.group(1),
+                m.group(2))
+        return self.dispatch(environ, start_response)
+
+    def build_output(self, environ, start_response, build_checksum, kind):
+        """Send the standard output, standard error or subunit output of a
+        build."""
+        try:
+            build = self.buildfarm.builds.get_by_checksum(build_checksum)
+        except NoSuchBuildError:
+            start_response('404 Page Not Found', [
+                ('Content-Type', 'text/html; charset=utf8')])
+            return ["No build with checksum %s found" % build_checksum]
+        # The ETag is weak, since the output may be sent compressed or not
+        cache_headers = self.immutable_headers('W/"%s"' % build.checksum,
+            build.upload_time)
+        if is_not_modified(environ, 'W/"%s"' % build.checksum,
+                build.upload_time):
+            start_response('304 Not Modified', cache_headers)
+            return []
+        extension = {"stdout": "log", "stderr": "err", "subunit": "subunit"}[kind]
+        headers = [('Content-Disposition', 'attachment; filename="%s.%s.%s-%s.%s"' % (
+            build.tree, build.host, build.compiler, build.revision, extension))]
+        headers.extend(cache_headers)
+        if kind == "subunit":
+            headers.insert(0, ('Content-type', 'text/x-subunit; charset=utf-8'))
+            found = build.find_file("subunit")
+            if found is None:
+                # The size is not known until the whole log has been read
+                start_response('200 OK', headers)
+                return join_chunks(build_test_output(build))
+        else:
+            headers.insert(0, ('Content-type', 'text/plain; charset=utf-8'))
+            found = build.find_file(extension)
+            if found is None:
+                if kind == "stdout":
+                    start_response('404 Page Not Found', [
+                        ('Content-Type', 'text/html; charset=utf8')])
+                    return ["No build log available"]
+                headers.append(('Content-Length', '0'))
+                start_response('200 OK', headers)
+                return []
+        (path, compression) = found
+        return file_response(environ, start_response, path, compression,
+            headers)
+
+    def dispatch(self, environ, start_response):
         form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ)
         fn_name = get_param(form, 'function') or ''
         myself = wsgiref.util.application_uri(environ)
@@ -1029,19 +1990,28 @@ class BuildFarmApp(object):
             t = self.buildfarm.trees[tree]
             branch = t.get_branch()
             revision = get_param(form, 'revision')
-            (entry, diff) = branch.diff(revision)
-            changes = branch.changes_summary(revision)
+            try:
+                entry = branch.get_revision(revision)
+                changes = branch.changes_summary(revision)
+                diff = open_diff(branch, entry.revision, self.diff_cache)
+            finally:
+                branch.close()
             yield "".join(history_row_text(entry, tree, changes))
-            yield "%s\n" % diff
+            for chunk in iter_file(diff):
+                yield chunk
+            yield "\n"
         elif fn_name == 'Text_Summary':
-            start_response('200 OK', [('Content-type', 'text/plain')])
+            start_response('200 OK', [('Content-type', 'text/plain')] +
+                self.page_cache_headers())
             page = ViewSummaryPage(self.buildfarm)
             yield "".join(page.render_text(myself))
         elif fn_name:
-            start_response('200 OK', [
-                ('Content-type', 'text/html; charset=utf-8')])
-
             tree = get_param(form, "tree")
+            headers = [('Content-type', 'text/html; charset=utf-8')]
+            if fn_name in ("Summary", "Recent_Builds"):
+                headers.extend(self.page_cache_headers(tree))
+            start_response('200 OK', headers)
+
             host = get_param(form, "host")
             compiler = get_param(form, "compiler")
 
@@ -1056,7 +2026,7 @@ class BuildFarmApp(object):
                     yield "No such build: %s on %s with %s, rev %r, checksum %r" % (
                         tree, host, compiler, revision, checksum)
                 else:
-                    page = ViewBuildPage(self.buildfarm)
+                    page = ViewBuildPage(self.buildfarm, self.render_cache)
                     plain_logs = (get_param(form, "plain") is not None and get_param(form, "plain").lower() in ("yes", "1", "on", "true", "y"))
                     yield "".join(self.html_page(form, page.render(myself, build, plain_logs)))
             elif fn_name == "View_Host":
@@ -1064,7 +2034,11 @@ class BuildFarmApp(object):
                 yield "".join(self.html_page(form, page.render_html(myself, get_param(form, 'host'))))
             elif fn_name == "Recent_Builds":
                 page = ViewRecentBuildsPage(self.buildfarm)
-                yield "".join(self.html_page(form, page.render(myself, get_param(form, "tree"), get_param(form, "sortby") or "age")))
+                (limit, offset) = get_paging_params(form)
+                yield "".join(self.html_page(form, page.render(myself, get_param(form, "tree"), get_param(form, "sortby") or "age", limit, offset)))
+            elif fn_name == "Flaky_Tests":
+                page = FlakyTestsPage(self.buildfarm)
+                yield "".join(self.html_page(form, page.render(myself, tree)))
             elif fn_name == "Recent_Checkins":
                 # validate the tree
                 author = get_param(form, 'author')
@@ -1077,7 +2051,7 @@ class BuildFarmApp(object):
                 yield "".join(self.html_page(form, page.render(myself, tree, gitstart, author)))
             elif fn_name == "diff":
                 revision = get_param(form, 'revision')
-                page = DiffPage(self.buildfarm)
+                page = DiffPage(self.buildfarm, self.diff_cache)
                 yield "".join(self.html_page(form, page.render(myself, tree, revision)))
             elif fn_name == "Summary":
                 page = ViewSummaryPage(self.buildfarm)
@@ -1091,12 +2065,15 @@ class BuildFarmApp(object):
                 subfn = wsgiref.util.shift_path_info(environ)
                 if subfn in ("", None, "+recent"):
                     start_response('200 OK', [
-                        ('Content-type', 'text/html; charset=utf-8')])
+                        ('Content-type', 'text/html; charset=utf-8')] +
+                        self.page_cache_headers(tree))
                     page = ViewRecentBuildsPage(self.buildfarm)
-                    yield "".join(self.html_page(form, page.render(myself, tree, get_param(form, 'sortby') or 'age')))
+                    (limit, offset) = get_paging_params(form)
+                    yield "".join(self.html_page(form, page.render(myself, tree, get_param(form, 'sortby') or 'age', limit, offset)))
                 elif subfn == "+recent-ids":
                     start_response('200 OK', [
-                        ('Content-type', 'text/plain; charset=utf-8')])
+                        ('Content-type', 'text/plain; charset=utf-8')] +
+                        self.page_cache_headers(tree))
                     yield "".join([x.log_checksum()+"\n" for x in self.buildfarm.get_tree_builds(tree) if x.has_log()])
                 else:
                     start_response('200 OK', [
@@ -1110,12 +2087,12 @@ class BuildFarmApp(object):
             elif fn == "about":
                 start_response('200 OK', [
                     ('Content-type', 'text/html; charset=utf-8')])
-                lines = util.FileLoad(os.path.join(webdir, "about.html"))
+                lines = self.load_file(os.path.join(webdir, "about.html"))
                 yield "".join(self.html_page(form, lines))
             elif fn == "instructions":
                 start_response('200 OK', [
                     ('Content-type', 'text/html; charset=utf-8')])
-                lines = util.FileLoad(os.path.join(webdir, "instructions.html"))
+                lines = self.load_file(os.path.join(webdir, "instructions.html"))
                 yield "".join(self.html_page(form, lines))
             elif fn == "build":
                 build_checksum = wsgiref.util.shift_path_info(environ)
@@ -1126,39 +2103,64 @@ class BuildFarmApp(object):
                         ('Content-Type', 'text/html; charset=utf8')])
                     yield "No build with checksum %s found" % build_checksum
                     return
-                page = ViewBuildPage(self.buildfarm)
+                page = ViewBuildPage(self.buildfarm, self.render_cache)
                 subfn = wsgiref.util.shift_path_info(environ)
                 if subfn == "+plain":
                     start_response('200 OK', [
-                        ('Content-type', 'text/html; charset=utf-8')])
+                        ('Content-type', 'text/html; charset=utf-8')] +
+                        self.page_cache_headers(build.tree))
                     yield "".join(page.render(myself, build, True))
-                elif subfn == "+subunit":
-                    start_response('200 OK', [
-                        ('Content-type', 'text/x-subunit; charset=utf-8'),
-                        ('Content-Disposition', 'attachment; filename="%s.%s.%s-%s.subunit"' % (build.tree, build.host, build.compiler, build.revision))])
+                elif subfn == "+test-diff":
+                    other_build_checksum = wsgiref.util.shift_path_info(environ)
                     try:
-                        yield build.read_subunit().read()
-                    except NoTestOutput:
-                        yield "There was no test output"
-                elif subfn == "+stdout":
+                        other_build = self.buildfarm.builds.get_by_checksum(
+                            other_build_checksum)
+                    except NoSuchBuildError:
+                        start_response('404 Page Not Found', [
+                            ('Content-Type', 'text/html; charset=utf8')])
+                        yield "No build with checksum %s found" % (
+                            other_build_checksum)
+                        return
                     start_response('200 OK', [
-                        ('Content-type', 'text/plain; charset=utf-8'),
-                        ('Content-Disposition', 'attachment; filename="%s.%s.%s-%s.log"' % (build.tree, build.host, build.compiler, build.revision))])
-                    yield build.read_log().read()
-                elif subfn == "+stderr":
-                    start_response('200 OK', [
-                        ('Content-type', 'text/plain; charset=utf-8'),
-                        ('Content-Disposition', 'attachment; filename="%s.%s.%s-%s.err"' % (build.tree, build.host, build.compiler, build.revision))])
-                    yield build.read_err().read()
+                        ('Content-type', 'text/html; charset=utf-8')] +
+                        self.page_cache_headers(build.tree))
+                    diff = compare_test_results(
+                        self.buildfarm.builds.find_test_results(other_build),
+                        self.buildfarm.builds.find_test_results(build))
+                    page = TestDiffPage(self.buildfarm)
+                    yield "".join(self.html_page(form,
+                        page.render(myself, other_build, build, diff)))
                 elif subfn == "+subunit-diff":
-                    start_response('200 OK', [
-                        ('Content-type', 'text/plain; charset=utf-8')])
-                    subunit_this = build.read_subunit().readlines()
                     other_build_checksum = wsgiref.util.shift_path_info(environ)
-                    other_build = self.buildfarm.builds.get_by_checksum(other_build_checksum)
-                    subunit_other = other_build.read_subunit().readlines()
-                    import difflib
-                    yield "".join(difflib.unified_diff(subunit_other, subunit_this))
+                    try:
+                        other_build = self.buildfarm.builds.get_by_checksum(
+                            other_build_checksum)
+                    except NoSuchBuildError:
+                        start_response('404 Page Not Found', [
+                            ('Content-Type', 'text/html; charset=utf8')])
+                        yield "No build with checksum %s found" % (
+                            other_build_checksum)
+                        return
+                    if get_param(form, "format") == "json":
+                        etag = '"%s-%s-json"' % (build.checksum, other_build.checksum)
+                        content_type = 'application/json'
+                    else:
+                        etag = '"%s-%s"' % (build.checksum, other_build.checksum)
+                        content_type = 'text/plain; charset=utf-8'
+                    last_modified = max(build.upload_time, other_build.upload_time)
+                    cache_headers = self.immutable_headers(etag, last_modified)
+                    if is_not_modified(environ, etag, last_modified):
+                        start_response('304 Not Modified', cache_headers)
+                        return
+                    start_response('200 OK', [
+                        ('Content-type', content_type)] + cache_headers)
+                    diff = compare_test_results(
+                        self.buildfarm.builds.find_test_results(other_build),
+                        self.buildfarm.builds.find_test_results(build))
+                    if content_type == 'application/json':
+                        yield json.dumps(diff.as_dict())
+                    else:
+                        yield "".join(test_results_diff_text(diff))
 
                 elif subfn in ("", "limit", None):
                     if subfn == "limit":
@@ -1169,11 +2171,13 @@ class BuildFarmApp(object):
                     else:
                         limit = 10
                     start_response('200 OK', [
-                        ('Content-type', 'text/html; charset=utf-8')])
+                        ('Content-type', 'text/html; charset=utf-8')] +
+                        self.page_cache_headers(build.tree))
                     yield "".join(self.html_page(form, page.render(myself, build, False, limit)))
             elif fn in ("", None):
                 start_response('200 OK', [
-                    ('Content-type', 'text/html; charset=utf-8')])
+                    ('Content-type', 'text/html; charset=utf-8')] +
+                    self.page_cache_headers())
                 page = ViewSummaryPage(self.buildfarm)
                 yield "".join(self.html_page(form, page.render_html(myself)))
             else:
@@ -1183,40 +2187,5 @@ class BuildFarmApp(object):
 
 
 if __name__ == '__main__':
-    import optparse
-    parser = optparse.OptionParser("[options]")
-    parser.add_option("--debug-storm", help="Enable storm debugging",
-                      default=False, action='store_true')
-    parser.add_option("--port", help="Port to listen on [localhost:8000]",
-        default="localhost:8000", type=str)
-    opts, args = parser.parse_args()
-    from buildfarm import BuildFarm
-    buildfarm = BuildFarm()
-    buildApp = BuildFarmApp(buildfarm)
-    from wsgiref.simple_server import make_server
-    import mimetypes
-    mimetypes.init()
-
-    def standaloneApp(environ, start_response):
-        if environ['PATH_INFO']:
-            m = re.match("^/([a-zA-Z0-9_-]+)(\.[a-zA-Z0-9_-]+)?", environ['PATH_INFO'])
-            if m:
-                static_file = os.path.join(webdir, m.group(1)+m.group(2))
-                if os.path.exists(static_file):
-                    type = mimetypes.types_map[m.group(2)]
-                    start_response('200 OK', [('Content-type', type)])
-                    data = open(static_file, 'rb').read()
-                    yield data
-                    return
-        yield "".join(buildApp(environ, start_response))
-    try:
-        (address, port) = opts.port.rsplit(":", 1)
-    except ValueError:
-        address = "localhost"
-        port = opts.port
-    if opts.debug_storm:
-        from storm.tracer import debug
-        debug(True, stream=sys.stdout)
-    httpd = make_server(address, int(port), standaloneApp)
-    print "Serving on %s:%d..." % (address, int(port))
-    httpd.serve_forever()
+    from buildfarm.web.server import main
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,412 @@
+#!/usr/bin/python
+# Standalone web server for the build farm
+# Copyright (C) 2010 Jelmer Vernooij <jelmer@samba.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Long-running web server for the build farm.
+
+Unlike build.cgi, which starts a new interpreter and opens the database for
+every request, this serves requests from a fixed pool of threads that each
+keep their own database connection.
+
+Send SIGHUP to restart the server with fresh code and configuration; the
+requests that are in progress are finished first, and the listening socket
+is handed over to the new process so no connections are refused. SIGTERM
+and SIGINT stop the server after finishing the requests in progress.
+"""
+
+import mimetypes
+import optparse
+import os
+import Queue
+import re
+import signal
+import socket
+import sys
+import threading
+from email.utils import formatdate
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from buildfarm import BuildFarm
+from buildfarm.web import (
+    STREAM_BLOCK_SIZE,
+    BuildFarmApp,
+    accepts_encoding,
+    is_not_modified,
+    iter_file,
+    open_diff_cache,
+    open_render_cache,
+    webdir,
+    )
+
+# Environment variable used to hand the listening socket to a restarted server.
+LISTEN_FD_ENV = "BUILDFARM_LISTEN_FD"
+
+
+class ThreadedBuildFarmApp(BuildFarmApp):
+    """BuildFarmApp that can handle requests from several threads at once.
+
+    A Storm store can only be used from a single thread, so every thread
+    opens its own BuildFarm the first time it handles a request. The
+    transaction is rolled back at the end of each request, so the next
+    request sees new builds.
+    """
+
+    def __init__(self, open_buildfarm, render_cache=None, diff_cache=None):
+        """Create a new application.
+
+        :param open_buildfarm: Function that opens a new BuildFarm
+        :param render_cache: Optional FileCache for rendered build logs
+        :param diff_cache: Optional FileCache for diffs
+        """
+        self._open_buildfarm = open_buildfarm
+        self._local = threading.local()
+        super(ThreadedBuildFarmApp, self).__init__(None, render_cache,
+            diff_cache)
+
+    def _get_buildfarm(self):
+        buildfarm = getattr(self._local, "buildfarm", None)
+        if buildfarm is None:
+            buildfarm = self._open_buildfarm()
+            self._local.buildfarm = buildfarm
+        return buildfarm
+
+    def _set_buildfarm(self, buildfarm):
+        self._local.buildfarm = buildfarm
+
+    buildfarm = property(_get_buildfarm, _set_buildfarm)
+
+    def __call__(self, environ, start_response):
+        try:
+            result = super(ThreadedBuildFarmApp, self).__call__(environ,
+                start_response)
+        except:
+            self.buildfarm.rollback()
+            raise
+        return ClosingIterable(result, self.buildfarm.rollback)
+
+
+class ClosingIterable(object):
+    """Response iterable that calls a function once the response is done."""
+
+    def __init__(self, iterable, close):
+        self._iterable = iterable
+        self._close = close
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, "close"):
+                self._iterable.close()
+        finally:
+            self._close()
+
+
+class StaticFile(object):
+    """A file served by `StaticFiles`."""
+
+    def __init__(self, path, content_type, max_age):
+        self.path = path
+        self.content_type = content_type
+        self.max_age = max_age
+        self.update(os.stat(path))
+
+    def update(self, st):
+        """Update the size, mtime and ETag after the file has changed."""
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.etag = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+
+
+def parse_range(value, size):
+    """Parse the value of a Range header.
+
+    Only single byte ranges are supported.
+
+    :param value: Value of the Range header
+    :param size: Size of the resource
+    :return: Tuple with the offset and length of the range, None if the
+        header should be ignored, or False if the range is not satisfiable
+    """
+    m = re.match(r"^bytes=(\d*)-(\d*)$", value.strip())
+    if m is None or m.groups() == ("", ""):
+        return None
+    (first, last) = m.groups()
+    if first == "":
+        # The last N bytes
+        length = min(int(last), size)
+        if length == 0:
+            return False
+        return (size - length, length)
+    first = int(first)
+    if first >= size:
+        return False
+    if last == "":
+        last = size - 1
+    else:
+        last = min(int(last), size - 1)
+        if last < first:
+            return None
+    return (first, last - first + 1)
+
+
+def iter_range(f, offset, length, block_size=STREAM_BLOCK_SIZE):
+    """Iterate over part of a file in blocks, closing it afterwards."""
+    try:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+class StaticFiles(object):
+    """WSGI application that serves the files in a directory, and passes
+    other requests on to another application.
+
+    The content type and ETag of each file are determined once, when the
+    server starts, and only updated when the file turns out to have changed.
+    If a file has a gzip compressed copy next to it (e.g. build_farm.css.gz),
+    that is sent to clients that accept gzip.
+    """
+
+    # Stylesheets and scripts are referred to with their mtime in the
+    # query string (see BuildFarmApp.static_url), so they can be cached
+    # for as long as we like. Images are not, but rarely change.
+    max_ages = [
+        (re.compile(r"\.(css|js)$"), 365 * 24 * 60 * 60),
+        (re.compile(r"\.(png|gif|ico)$"), 30 * 24 * 60 * 60),
+        ]
+    default_max_age = 60 * 60
+
+    def __init__(self, path, app):
+        """Create a new static file server.
+
+        :param path: Directory with the files to serve
+        :param app: WSGI application for all other requests
+        """
+        self.app = app
+        self.files = {}
+        self.compressed_files = {}
+        mimetypes.init()
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            if name.endswith(".gz") or not os.path.isfile(full_path):
+                continue
+            (content_type, encoding) = mimetypes.guess_type(name)
+            if content_type is None or encoding is not None:
+                continue
+            max_age = self.default_max_age
+            for (pattern, age) in self.max_ages:
+                if pattern.search(name):
+                    max_age = age
+                    break
+            self.files["/" + name] = StaticFile(full_path, content_type, max_age)
+            if os.path.isfile(full_path + ".gz"):
+                self.compressed_files["/" + name] = StaticFile(
+                    full_path + ".gz", content_type, max_age)
+
+    def __call__(self, environ, start_response):
+        static_file = self.files.get(environ.get('PATH_INFO'))
+        if static_file is None:
+            return self.app(environ, start_response)
+        headers = []
+        compressed = self.compressed_files.get(environ['PATH_INFO'])
+        if compressed is not None and compressed.mtime >= static_file.mtime:
+            headers.append(('Vary', 'Accept-Encoding'))
+            if accepts_encoding(environ, "gzip"):
+                static_file = compressed
+                headers.append(('Content-Encoding', 'gzip'))
+        try:
+            f = open(static_file.path, 'rb')
+        except IOError:
+            return self.app(environ, start_response)
+        st = os.fstat(f.fileno())
+        if (st.st_mtime, st.st_size) != (static_file.mtime, static_file.size):
+            static_file.update(st)
+        headers.extend([
+            ('Content-Type', static_file.content_type),
+            ('ETag', static_file.etag),
+            ('Last-Modified', formatdate(static_file.mtime, usegmt=True)),
+            ('Cache-Control', 'public, max-age=%d' % static_file.max_age),
+            ('Accept-Ranges', 'bytes'),
+            ])
+        if is_not_modified(environ, static_file.etag, static_file.mtime):
+            f.close()
+            start_response('304 Not Modified', headers)
+            return []
+        byte_range = None
+        if (environ.get('HTTP_RANGE') and
+            environ.get('HTTP_IF_RANGE', static_file.etag) == static_file.etag):
+            byte_range = parse_range(environ['HTTP_RANGE'], static_file.size)
+        if byte_range is False:
+            f.close()
+            headers.append(('Content-Range', 'bytes */%d' % static_file.size))
+            start_response('416 Requested Range Not Satisfiable', headers)
+            return []
+        if byte_range is not None:
+            (offset, length) = byte_range
+            headers.extend([
+                ('Content-Length', str(length)),
+                ('Content-Range', 'bytes %d-%d/%d' % (
+                    offset, offset + length - 1, static_file.size)),
+                ])
+            start_response('206 Partial Content', headers)
+            return iter_range(f, offset, length)
+        headers.append(('Content-Length', str(static_file.size)))
+        start_response('200 OK', headers)
+        if 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](f, STREAM_BLOCK_SIZE)
+        return iter_file(f)
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """WSGI server that handles requests in a fixed pool of threads."""
+
+    def __init__(self, server_address, RequestHandlerClass=WSGIRequestHandler,
+                 threads=8, listen_fd=None):
+        """Create a new server.
+
+        :param server_address: Tuple with address and port to listen on
+        :param threads: Number of requests to handle at the same time
+        :param listen_fd: File descriptor of a socket that is already
+            listening, to use instead of binding to server_address
+        """
+        WSGIServer.__init__(self, server_address, RequestHandlerClass,
+            bind_and_activate=(listen_fd is None))
+        if listen_fd is not None:
+            self.socket.close()
+            self.socket = socket.fromfd(listen_fd, self.address_family,
+                self.socket_type)
+            os.close(listen_fd)
+            self.server_address = self.socket.getsockname()
+            (host, port) = self.server_address[:2]
+            self.server_name = socket.getfqdn(host)
+            self.server_port = port
+            self.setup_environ()
+        self._requests = Queue.Queue()
+        self._workers = []
+        for i in range(threads):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            (request, client_address) = item
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def stop_workers(self):
+        """Wait for the queued requests to be handled, and stop the threads."""
+        for t in self._workers:
+            self._requests.put(None)
+        for t in self._workers:
+            t.join()
+        self._workers = []
+
+    def server_close(self):
+        self.stop_workers()
+        WSGIServer.server_close(self)
+
+
+def serve(httpd):
+    """Serve requests until the server is told to stop or restart.
+
+    :param httpd: A `ThreadPoolWSGIServer`
+    :return: True if the server should be restarted, False otherwise
+    """
+    restart = []
+
+    def stop(signum, frame):
+        if signum == signal.SIGHUP:
+            restart.append(True)
+        # shutdown() waits for serve_forever() to return, and that is
+        # running in this thread.
+        threading.Thread(target=httpd.shutdown).start()
+
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, stop)
+    httpd.serve_forever()
+    httpd.stop_workers()
+    if not restart:
+        httpd.server_close()
+    return bool(restart)
+
+
+def restart(httpd):
+    """Replace this process with a new server that takes over the socket."""
+    env = dict(os.environ)
+    env[LISTEN_FD_ENV] = str(httpd.socket.fileno())
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root] + [p for p in [env.get("PYTHONPATH")] if p])
+    os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+
+def main(argv):
+    parser = optparse.OptionParser("[options]")
+    parser.add_option("--debug-storm", help="Enable storm debugging",
+                      default=False, action='store_true')
+    parser.add_option("--port", help="Port to listen on [localhost:8000]",
+        default="localhost:8000", type=str)
+    parser.add_option("--threads", help="Number of requests to handle at the same time [8]",
+        default=8, type=int)
+    opts, args = parser.parse_args(argv)
+    try:
+        (address, port) = opts.port.rsplit(":", 1)
+    except ValueError:
+        address = "localhost"
+        port = opts.port
+    if opts.debug_storm:
+        from storm.tracer import debug
+        debug(True, stream=sys.stdout)
+    buildfarm = BuildFarm()
+    app = ThreadedBuildFarmApp(lambda: BuildFarm(buildfarm.path),
+        open_render_cache(buildfarm), open_diff_cache(buildfarm))
+    listen_fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if listen_fd is not None:
+        listen_fd = int(listen_fd)
+    httpd = ThreadPoolWSGIServer((address, int(port)), threads=opts.threads,
+        listen_fd=listen_fd)
+    httpd.set_app(StaticFiles(webdir, app))
+    print "Serving on %s:%d..." % (address, int(port))
+    sys.stdout.flush()
+    if serve(httpd):
+        print "Restarting..."
+        sys.stdout.flush()
+        restart(httpd)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,456 @@
+#!/usr/bin/python
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import bz2
+import cgi
+from cStringIO import StringIO
+import json
+import os
+import shutil
+import tempfile
+import time
+from wsgiref.util import setup_testing_defaults
+
+from buildfarm import BuildFarm
+from buildfarm.cache import FileCache
+from buildfarm.history import Revision
+from buildfarm.tests import BuildFarmTestCase
+from buildfarm.web import (
+    BuildFarmApp,
+    DiffPage,
+    FlakyTestsPage,
+    MAX_PAGE_MAX_AGE,
+    MIN_PAGE_MAX_AGE,
+    ViewRecentBuildsPage,
+    accepts_encoding,
+    get_diff,
+    get_paging_params,
+    open_diff,
+    is_not_modified,
+    join_chunks,
+    )
+
+import testtools
+
+
+class AcceptsEncodingTests(testtools.TestCase):
+
+    def test_missing(self):
+        self.assertFalse(accepts_encoding({}, "gzip"))
+
+    def test_listed(self):
+        environ = {"HTTP_ACCEPT_ENCODING": "deflate, GZIP;q=0.5"}
+        self.assertTrue(accepts_encoding(environ, "gzip"))
+        self.assertFalse(accepts_encoding(environ, "bzip2"))
+
+    def test_refused(self):
+        environ = {"HTTP_ACCEPT_ENCODING": "gzip;q=0"}
+        self.assertFalse(accepts_encoding(environ, "gzip"))
+
+
+class GetPagingParamsTests(testtools.TestCase):
+
+    def get_paging_params(self, query):
+        environ = {}
+        setup_testing_defaults(environ)
+        environ["QUERY_STRING"] = query
+        return get_paging_params(cgi.FieldStorage(environ=environ))
+
+    def test_defaults(self):
+        self.assertEquals((None, 0), self.get_paging_params(""))
+
+    def test_limit_offset(self):
+        self.assertEquals((10, 20),
+            self.get_paging_params("limit=10&offset=20"))
+
+    def test_invalid(self):
+        self.assertEquals((None, 0),
+            self.get_paging_params("limit=ten&offset=x"))
+        self.assertEquals((10, 0),
+            self.get_paging_params("limit=10&offset=x"))
+
+    def test_offset_without_limit(self):
+        self.assertEquals((None, 0), self.get_paging_params("offset=20"))
+
+    def test_negative(self):
+        self.assertEquals((0, 0),
+            self.get_paging_params("limit=-1&offset=-20"))
+
+
+class IsNotModifiedTests(testtools.TestCase):
+
+    def test_no_conditions(self):
+        self.assertFalse(is_not_modified({}, '"abc"', 1000))
+
+    def test_if_none_match(self):
+        self.assertTrue(is_not_modified(
+            {"HTTP_IF_NONE_MATCH": '"foo", "abc"'}, '"abc"', 1000))
+        self.assertTrue(is_not_modified(
+            {"HTTP_IF_NONE_MATCH": 'W/"abc"'}, 'W/"abc"', 1000))
+        self.assertFalse(is_not_modified(
+            {"HTTP_IF_NONE_MATCH": '"foo"'}, '"abc"', 1000))
+
+    def test_if_none_match_takes_precedence(self):
+        self.assertFalse(is_not_modified(
+            {"HTTP_IF_NONE_MATCH": '"foo"',
+             "HTTP_IF_MODIFIED_SINCE": "Thu, 01 Jan 1970 01:00:00 GMT"},
+            '"abc"', 1000))
+
+    def test_if_modified_since(self):
+        environ = {"HTTP_IF_MODIFIED_SINCE": "Thu, 01 Jan 1970 00:20:00 GMT"}
+        self.assertTrue(is_not_modified(environ, '"abc"', 1200))
+        self.assertFalse(is_not_modified(environ, '"abc"', 1201))
+
+    def test_if_modified_since_invalid(self):
+        self.assertFalse(is_not_modified(
+            {"HTTP_IF_MODIFIED_SINCE": "yesterday"}, '"abc"', 1000))
+
+
+class JoinChunksTests(testtools.TestCase):
+
+    def test_join(self):
+        self.assertEquals(["abcd", "e"],
+            list(join_chunks(["ab", "cd", "e"], block_size=3)))
+
+    def test_empty(self):
+        self.assertEquals([], list(join_chunks([])))
+
+
+class CountingBranch(object):
+
+    def __init__(self, diff, refs=None):
+        self._diff = diff
+        self._refs = refs or {}
+        self.diffs_written = 0
+
+    def get_revision(self, revision):
+        return Revision(self._refs.get(revision, revision), 0, "", "", "")
+
+    def write_diff(self, f, revision):
+        assert revision not in self._refs
+        self.diffs_written += 1
+        f.writelines(self._diff.splitlines(True))
+
+
+class DiffCacheTests(testtools.TestCase):
+
+    diff = """--- a/foo
++++ b/foo
+@@ -1 +1 @@
+-old
++new
+"""
+
+    def setUp(self):
+        super(DiffCacheTests, self).setUp()
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.cache = FileCache(path, 1024 * 1024)
+
+    def test_get_diff(self):
+        branch = CountingBranch(self.diff)
+        self.assertEquals(self.diff, get_diff(branch, "rev", self.cache))
+        self.assertEquals(self.diff, get_diff(branch, "rev", self.cache))
+        self.assertEquals(1, branch.diffs_written)
+
+    def test_get_diff_no_cache(self):
+        branch = CountingBranch(self.diff)
+        self.assertEquals(self.diff, get_diff(branch, "rev"))
+        self.assertEquals(self.diff, get_diff(branch, "rev"))
+        self.assertEquals(2, branch.diffs_written)
+
+    def test_get_diff_too_large(self):
+        branch = CountingBranch(self.diff)
+        self.assertEquals(None, get_diff(branch, "rev", self.cache,
+            max_size=len(self.diff) - 1))
+        self.assertEquals(None, self.cache.get("diff-rev"))
+        self.assertEquals(None, get_diff(branch, "rev", self.cache,
+            max_size=len(self.diff) - 1))
+        self.assertEquals(1, branch.diffs_written)
+
+    def test_get_diff_ref(self):
+        branch = CountingBranch(self.diff, {"HEAD": "rev"})
+        self.assertEquals(self.diff, get_diff(branch, "HEAD", self.cache))
+        self.assertEquals(self.diff, self.cache.get("diff-rev"))
+        self.assertEquals(None, self.cache.get("diff-HEAD"))
+
+    def test_open_diff(self):
+        branch = CountingBranch(self.diff)
+        self.assertEquals(self.diff, open_diff(branch, "rev", self.cache).read())
+        self.assertEquals(self.diff, get_diff(branch, "rev", self.cache))
+        self.assertEquals(1, branch.diffs_written)
+
+    def test_open_diff_too_large(self):
+        branch = CountingBranch(self.diff)
+        self.assertEquals(self.diff, open_diff(branch, "rev", self.cache,
+            max_size=len(self.diff) - 1).read())
+        self.assertEquals(1, branch.diffs_written)
+        self.assertEquals(None, get_diff(branch, "rev", self.cache,
+            max_size=len(self.diff) - 1))
+        self.assertEquals(1, branch.diffs_written)
+
+    def test_highlighted_diff(self):
+        branch = CountingBranch(self.diff)
+        page = DiffPage(None, self.cache)
+        html = page.get_highlighted_diff(branch, "rev")
+        self.assertTrue("+new" in html)
+        self.assertEquals(html, page.get_highlighted_diff(branch, "rev"))
+        self.assertEquals(1, branch.diffs_written)
+
+    def test_highlighted_diff_ref(self):
+        branch = CountingBranch(self.diff, {"master": "rev"})
+        page = DiffPage(None, self.cache)
+        html = page.get_highlighted_diff(branch, "master")
+        self.assertEquals(html, self.cache.get(
+            "diff-html-%d-rev" % page.highlight_version))
+
+
+class BuildOutputTests(BuildFarmTestCase):
+
+    def setUp(self):
+        super(BuildOutputTests, self).setUp()
+        self.buildfarm = BuildFarm(self.path)
+        self.write_compilers(["cc"])
+        self.write_hosts(["charis"])
+        self.log = ("BUILD COMMIT REVISION: 12\n"
+                    "Running action test\n"
+                    "test: foo\n"
+                    "success: foo\n"
+                    "ACTION PASSED: test\n")
+        self.upload_mock_logfile(self.buildfarm.builds, "tdb", "charis", "cc",
+            self.log)
+        self.build = self.buildfarm.builds.get_build("tdb", "charis", "cc")
+        self.app = BuildFarmApp(self.buildfarm)
+
+    def get(self, subfn, accept_encoding=None, if_none_match=None, query=""):
+        environ = {
+            "PATH_INFO": "/build/%s/%s" % (self.build.checksum, subfn),
+            "QUERY_STRING": query,
+            "wsgi.input": StringIO(""),
+            }
+        if accept_encoding is not None:
+            environ["HTTP_ACCEPT_ENCODING"] = accept_encoding
+        if if_none_match is not None:
+            environ["HTTP_IF_NONE_MATCH"] = if_none_match
+        setup_testing_defaults(environ)
+        response = []
+        def start_response(status, headers):
+            response.append((status, dict(headers)))
+        body = "".join(self.app(environ, start_response))
+        return response[0] + (body,)
+
+    def test_stdout(self):
+        (status, headers, body) = self.get("+stdout")
+        self.assertEquals("200 OK", status)
+        self.assertEquals(self.log, body)
+        self.assertEquals(str(len(self.log)), headers["Content-Length"])
+
+    def test_stderr_missing(self):
+        (status, headers, body) = self.get("+stderr")
+        self.assertEquals("200 OK", status)
+        self.assertEquals("", body)
+
+    def test_subunit(self):
+        (status, headers, body) = self.get("+subunit")
+        self.assertEquals("test: foo\nsuccess: foo\n", body)
+        self.assertFalse("Content-Length" in headers)
+
+    def test_subunit_unfinished(self):
+        os.unlink(os.path.join(self.path, "data", "upload",
+            "build.tdb.charis.cc.log"))
+        self.upload_mock_logfile(self.buildfarm.builds, "tdb", "charis", "cc",
+            "BUILD COMMIT REVISION: 13\n"
+            "Running action test\n"
+            "success: a\n"
+            "Running action install\n")
+        self.build = self.buildfarm.builds.get_build("tdb", "charis", "cc", "13")
+        (status, headers, body) = self.get("+subunit")
+        self.assertEquals("success: a\n", body)
+        self.build.write_subunit()
+        (status, headers, body) = self.get("+subunit")
+        self.assertEquals("success: a\n", body)
+        self.assertEquals({"a": "success"}, self.build.test_results())
+
+    def test_subunit_prerendered(self):
+        self.build.write_subunit()
+        (status, headers, body) = self.get("+subunit")
+        self.assertEquals("test: foo\nsuccess: foo\n", body)
+        (status, headers, body) = self.get("+subunit", accept_encoding="gzip")
+        self.assertEquals("gzip", headers["Content-Encoding"])
+        self.assertEquals(str(len(body)), headers["Content-Length"])
+
+    def upload_newer_build(self):
+        old = self.buildfarm.builds.get_build("tdb", "charis", "cc", "12")
+        # The uploaded log is hard linked to that of the old build
+        os.unlink(os.path.join(self.path, "data", "upload",
+            "build.tdb.charis.cc.log"))
+        self.upload_mock_logfile(self.buildfarm.builds, "tdb", "charis", "cc",
+            "BUILD COMMIT REVISION: 13\n"
+            "Running action test\n"
+            "failure: foo\n"
+            "success: bar\n"
+            "ACTION FAILED: test\n")
+        self.build = self.buildfarm.builds.get_build("tdb", "charis", "cc", "13")
+        return old
+
+    def test_subunit_diff(self):
+        old = self.upload_newer_build()
+        (status, headers, body) = self.get("+subunit-diff/%s" % old.checksum)
+        self.assertEquals("200 OK", status)
+        self.assertEquals("text/plain; charset=utf-8", headers["Content-type"])
+        self.assertEquals("Newly failing tests:\n"
+                          "    foo (success -> failure)\n"
+                          "Added tests:\n"
+                          "    bar: success\n", body)
+
+    def test_subunit_diff_json(self):
+        old = self.upload_newer_build()
+        (status, headers, body) = self.get("+subunit-diff/%s" % old.checksum,
+            query="format=json")
+        self.assertEquals("application/json", headers["Content-type"])
+        self.assertEquals({
+            "newly_failing": [{"test": "foo", "old": "success", "new": "failure"}],
+            "newly_passing": [],
+            "added": [{"test": "bar", "result": "success"}],
+            "removed": [],
+            }, json.loads(body))
+
+    def test_test_diff(self):
+        old = self.upload_newer_build()
+        self.buildfarm.hostdb["charis"].update_platform(u"Debian")
+        (status, headers, body) = self.get("+test-diff/%s" % old.checksum)
+        self.assertEquals("200 OK", status)
+        self.assertTrue("<h3>Newly failing tests</h3>" in body)
+        self.assertTrue("<td>foo</td><td>success</td><td>failure</td>" in body)
+
+    def test_subunit_diff_unknown(self):
+        (status, headers, body) = self.get("+subunit-diff/nonexistent")
+        self.assertEquals("404 Page Not Found", status)
+        self.assertEquals("No build with checksum nonexistent found", body)
+
+    def test_test_diff_unknown(self):
+        (status, headers, body) = self.get("+test-diff/nonexistent")
+        self.assertEquals("404 Page Not Found", status)
+        self.assertEquals("No build with checksum nonexistent found", body)
+
+    def compress_log(self):
+        os.unlink(self.build.basename + ".log")
+        f = open(self.build.basename + ".log.bz2", 'w')
+        try:
+            f.write(bz2.compress(self.log))
+        finally:
+            f.close()
+
+    def test_stdout_compressed(self):
+        self.compress_log()
+        (status, headers, body) = self.get("+stdout")
+        self.assertEquals(self.log, body)
+        self.assertNotIn("Content-Encoding", headers)
+
+    def test_stdout_compressed_passthrough(self):
+        self.compress_log()
+        (status, headers, body) = self.get("+stdout", "gzip, bzip2")
+        self.assertEquals("bzip2", headers["Content-Encoding"])
+        self.assertEquals(str(len(body)), headers["Content-Length"])
+        self.assertEquals(self.log, bz2.decompress(body))
+
+    def test_immutable(self):
+        (status, headers, body) = self.get("+stdout")
+        self.assertEquals('W/"%s"' % self.build.checksum, headers["ETag"])
+        self.assertIn("immutable", headers["Cache-Control"])
+
+    def test_not_modified(self):
+        (status, headers, body) = self.get("+stdout",
+            if_none_match='W/"%s"' % self.build.checksum)
+        self.assertEquals("304 Not Modified", status)
+        self.assertEquals("", body)
+
+    def test_page_cache_headers(self):
+        self.assertEquals([('Cache-Control', 'max-age=%d' % MIN_PAGE_MAX_AGE)],
+            self.app.page_cache_headers("tdb"))
+        self.assertEquals([('Cache-Control', 'max-age=%d' % MAX_PAGE_MAX_AGE)],
+            self.app.page_cache_headers("unknown"))
+
+
+class HostMenuTests(BuildFarmTestCase):
+
+    def setUp(self):
+        super(HostMenuTests, self).setUp()
+        self.buildfarm = BuildFarm(self.path)
+        self.app = BuildFarmApp(self.buildfarm)
+
+    def test_refreshed(self):
+        self.buildfarm.hostdb.createhost("charis", u"Debian")
+        self.assertEquals({"charis": "Debian-charis"}, self.app.host_menu())
+        self.buildfarm.hostdb["charis"].update_platform(u"Fedora")
+        self.assertEquals({"charis": "Fedora-charis"}, self.app.host_menu())
+
+
+class FlakyTestsPageTests(BuildFarmTestCase):
+
+    def setUp(self):
+        super(FlakyTestsPageTests, self).setUp()
+        self.write_trees({"tdb": {"scm": "git", "branch": "master",
+            "repo": "tdb"}})
+        self.write_compilers(["cc"])
+        self.buildfarm = BuildFarm(self.path)
+        self.write_hosts(["charis"])
+        self.page = FlakyTestsPage(self.buildfarm)
+
+    def test_none(self):
+        self.assertTrue("No flaky tests" in
+            "".join(self.page.render("http://example.com/", "tdb")))
+
+    def test_flaky(self):
+        for (i, result) in enumerate(["success", "failure"] * 2):
+            self.upload_mock_logfile(self.buildfarm.builds, "tdb", "charis",
+                "cc", "BUILD COMMIT REVISION: %d\nRunning action test\n"
+                "%s: samba.flaky\nACTION PASSED: test\n" % (i, result),
+                mtime=1000 + i)
+        html = "".join(self.page.render("http://example.com/", "tdb"))
+        self.assertTrue("<td>samba.flaky</td>" in html)
+        self.assertTrue("charis" in html)
+
+    def test_unknown_tree(self):
+        self.assertEquals("Unknown tree foo",
+            "".join(self.page.render("http://example.com/", "foo")))
+        self.assertEquals("Unknown tree None",
+            "".join(self.page.render("http://example.com/", None)))
+
+
+class ViewRecentBuildsPageTests(BuildFarmTestCase):
+
+    def setUp(self):
+        super(ViewRecentBuildsPageTests, self).setUp()
+        self.write_trees({"tdb": {"scm": "git", "branch": "master",
+            "repo": "tdb"}})
+        self.write_compilers(["cc"])
+        self.buildfarm = BuildFarm(self.path)
+        self.page = ViewRecentBuildsPage(self.buildfarm)
+
+    def test_platforms(self):
+        self.buildfarm.hostdb.createhost("charis", u"Debian \xe9")
+        self.buildfarm.hostdb.createhost("gonehost", u"AIX")
+        self.upload_mock_logfile(self.buildfarm.builds, "tdb", "charis", "cc",
+            "BUILD COMMIT REVISION: 12\n", mtime=1200)
+        self.upload_mock_logfile(self.buildfarm.builds, "tdb", "gonehost",
+            "cc", "BUILD COMMIT REVISION: 13\n", mtime=1300)
+        self.buildfarm.hostdb.deletehost("gonehost")
+        chunks = list(self.page.render("http://example.com/", "tdb"))
+        self.assertEquals([], [c for c in chunks if isinstance(c, unicode)])
+        html = "".join(chunks)
+        self.assertTrue("<td>Debian \xc3\xa9</td>" in html)
+        self.assertTrue("<td>UNKNOWN</td>" in html)
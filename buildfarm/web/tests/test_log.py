@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+from cStringIO import StringIO
+import os
+
+from buildfarm import BuildFarm
+from buildfarm.cache import FileCache
+from buildfarm.tests import BuildFarmTestCase
+from buildfarm.web import (
+    ViewBuildPage,
+    decode_rendered_logs,
+    encode_rendered_logs,
+    make_collapsible_html,
+    print_log_pretty,
+    split_lines,
+    )
+
+import testtools
+
+
+def collapsible(type, title, output, id, status=""):
+    return "".join(make_collapsible_html(type, title, output, id, status))
+
+
+class SplitLinesTests(testtools.TestCase):
+
+    def test_trailing_newline(self):
+        self.assertEquals(["a", "b", ""], list(split_lines(StringIO("a\nb\n"))))
+
+    def test_no_trailing_newline(self):
+        self.assertEquals(["a", "b"], list(split_lines(StringIO("a\nb"))))
+
+    def test_empty(self):
+        self.assertEquals([""], list(split_lines(StringIO(""))))
+
+
+class PrettyPrintTests(testtools.TestCase):
+
+    def test_plain(self):
+        self.assertEquals("<pre>foo\nbar\n</pre>", print_log_pretty("foo\nbar\n"))
+
+    def test_action(self):
+        self.assertEquals(
+            "<pre>foo\n" + collapsible("action", "configure",
+                "Running action configure\nbla\nACTION PASSED: configure", 1,
+                "PASSED") + "\n</pre>",
+            print_log_pretty("foo\nRunning action configure\nbla\n"
+                             "ACTION PASSED: configure\n"))
+
+    def test_unfinished_action(self):
+        log = "Running action configure\nbla\n"
+        self.assertEquals("<pre>%s</pre>" % log, print_log_pretty(log))
+
+    def test_testsuites(self):
+        log = ("testsuite: foo\nbla\ntestsuite-success: foo\n"
+               "testsuite: bar\ntestsuite-failure: bar [\nbroken\n]\n")
+        self.assertEquals(
+            "<pre>" + collapsible("test", "foo", "bla", 1, "passed") + "\n" +
+            collapsible("test", "bar",
+                '<div class="reason">broken</div>'
+                "<p><a href='#shortcut2errors'>back to error list</a>", 2,
+                "failed") + "\n</pre>",
+            print_log_pretty(log))
+
+    def test_failed_test_links(self):
+        log = ("Running action test\npretest\ntestsuite: bar\n"
+               "testsuite-failure: bar\nACTION FAILED: test")
+        html = print_log_pretty(log)
+        # The pretest and testsuite sections are numbered after the action
+        self.assertIn("id='pretest-2'", html)
+        self.assertIn("id='test-3'", html)
+        self.assertIn(collapsible("testlinks", "Shortcut to failed tests",
+            "<a name='shortcut2errors'></a>\n<A href='#lnk-test-3'>bar</A>", 3),
+            html)
+
+
+class RenderedLogsTests(testtools.TestCase):
+
+    def test_roundtrip(self):
+        rendered = ("Linux foo", None, "--enable-developer",
+                    "<h2>Build log:</h2>\n<pre>a\n\nb\n</pre>")
+        self.assertEquals(rendered,
+            decode_rendered_logs(encode_rendered_logs(*rendered)))
+
+    def test_roundtrip_empty(self):
+        rendered = (None, None, None, "")
+        self.assertEquals(rendered,
+            decode_rendered_logs(encode_rendered_logs(*rendered)))
+
+
+class RenderedLogsCacheTests(BuildFarmTestCase):
+
+    def setUp(self):
+        super(RenderedLogsCacheTests, self).setUp()
+        self.buildfarm = BuildFarm(self.path)
+        self.write_compilers(["cc"])
+        self.write_hosts(["charis"])
+        self.upload_mock_logfile(self.buildfarm.builds, "tdb", "charis", "cc",
+            "Linux charis\nBUILD COMMIT REVISION: 12\n", "warning: foo\n")
+        self.build = self.buildfarm.builds.get_build("tdb", "charis", "cc")
+        self.expected = ViewBuildPage(self.buildfarm).render_logs(self.build)
+
+    def test_cache(self):
+        page = ViewBuildPage(self.buildfarm,
+            FileCache(os.path.join(self.path, "cache"), 1024 * 1024))
+        self.assertEquals(self.expected, page.get_rendered_logs(self.build))
+        os.unlink(self.build.basename + ".log")
+        self.assertEquals(self.expected, page.get_rendered_logs(self.build))
+
+    def test_prerendered(self):
+        page = ViewBuildPage(self.buildfarm)
+        page.prerender_logs(self.build)
+        os.unlink(self.build.basename + ".log")
+        self.assertEquals(self.expected, page.get_rendered_logs(self.build))
+
+    def test_prerendered_outdated(self):
+        page = ViewBuildPage(self.buildfarm)
+        page.prerender_logs(self.build)
+        page.render_version += 1
+        self.assertIs(None, page.read_prerendered_logs(self.build))
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# Copyright (C) Jelmer Vernooij <jelmer@samba.org> 2010
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import urllib2
+from wsgiref.simple_server import WSGIRequestHandler
+
+from buildfarm.web.server import (
+    ClosingIterable,
+    StaticFiles,
+    ThreadedBuildFarmApp,
+    ThreadPoolWSGIServer,
+    parse_range,
+    )
+
+import testtools
+
+
+class LoggingBuildFarm(object):
+
+    def __init__(self):
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class ThreadedBuildFarmAppTests(testtools.TestCase):
+
+    def test_buildfarm_per_thread(self):
+        app = ThreadedBuildFarmApp(LoggingBuildFarm)
+        buildfarms = []
+        t = threading.Thread(target=lambda: buildfarms.append(app.buildfarm))
+        t.start()
+        t.join()
+        buildfarms.append(app.buildfarm)
+        self.assertIs(buildfarms[1], app.buildfarm)
+        self.assertIsNot(buildfarms[0], buildfarms[1])
+
+
+class ClosingIterableTests(testtools.TestCase):
+
+    def test_close(self):
+        closed = []
+        result = ClosingIterable(iter(["a", "b"]), lambda: closed.append(True))
+        self.assertEquals(["a", "b"], list(result))
+        self.assertEquals([], closed)
+        result.close()
+        self.assertEquals([True], closed)
+
+
+class ParseRangeTests(testtools.TestCase):
+
+    def test_range(self):
+        self.assertEquals((10, 11), parse_range("bytes=10-20", 100))
+
+    def test_open_ended(self):
+        self.assertEquals((90, 10), parse_range("bytes=90-", 100))
+
+    def test_suffix(self):
+        self.assertEquals((70, 30), parse_range("bytes=-30", 100))
+        self.assertEquals((0, 100), parse_range("bytes=-300", 100))
+
+    def test_truncated(self):
+        self.assertEquals((90, 10), parse_range("bytes=90-200", 100))
+
+    def test_unsatisfiable(self):
+        self.assertEquals(False, parse_range("bytes=100-", 100))
+        self.assertEquals(False, parse_range("bytes=-0", 100))
+
+    def test_ignored(self):
+        self.assertEquals(None, parse_range("bytes=0-1,5-6", 100))
+        self.assertEquals(None, parse_range("bytes=-", 100))
+        self.assertEquals(None, parse_range("bytes=20-10", 100))
+        self.assertEquals(None, parse_range("lines=1-2", 100))
+
+
+class StaticFilesTests(testtools.TestCase):
+
+    def setUp(self):
+        super(StaticFilesTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        f = open(os.path.join(self.path, "build_farm.css"), 'w')
+        try:
+            f.write("body { color: black; }\n")
+        finally:
+            f.close()
+        f = open(os.path.join(self.path, "README"), 'w')
+        try:
+            f.write("Not served.\n")
+        finally:
+            f.close()
+
+    def fallback_app(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ["fallback"]
+
+    def request(self, path, **headers):
+        environ = {"PATH_INFO": path}
+        for (name, value) in headers.items():
+            environ["HTTP_" + name.upper()] = value
+        response = []
+        def start_response(status, headers):
+            response.append(status)
+            response.append(dict(headers))
+        app = StaticFiles(self.path, self.fallback_app)
+        body = "".join(app(environ, start_response))
+        return (response[0], response[1], body)
+
+    def test_file(self):
+        (status, headers, body) = self.request("/build_farm.css")
+        self.assertEquals("200 OK", status)
+        self.assertEquals("body { color: black; }\n", body)
+        self.assertEquals("text/css", headers["Content-Type"])
+        self.assertEquals(str(len(body)), headers["Content-Length"])
+        self.assertEquals("public, max-age=31536000", headers["Cache-Control"])
+        self.assertTrue("ETag" in headers)
+        self.assertFalse("Vary" in headers)
+
+    def test_fallback(self):
+        self.assertEquals(("200 OK", {"Content-Type": "text/plain"}, "fallback"),
+            self.request("/README"))
+        self.assertEquals("fallback", self.request("/")[2])
+        self.assertEquals("fallback", self.request("/build_farm.css.gz")[2])
+
+    def test_not_modified(self):
+        etag = self.request("/build_farm.css")[1]["ETag"]
+        (status, headers, body) = self.request("/build_farm.css",
+            if_none_match=etag)
+        self.assertEquals("304 Not Modified", status)
+        self.assertEquals("", body)
+
+    def test_range(self):
+        (status, headers, body) = self.request("/build_farm.css",
+            range="bytes=0-3")
+        self.assertEquals("206 Partial Content", status)
+        self.assertEquals("body", body)
+        self.assertEquals("bytes 0-3/23", headers["Content-Range"])
+
+    def test_range_outdated(self):
+        (status, headers, body) = self.request("/build_farm.css",
+            range="bytes=0-3", if_range='"other"')
+        self.assertEquals("200 OK", status)
+        self.assertEquals("body { color: black; }\n", body)
+
+    def test_range_unsatisfiable(self):
+        (status, headers, body) = self.request("/build_farm.css",
+            range="bytes=100-")
+        self.assertEquals("416 Requested Range Not Satisfiable", status)
+        self.assertEquals("bytes */23", headers["Content-Range"])
+
+    def test_gzip(self):
+        f = gzip.open(os.path.join(self.path, "build_farm.css.gz"), 'wb')
+        try:
+            f.write("body { color: black; }\n")
+        finally:
+            f.close()
+        (status, headers, body) = self.request("/build_farm.css",
+            accept_encoding="gzip")
+        self.assertEquals("gzip", headers["Content-Encoding"])
+        self.assertEquals("Accept-Encoding", headers["Vary"])
+        self.assertEquals("\x1f\x8b", body[:2])
+        (status, headers, body) = self.request("/build_farm.css")
+        self.assertFalse("Content-Encoding" in headers)
+        self.assertEquals("body { color: black; }\n", body)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadPoolWSGIServerTests(testtools.TestCase):
+
+    def setUp(self):
+        super(ThreadPoolWSGIServerTests, self).setUp()
+        self.unblock = threading.Event()
+        self.httpd = ThreadPoolWSGIServer(("localhost", 0),
+            QuietRequestHandler, threads=2)
+        self.httpd.set_app(self.app)
+        t = threading.Thread(target=self.httpd.serve_forever)
+        t.start()
+        self.addCleanup(t.join)
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+        self.addCleanup(self.unblock.set)
+
+    def app(self, environ, start_response):
+        if environ["PATH_INFO"] == "/slow":
+            self.unblock.wait(10)
+        start_response('200 OK', [('Content-type', 'text/plain')])
+        return [environ["PATH_INFO"]]
+
+    def get(self, path):
+        opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+        return opener.open("http://localhost:%d%s" % (
+            self.httpd.server_port, path)).read()
+
+    def test_concurrent(self):
+        slow = []
+        t = threading.Thread(target=lambda: slow.append(self.get("/slow")))
+        t.start()
+        self.assertEquals("/fast", self.get("/fast"))
+        self.assertEquals([], slow)
+        self.unblock.set()
+        t.join()
+        self.assertEquals(["/slow"], slow)
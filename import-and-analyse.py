@@ -8,23 +8,32 @@
 them into the database, add links to the oldrevs/ directory and send
 some mail chastising the possible culprits when the build fails, based
 on recent commits.
+
+The mails are only queued; send-queued-mail.py delivers them.
 """
 
 from buildfarm.build import (
     BuildDiff,
     MissingRevisionInfo,
     NoSuchBuildError,
+    NoTestOutput,
+    UploadWatcher,
+    analyse_build,
     )
 from buildfarm import BuildFarm
-from buildfarm.web import build_uri
-from email.mime.text import MIMEText
+from buildfarm.outbox import QueuedNotice, format_digest
+from buildfarm.web import ViewBuildPage, build_uri
+import multiprocessing
 import optparse
 import resource
-import smtplib
 
 parser = optparse.OptionParser("import-and-analyse [options]")
-parser.add_option("--dry-run", help="Will cause the script to send output to stdout instead of to sendmail.", action="store_true")
+parser.add_option("--dry-run", help="Will cause the script to send output to stdout instead of to the mail queue.", action="store_true")
 parser.add_option("--verbose", help="Be verbose", action="count")
+parser.add_option("--jobs", help="Number of processes to analyse logs with [1]", type=int, default=1)
+parser.add_option("--batch-size", help="Number of builds to import per transaction [20]", type=int, default=20)
+parser.add_option("--watch", help="Keep running, and import new builds as soon as they are uploaded.", action="store_true")
+parser.add_option("--prerender", help="Render the build log and extract the subunit output of new builds, so the web frontend does not have to.", action="store_true")
 
 (opts, args) = parser.parse_args()
 
@@ -33,9 +42,6 @@ resource.setrlimit(resource.RLIMIT_DATA, (300000, 300000))
 
 buildfarm = BuildFarm(timeout=40.0)
 
-smtp = smtplib.SMTP()
-smtp.connect()
-
 def check_and_send_mails(cur, old):
 
     if cur.tree is "waf":
@@ -47,13 +53,23 @@ def check_and_send_mails(cur, old):
         return
 
     t = buildfarm.trees[cur.tree]
-    diff = BuildDiff(t, old, cur)
+    diff = BuildDiff(t, old, cur, buildfarm.builds.find_test_results(old),
+        buildfarm.builds.find_test_results(cur))
+    flaky_tests = set([f.test.name for f in
+        buildfarm.builds.get_flaky_tests(cur.tree, cur.host, cur.compiler)])
 
-    if not diff.is_regression():
+    if not diff.is_regression(flaky_tests):
         if opts.verbose >= 3:
             print "... hasn't regressed since %s: %s" % (diff.old_rev, diff.old_status)
         return
 
+    regressed_tests = ""
+    for (name, old_result, new_result) in diff.regressed_tests(flaky_tests):
+        regressed_tests += "    %s (%s -> %s)\n" % (name,
+            old_result or "not run", new_result)
+    if regressed_tests:
+        regressed_tests = "The following tests started failing:\n\n" + regressed_tests
+
     recipients = set()
     change_log = ""
 
@@ -78,68 +94,136 @@ Build status for old revision %(old_rev)s was %(old_status)s
 
 See %(build_link)s
 
-The build may have been broken by one of the following commits:
-
-%(change_log)s
-    """ % {
+%(regressed_tests)s""" % {
         "tree": cur.tree, "host": cur.host, "compiler": cur.compiler,
-        "change_log": change_log,
         "scm": t.scm,
         "branch": t.branch,
         "cur_rev": diff.new_rev,
         "old_rev": diff.old_rev,
         "cur_status": diff.new_status,
         "old_status": diff.old_status,
-        "build_link": build_uri("https://build.samba.org/build.cgi", cur)
+        "build_link": build_uri("https://build.samba.org/build.cgi", cur),
+        "regressed_tests": regressed_tests,
         }
 
-    msg = MIMEText(body)
-    msg["Subject"] = "BUILD of %s:%s BROKEN on %s with %s AT REVISION %s" % (cur.tree, t.branch, cur.host, cur.compiler, diff.new_rev)
-    msg["From"] = "\"Build Farm\" <build@samba.org>"
-    msg["To"] = ",".join(recipients)
-    if not opts.dry_run:
-        smtp.sendmail(msg["From"], [msg["To"]], msg.as_string())
-    else:
-        print msg.as_string()
+    # Other hosts broken by the same commits end up in the same mail
+    for recipient in sorted(recipients):
+        notice = QueuedNotice(cur.tree, t.branch, cur.host, cur.compiler,
+            diff.old_rev, diff.new_rev, recipient, body, change_log)
+        if not opts.dry_run:
+            buildfarm.outbox.queue(notice)
+        else:
+            print format_digest([notice]).as_string()
+
+
+# Logs that have been imported but not yet committed; they are only
+# removed from the upload directory once the transaction has been committed.
+imported_builds = []
 
+def commit():
+    buildfarm.commit()
+    for old_build in imported_builds:
+        old_build.remove()
+    del imported_builds[:]
+    buildfarm.upload_builds.save_index()
+
+
+def prerender(build):
+    ViewBuildPage(buildfarm).prerender_logs(build)
+    try:
+        build.write_subunit()
+    except NoTestOutput:
+        pass
+
+
+def update_history_indexes():
+    # The web frontend only reads the indexes, so keep them up to date here
+    for tree in buildfarm.trees.values():
+        branch = tree.get_branch()
+        try:
+            branch.update_index()
+        finally:
+            branch.close()
 
-for build in buildfarm.get_new_builds():
-    if build in buildfarm.builds:
-        continue
 
+def mark_seen(build):
     if not opts.dry_run:
-        old_build = build
+        buildfarm.upload_builds.mark_seen(build)
+
+
+def import_builds(new_builds):
+    for build in new_builds:
+        if build in buildfarm.builds:
+            mark_seen(build)
+            continue
+
+        if not opts.dry_run:
+            old_build = build
+            try:
+                build = buildfarm.builds.upload_build(old_build)
+            except MissingRevisionInfo:
+                print "No revision info in %r, skipping" % build
+                mark_seen(build)
+                continue
+
         try:
-            build = buildfarm.builds.upload_build(old_build)
+            rev = build.revision_details()
         except MissingRevisionInfo:
             print "No revision info in %r, skipping" % build
             continue
 
-    try:
-        rev = build.revision_details()
-    except MissingRevisionInfo:
-        print "No revision info in %r, skipping" % build
-        continue
+        if opts.prerender and not opts.dry_run:
+            prerender(build)
 
-    if opts.verbose >= 2:
-        print "%s... " % build,
-        print str(build.status())
+        if opts.verbose >= 2:
+            print "%s... " % build,
+            print str(build.status())
 
-    try:
-        if opts.dry_run:
-            # Perhaps this is a dry run and rev is not in the database yet?
-            prev_build = buildfarm.builds.get_latest_build(build.tree, build.host, build.compiler)
+        try:
+            if opts.dry_run:
+                # Perhaps this is a dry run and rev is not in the database yet?
+                prev_build = buildfarm.builds.get_latest_build(build.tree, build.host, build.compiler)
+            else:
+                prev_build = buildfarm.builds.get_previous_build(build.tree, build.host, build.compiler, rev)
+        except NoSuchBuildError:
+            if opts.verbose >= 1:
+                print "Unable to find previous build for %s,%s,%s" % (build.tree, build.host, build.compiler)
+            # Can't send a nastygram until there are 2 builds..
         else:
-            prev_build = buildfarm.builds.get_previous_build(build.tree, build.host, build.compiler, rev)
-    except NoSuchBuildError:
-        if opts.verbose >= 1:
-            print "Unable to find previous build for %s,%s,%s" % (build.tree, build.host, build.compiler)
-        # Can't send a nastygram until there are 2 builds..
-    else:
-        check_and_send_mails(build, prev_build)
+            check_and_send_mails(build, prev_build)
+
+        if not opts.dry_run:
+            imported_builds.append(old_build)
+            if len(imported_builds) >= opts.batch_size:
+                commit()
 
     if not opts.dry_run:
-        old_build.remove()
-        buildfarm.commit()
+        commit()
+
 
-smtp.quit()
+if opts.jobs > 1:
+    # Parse and checksum the logs in worker processes; all database
+    # access stays in this process.
+    pool = multiprocessing.Pool(opts.jobs)
+else:
+    pool = None
+
+if opts.watch:
+    watcher = UploadWatcher(buildfarm.upload_builds.path)
+else:
+    watcher = None
+
+while True:
+    if not opts.dry_run:
+        update_history_indexes()
+    new_builds = buildfarm.get_new_builds(unseen_only=True)
+    if pool is not None:
+        new_builds = pool.imap(analyse_build, list(new_builds))
+    import_builds(new_builds)
+    if watcher is None:
+        break
+    watcher.wait()
+
+if pool is not None:
+    pool.close()
+    pool.join()
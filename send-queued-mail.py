@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# Send the regression mails queued by import-and-analyse.py
+# Copyright (C) 2010 Jelmer Vernooij <jelmer@samba.org>
+# Published under the GNU GPL
+
+"""Script to deliver the queued regression mails.
+
+All mails are sent over a single SMTP connection. Mails that can not be
+delivered are retried on later runs, with an increasing delay. Run this
+regularly from cron, e.g. every five minutes. If a previous run is still
+sending, the new run exits without doing anything.
+"""
+
+from buildfarm import BuildFarm
+from buildfarm.outbox import format_digest
+import errno
+import fcntl
+import optparse
+import os
+import smtplib
+import sys
+
+parser = optparse.OptionParser("send-queued-mail [options]")
+parser.add_option("--dry-run", help="Print the mails that are due instead of sending them.", action="store_true")
+parser.add_option("--verbose", help="Be verbose", action="count")
+parser.add_option("--smtp-host", help="SMTP server to send the mails through [localhost]", default="localhost")
+parser.add_option("--smtp-port", help="Port of the SMTP server [25]", type=int, default=25)
+
+(opts, args) = parser.parse_args()
+
+buildfarm = BuildFarm(timeout=40.0)
+
+if opts.dry_run:
+    for notices in buildfarm.outbox.due_digests():
+        print format_digest(notices).as_string()
+else:
+    # Two senders would both send the digests that are due before either
+    # of them has removed them from the queue.
+    lock = open(os.path.join(buildfarm.path, "data", "send-queued-mail.lock"), 'w')
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        if opts.verbose >= 1:
+            print "Another send-queued-mail is still running"
+        sys.exit(0)
+    smtp = smtplib.SMTP(opts.smtp_host, opts.smtp_port)
+    try:
+        (sent, deferred) = buildfarm.outbox.send(smtp)
+    except:
+        # The connection may be gone, so don't let QUIT hide the error
+        smtp.close()
+        raise
+    smtp.quit()
+    if opts.verbose >= 1:
+        print "Sent %d mails, %d failed" % (sent, deferred)
@@ -14,6 +14,7 @@ from buildfarm.build import (
     extract_test_output,
     )
 from buildfarm.hostdb import NoSuchHost
+from buildfarm.sqldb import insert_build_stages
 
 from buildfarm import BuildFarm, StormBuild
 
@@ -37,6 +38,7 @@ for build in store.find(StormBuild, StormBuild.status_str == None):
     finally:
         log.close()
     build.status_str = status.__serialize__()
+    insert_build_stages(store, build.id, status)
     print "Updating status for %r" % build
 
 
@@ -55,6 +57,22 @@ for build in store.find(StormBuild, StormBuild.revision == None):
     build.revision = revision
     print "Updating revision for %r" % build
 
+for build in store.find(StormBuild, StormBuild.err_lines == None):
+    if build.basename is None or not build.has_log():
+        # Without the logs the count is unknown; leave it NULL rather
+        # than storing a bogus zero.
+        continue
+    err = build.read_err()
+    try:
+        build.err_lines = 0
+        build.err_size = 0
+        for l in err:
+            build.err_lines += 1
+            build.err_size += len(l)
+    finally:
+        err.close()
+    print "Updating warning count for %r" % build
+
 for build in store.find(StormBuild, StormBuild.host_id == None):
     try:
         build.host_id = buildfarm.hostdb[build.host].id
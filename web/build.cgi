@@ -37,7 +37,8 @@ if CGI_DEBUG:
     handler.log_exception = cgitb.handler
 
 from buildfarm import BuildFarm
-from buildfarm.web import BuildFarmApp
+from buildfarm.web import BuildFarmApp, open_diff_cache, open_render_cache
 buildfarm = BuildFarm()
-buildApp = BuildFarmApp(buildfarm)
+buildApp = BuildFarmApp(buildfarm, open_render_cache(buildfarm),
+    open_diff_cache(buildfarm))
 handler.run(buildApp)